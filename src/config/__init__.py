@@ -11,7 +11,8 @@ import os
 # app.config['FSM_APP_INFO_DATA']:  Dictionary with this specific App details, versioning, owner, etc.
 
 class TestConfig(object):
-    settings = ['FSM_VIEW_APP_NAME', 'FSM_APP_INFO_DATA', 'FSM_APP_ROOT', 'FSM_SA_KEY_JSON_FILE', 'FSM_APP_OBJECTS_PATH']
+    settings = ['FSM_VIEW_APP_NAME', 'FSM_APP_INFO_DATA', 'FSM_APP_ROOT', 'FSM_SA_KEY_JSON_FILE', 'FSM_APP_OBJECTS_PATH',
+                'FSM_BACKEND']
     # Application FS details
     FSM_VIEW_APP_NAME = os.environ.get('FSM_VIEW_APP_NAME') or 'gfs-fs-manager'
     FSM_APP_INFO_DATA = {'description': 'Firestore Manager Base', 'version': '1.0', 'stage': 'alpha', 'env': 'test'}
@@ -23,10 +24,12 @@ class TestConfig(object):
     # FROM OS or known filesystem path
     # FSM_SA_KEY_JSON_FILE = os.environ.get('FSM_SA_KEY_JSON_FILE') or '/etc/secrets/sa_key_fs.json'
     # Force using ENV variable for tests
-    FSM_SA_KEY_JSON_FILE = os.environ.get('TEST_FSM_SA_KEY_JSON_FILE')
+    FSM_SA_KEY_JSON_FILE = os.environ.get('TEST_FSM_SA_KEY_JSON_FILE') or ''
     # Default Google Cloud Application credentials
     # FSM_SA_KEY_JSON_FILE = ''
     FSM_APP_OBJECTS_PATH = os.environ.get('FSM_APP_OBJECTS_PATH') or "gfs_manager_dev"
+    # Storage backend: in-memory database unless tests are run against Firestore (TEST_FSM_BACKEND=firestore)
+    FSM_BACKEND = os.environ.get('TEST_FSM_BACKEND') or 'memory'
 
     def to_dict(self):
         r = {}
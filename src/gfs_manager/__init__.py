@@ -1,8 +1,108 @@
+import gzip
 import os
 import logging
+import threading
+import time
+import weakref
+from typing import Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from google.api_core.exceptions import FailedPrecondition, NotFound
 from google.cloud import firestore
+from google.cloud.firestore_v1 import _helpers
 from google.cloud.firestore_v1.base_document import DocumentSnapshot
 from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.batch import WriteBatch
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.query import CollectionGroup
+from gfs_manager.buffered_writer import BufferedWriter, FSM_BUFFER_MAX_SIZE
+from gfs_manager.cache import DocumentCache, QueryCache, FSM_CACHE_MAX_BYTES, FSM_CACHE_MAX_ENTRIES, \
+    FSM_QUERY_CACHE_MAX_BYTES, FSM_QUERY_CACHE_MAX_ENTRIES
+from gfs_manager.client_pool import ClientPool, fs_client_pool
+from gfs_manager.export import Checkpoint, fs_decode_value, fs_export_file_name, fs_export_line, \
+    fs_read_export_file, fs_read_json, fs_write_json, FSM_EXPORT_CHECKPOINT, FSM_EXPORT_COMPRESS_LEVEL, \
+    FSM_EXPORT_FORMAT_VERSION, FSM_EXPORT_MANIFEST, FSM_IMPORT_CHECKPOINT
+from gfs_manager.fork import fs_fork_check, fs_register_at_fork, FSM_CLIENT_MANAGER, FSM_CLIENT_POLICIES, \
+    FSM_CLIENT_SHARED, FSM_CLIENT_THREAD
+from gfs_manager.counters import CounterValues, WriteCoalescer, fs_counter_shard, FSM_COUNTER_FIELD, \
+    FSM_COUNTER_SHARDS, FSM_COUNTER_SHARDS_COLLECTION, FSM_COUNTERS_COLLECTION
+from gfs_manager.indexes import SecondaryIndex, fs_collection_indexes, fs_index_check, fs_index_write, \
+    FSM_INDEX_DELETE, FSM_INDEX_MERGE, FSM_INDEX_SET, FSM_INDEX_UPDATE
+from gfs_manager.instrumentation import Instrumentation, MetricsInstrumentation, fs_bind_operation, \
+    fs_instrument_client, fs_instrumented, fs_record_error
+from gfs_manager.memory_backend import MemoryClient
+from gfs_manager.models import Model, ModelSchema, fs_model, fs_model_schema
+from gfs_manager.transactions import ContentionStats, FSTransactional, FSM_TRANSACTION_MAX_ATTEMPTS
+from gfs_manager.retry import RetryBudget, RetryPolicy, fs_retry_kwargs, FSM_RETRY_BUDGET, \
+    FSM_RETRY_BUDGET_RESERVE, FSM_RETRY_DEADLINE
+from gfs_manager.watch import CollectionWatch
+
+# Firestore limit of write operations in a single batched write
+FS_MAX_BATCH_SIZE = 500
+# Default number of batched writes committed concurrently by bulk operations
+FS_BATCH_MAX_WORKERS = 4
+# Default number of documents read per batched get (get_all) request
+FS_GET_ALL_BATCH_SIZE = 100
+# Default number of documents read per page by query iterators
+FS_QUERY_PAGE_SIZE = 500
+# Default number of partitions per worker of partitioned scans, smaller partitions balance the workers load
+FS_SCAN_PARTITIONS_PER_WORKER = 4
+# Firestore query filter operators
+FS_QUERY_OPERATORS = ['<', '<=', '==', '!=', '>=', '>', 'in', 'not-in', 'array_contains', 'array_contains_any']
+
+# Write modes for updates and deletes
+# Precondition: one RPC per write, existence is asserted by Firestore with write preconditions
+FSM_WRITE_PRECONDITION = 'precondition'
+# Strict: documents existence is read before writing, deletions are verified by reading after deleting
+FSM_WRITE_STRICT = 'strict'
+FSM_WRITE_MODES = [FSM_WRITE_PRECONDITION, FSM_WRITE_STRICT]
+
+# Storage backends
+# Firestore: Google Cloud Firestore database
+FSM_BACKEND_FIRESTORE = 'firestore'
+# Memory: in-process database, for offline tests and local benchmarking, data is lost when the process ends
+FSM_BACKEND_MEMORY = 'memory'
+FSM_BACKENDS = [FSM_BACKEND_FIRESTORE, FSM_BACKEND_MEMORY]
+
+# App config keys used to create the Firestore client and bootstrap the app document
+FSM_CONNECT_SETTINGS = ['FSM_SA_KEY_JSON_FILE', 'FSM_APP_ROOT', 'FSM_APP_OBJECTS_PATH', 'FSM_APP_INFO_DATA',
+                        'FSM_PROJECT', 'FSM_SHARED_CLIENT', 'FSM_CLIENT_POLICY', 'FSM_BACKEND']
+
+# App documents already bootstrapped in this process, per client: {client: {(FSM_APP_ROOT, FSM_APP_OBJECTS_PATH)}}
+_fs_bootstrapped_apps = weakref.WeakKeyDictionary()
+_fs_bootstrap_lock = threading.Lock()
+
+
+# Client of a thread (FSM_CLIENT_THREAD policy), held by the thread local data of the manager
+# The client is closed when the thread local data is released: once the thread has ended, or the thread clients of the
+# manager are dropped (close_connection, fork)
+class _FSThreadClient:
+    __slots__ = ('client', '__weakref__')
+
+    def __init__(self, fs_client):
+        self.client = fs_client
+        weakref.finalize(self, _fs_close_thread_client, fs_client, os.getpid()).atexit = False
+
+
+# Clients inherited by a forked child process are abandoned, not closed: their channels are used by the parent
+def _fs_close_thread_client(fs_client, pid):
+    if os.getpid() == pid:
+        fs_client.close()
+
+
+# Firestore batch accepting a write option (precondition) when replacing a document with set()
+# Firestore supports preconditions on any write, but the client library only exposes them for update() and delete()
+class _PreconditionSetBatch:
+    def set(self, reference, document_data, merge=False, option=None):
+        if option is None:
+            return super().set(reference, document_data, merge=merge)
+        write_pbs = _helpers.pbs_for_set_no_merge(reference._document_path, document_data)
+        option.modify_write(write_pbs[0])
+        self._document_references[reference._document_path] = reference
+        self._add_write_pbs(write_pbs)
+
+
+class GFSWriteBatch(_PreconditionSetBatch, WriteBatch):
+    pass
 
 
 # Google Firestore manager class
@@ -10,67 +110,475 @@ class GFSManager:
     def __init__(self):
         self.__path_prefix = None
         self.__fs_client = None
+        self.__write_mode = FSM_WRITE_PRECONDITION
+        self.__cache = None
+        self.__query_cache = None
+        self.__shared_client = False
+        self.__client_policy = FSM_CLIENT_SHARED
+        # FSM_CLIENT_THREAD policy: client of each thread, and the clients of the live threads
+        self.__thread_clients = threading.local()
+        self.__clients = weakref.WeakSet()
+        self.__app_config = None
+        self.__connect_pending = False
+        self.__connect_lock = threading.RLock()
+        self.__bootstrapped = False
+        # Process using the clients, clients are created again by forked child processes
+        self.__pid = os.getpid()
+        fs_register_at_fork(self)
+        self.__instrumentation = None
+        self.__retry_policy = RetryPolicy()
+        # Collection watches, stopped by close_connection
+        self.__watches = weakref.WeakSet()
+        self.__write_coalescer = None
+        self.__buffered_writer = None
+        # Spill file of the buffered writer recovered once connected
+        self.__recover_pending = False
+        # Sharded counter values read
+        self.__counter_values = CounterValues()
+        self.__contention_stats = ContentionStats()
 
     @property
     def path_prefix(self):
+        self._fs_ensure_connected()
         return self.__path_prefix
 
+    @property
+    def write_mode(self):
+        return self.__write_mode
+
+    @property
+    def cache(self):
+        # Document cache, None if caching is disabled
+        return self.__cache
+
+    # Plugs a document cache (DocumentCache or compatible object) used by fs_query_by_id and fs_doc_properties
+    # Cached documents are invalidated by the manager update and delete methods
+    # Use None to disable caching
+    def set_cache(self, cache):
+        self.__cache = cache
+
+    @property
+    def query_cache(self):
+        # Query result cache, None if caching is disabled
+        return self.__query_cache
+
+    # Plugs a query result cache (QueryCache or compatible object) used by fs_query, fs_query_by_collection and
+    # fs_query_by_properties
+    # Cached queries of a collection are invalidated by the manager writes to the collection, and by fs_watch_cache
+    # for the writes of other processes
+    # Use None to disable caching
+    def set_query_cache(self, query_cache):
+        self.__query_cache = query_cache
+
+    @property
+    def instrumentation(self):
+        # Operations instrumentation, None if disabled
+        return self.__instrumentation
+
+    # Plugs an instrumentation (MetricsInstrumentation or any Instrumentation implementation) notified of every
+    # manager operation with its duration, RPCs, bytes written and read, documents read and errors
+    # Use None to disable instrumentation
+    def set_instrumentation(self, instrumentation):
+        self.__instrumentation = instrumentation
+        if instrumentation is not None and self.__fs_client is not None:
+            fs_instrument_client(self.__fs_client)
+            for fs_client in list(self.__clients):
+                fs_instrument_client(fs_client)
+
+    @property
+    def retry_policy(self):
+        # Retry policy of Firestore calls, None if calls are not retried
+        return self.__retry_policy
+
+    # Plugs a retry policy (RetryPolicy or compatible object) for transient Firestore errors
+    # A policy for some calls only is set with fs_retrying(), see gfs_manager.retry
+    # Use None to disable retries
+    def set_retry_policy(self, retry_policy):
+        self.__retry_policy = retry_policy
+
+    @property
+    def contention_stats(self):
+        # Contention statistics of fs_transaction and fs_doc_transform, see gfs_manager.transactions
+        return self.__contention_stats
+
+    @property
+    def write_coalescer(self):
+        # Write buffer of fs_doc_merge and fs_counter_increment, None if writes are not buffered
+        return self.__write_coalescer
+
+    # Plugs a write buffer (WriteCoalescer or compatible object) merging the writes of fs_doc_merge and
+    # fs_counter_increment to the same document into one write per flush interval, see gfs_manager.counters
+    # Buffered writes are flushed by close_connection
+    # Use None to write immediately
+    def set_write_coalescer(self, write_coalescer):
+        self.__write_coalescer = write_coalescer
+
+    @property
+    def buffered_writer(self):
+        # Write-behind buffer of fs_doc_store_buffered and fs_doc_merge_buffered, None if writes are not buffered
+        return self.__buffered_writer
+
+    # Plugs a write-behind buffer (BufferedWriter or compatible object) committing the writes of fs_doc_store_buffered
+    # and fs_doc_merge_buffered in the background, see gfs_manager.buffered_writer
+    # Buffered writes are flushed by close_connection
+    # Use None to write immediately
+    def set_buffered_writer(self, buffered_writer):
+        self.__buffered_writer = buffered_writer
+
+    @property
+    def client_policy(self):
+        # Clients used by the threads of the process: FSM_CLIENT_SHARED, FSM_CLIENT_MANAGER or FSM_CLIENT_THREAD
+        return self.__client_policy
+
     @property
     def client(self):
-        # Firestore client
+        # Firestore client, created on first use in lazy mode, and by forked child processes
+        # FSM_CLIENT_THREAD policy: client of the current thread
+        self._fs_ensure_connected()
+        if self.__client_policy == FSM_CLIENT_THREAD and self.__fs_client is not None:
+            return self._fs_thread_client()
         return self.__fs_client
 
+    # Client of the current thread, created on first use by the thread
+    # The client of a thread is closed once the thread has ended, see _FSThreadClient, or by close_connection
+    def _fs_thread_client(self):
+        thread_client = getattr(self.__thread_clients, 'client', None)
+        fs_client = thread_client.client if thread_client is not None else None
+        if fs_client is None:
+            fs_client = self._fs_new_client(self.__app_config, shared=False)
+            if fs_client is None:
+                # Manager client used until a client can be created for the thread
+                return self.__fs_client
+            if self.__instrumentation is not None:
+                fs_instrument_client(fs_client)
+            self.__thread_clients.client = _FSThreadClient(fs_client)
+            self.__clients.add(fs_client)
+        return fs_client
+
     def init_app(self, app):
         # Creates a firestore client per application instance
         # Using credentials from service account file
         # Service Account role: access to Firestore for read/write
+        # Lazy mode (FSM_LAZY_INIT): only the app configuration is validated, the client is created and the app
+        # document bootstrapped on first use, or in a background thread if FSM_WARMUP is set
 
         if self.validate_app(app):
-            sa_creds_json_file = app.config['FSM_SA_KEY_JSON_FILE']
-            if sa_creds_json_file == "":
-                # Default Google Cloud application credentials
-                try:
-                    self.__fs_client = firestore.Client()
-                except Exception as e:
-                    logging.log(level=logging.ERROR,
-                                msg="Exception {}:{} Method: {}".format(e.__class__, e, self.init_app.__name__))
-                    pass
+            # Optional write mode, precondition writes by default
+            self.__write_mode = app.config.get('FSM_WRITE_MODE') or FSM_WRITE_PRECONDITION
+            # Optional document cache, enabled if a time to live is configured
+            if app.config.get('FSM_CACHE_TTL'):
+                self.__cache = DocumentCache(
+                    max_entries=app.config.get('FSM_CACHE_MAX_ENTRIES') or FSM_CACHE_MAX_ENTRIES,
+                    max_bytes=app.config.get('FSM_CACHE_MAX_BYTES') or FSM_CACHE_MAX_BYTES,
+                    ttl=app.config['FSM_CACHE_TTL'])
+            # Optional query result cache, enabled if a time to live is configured
+            if app.config.get('FSM_QUERY_CACHE_TTL'):
+                self.__query_cache = QueryCache(
+                    max_entries=app.config.get('FSM_QUERY_CACHE_MAX_ENTRIES') or FSM_QUERY_CACHE_MAX_ENTRIES,
+                    max_bytes=app.config.get('FSM_QUERY_CACHE_MAX_BYTES') or FSM_QUERY_CACHE_MAX_BYTES,
+                    ttl=app.config['FSM_QUERY_CACHE_TTL'])
+            # Optional operation metrics
+            if app.config.get('FSM_METRICS'):
+                self.__instrumentation = MetricsInstrumentation()
+            # Retries of transient errors, enabled unless FSM_RETRY is False
+            self.__retry_policy = self._fs_config_retry_policy(app.config)
+            # Write buffers of a previous initialization: their writes are flushed and their threads stopped, buffers
+            # are built again from the app config
+            # Buffered writes flushed first, as by close_connection
+            for buffer in (self.__buffered_writer, self.__write_coalescer):
+                if buffer is not None:
+                    buffer.close()
+            self.__write_coalescer = None
+            self.__buffered_writer = None
+            # Release the client of a previous initialization
+            self.close_connection()
+            # Optional write coalescing, enabled if a flush interval is configured
+            if app.config.get('FSM_COALESCE_INTERVAL'):
+                self.__write_coalescer = WriteCoalescer(self, interval=app.config['FSM_COALESCE_INTERVAL'])
+            # Optional write-behind buffer, enabled if a flush interval is configured
+            # Writes spilled by a previous process are buffered again once connected, see _fs_recover_spill
+            if app.config.get('FSM_BUFFER_INTERVAL'):
+                self.__buffered_writer = BufferedWriter(
+                    self, max_size=app.config.get('FSM_BUFFER_MAX_SIZE') or FSM_BUFFER_MAX_SIZE,
+                    interval=app.config['FSM_BUFFER_INTERVAL'], spill_path=app.config.get('FSM_BUFFER_SPILL_FILE'))
+                self.__recover_pending = True
+            # Settings needed to connect, copied from app config
+            self.__app_config = {k: app.config.get(k) for k in FSM_CONNECT_SETTINGS}
+            self.__bootstrapped = False
+            if app.config.get('FSM_LAZY_INIT'):
+                self.__connect_pending = True
+                if app.config.get('FSM_WARMUP'):
+                    self.warm_up(background=True)
             else:
-                # Credential from file
-                try:
-                    self.__fs_client = firestore.Client.from_service_account_json(sa_creds_json_file)
-                except Exception as e:
-                    logging.log(level=logging.ERROR,
-                                msg="Exception {}:{} Method: {}".format(e.__class__, e, self.init_app.__name__))
-                    pass
+                self._fs_connect()
+
+    # Creates the Firestore client and bootstraps the app document
+    def _fs_connect(self):
+        with self.__connect_lock:
+            config = self.__app_config
+            if self.__fs_client is None:
+                self.__client_policy = self._fs_client_policy(config)
+                self.__shared_client = self.__client_policy == FSM_CLIENT_SHARED
+                self.__fs_client = self._fs_new_client(config, shared=self.__shared_client)
+                if self.__fs_client is not None and self.__instrumentation is not None:
+                    fs_instrument_client(self.__fs_client)
 
             if self.__fs_client is not None:
                 # Dictionary with app details, versioning, owner, etc.
-                app_data = app.config['FSM_APP_INFO_DATA']
+                app_data = config['FSM_APP_INFO_DATA']
 
                 # Firestore operation
                 try:
-                    # Create a FS document reference to store app data
-                    app_doc = self.__fs_client.collection(app.config['FSM_APP_ROOT']).document(
-                        app.config['FSM_APP_OBJECTS_PATH']).get()
-                    if not app_doc.exists:
-                        # Create Firestore document in collection apps at FSM_APP_OBJECTS_PATH from app config class
-                        self.__fs_client.collection(app.config['FSM_APP_ROOT']).document(
-                            app.config['FSM_APP_OBJECTS_PATH']).set(app_data)
-                    self.__path_prefix = app.config['FSM_APP_ROOT'] + '/' + app.config['FSM_APP_OBJECTS_PATH']
+                    # App document bootstrapped once per client and process, and not again by forked child processes
+                    bootstrap_key = (config['FSM_APP_ROOT'], config['FSM_APP_OBJECTS_PATH'])
+                    with _fs_bootstrap_lock:
+                        bootstrapped = bootstrap_key in _fs_bootstrapped_apps.setdefault(self.__fs_client, set()) \
+                                       or self.__bootstrapped
+                    if not bootstrapped:
+                        # Create a FS document reference to store app data
+                        app_doc = self.__fs_client.collection(config['FSM_APP_ROOT']).document(
+                            config['FSM_APP_OBJECTS_PATH']).get(**self._fs_retry())
+                        if not app_doc.exists:
+                            # Create Firestore document in collection apps at FSM_APP_OBJECTS_PATH from app config
+                            self.__fs_client.collection(config['FSM_APP_ROOT']).document(
+                                config['FSM_APP_OBJECTS_PATH']).set(app_data, **self._fs_retry())
+                        with _fs_bootstrap_lock:
+                            _fs_bootstrapped_apps[self.__fs_client].add(bootstrap_key)
+                    self.__bootstrapped = True
+                    self.__path_prefix = config['FSM_APP_ROOT'] + '/' + config['FSM_APP_OBJECTS_PATH']
+                    self.__connect_pending = False
                 except Exception as e:
-                    logging.log(level=logging.ERROR,
-                                msg="Exception {}:{} Method: {}".format(e.__class__, e, self.init_app.__name__))
+                    self._fs_log_error(e, self._fs_connect)
                     pass
+                if not self.__connect_pending:
+                    self._fs_recover_spill()
+
+    # Buffers again the writes spilled by a previous process, once connected: spilled document references are decoded
+    # with the client
+    def _fs_recover_spill(self):
+        if self.__recover_pending:
+            self.__recover_pending = False
+            if self.__buffered_writer is not None:
+                try:
+                    self.__buffered_writer.recover()
+                except Exception as e:
+                    self._fs_log_error(e, self._fs_recover_spill)
+
+    # Client policy from app config, shared clients unless FSM_SHARED_CLIENT is False (FSM_CLIENT_MANAGER)
+    @staticmethod
+    def _fs_client_policy(config):
+        policy = config.get('FSM_CLIENT_POLICY')
+        if policy in FSM_CLIENT_POLICIES:
+            return policy
+        return FSM_CLIENT_MANAGER if config.get('FSM_SHARED_CLIENT') is False else FSM_CLIENT_SHARED
+
+    # Firestore client for the app settings, None on error
+    # shared: client shared with other managers using the same credentials and project, from the client pool
+    def _fs_new_client(self, config, shared=True):
+        fs_client = None
+        sa_creds_json_file = config['FSM_SA_KEY_JSON_FILE']
+        # Optional Google Cloud project, by default project from credentials
+        project = config.get('FSM_PROJECT')
+        # Optional backend, Firestore by default
+        client_class = MemoryClient if config.get('FSM_BACKEND') == FSM_BACKEND_MEMORY else firestore.Client
+        if shared:
+            try:
+                fs_client = fs_client_pool.acquire(sa_creds_json_file, project, client_class)
+            except Exception as e:
+                self._fs_log_error(e, self._fs_new_client)
+                pass
+        elif sa_creds_json_file == "":
+            # Default Google Cloud application credentials
+            try:
+                fs_client = client_class(project=project)
+            except Exception as e:
+                self._fs_log_error(e, self._fs_new_client)
+                pass
+        else:
+            # Credential from file
+            try:
+                kwargs = {'project': project} if project is not None else {}
+                fs_client = client_class.from_service_account_json(sa_creds_json_file, **kwargs)
+            except Exception as e:
+                self._fs_log_error(e, self._fs_new_client)
+                pass
+        return fs_client
+
+    # Lazy mode: connects on first use, connection attempts are repeated on use until one succeeds
+    # Forks not notified to Python are detected here, see gfs_manager.fork
+    def _fs_ensure_connected(self):
+        self.__pid = fs_fork_check(self, self.__pid)
+        if self.__connect_pending:
+            with self.__connect_lock:
+                if self.__connect_pending:
+                    self._fs_connect()
+
+    # Lazy mode: connects and bootstraps the app document ahead of first use
+    # In a background thread if background, the thread is returned
+    def warm_up(self, background=True):
+        if background:
+            thread = threading.Thread(target=self._fs_ensure_connected, name='gfs-manager-warm-up', daemon=True)
+            thread.start()
+            return thread
+        self._fs_ensure_connected()
+
+    # Forked child process: the clients of the parent process are abandoned, not closed, and created again on first
+    # use, the app document is not bootstrapped again
+    # Buffered writes belong to the parent process, collection watches are not running in the child process
+    def _fs_after_fork(self):
+        self.__pid = os.getpid()
+        self.__connect_lock = threading.RLock()
+        self.__connect_pending = self.__fs_client is not None or self.__connect_pending
+        self.__fs_client = None
+        self.__thread_clients = threading.local()
+        self.__clients = weakref.WeakSet()
+        self.__watches = weakref.WeakSet()
+        for buffer in (self.__write_coalescer, self.__buffered_writer):
+            after_fork = getattr(buffer, '_fs_after_fork', None)
+            if after_fork is not None:
+                after_fork()
 
     def initialized(self) -> bool:
         return self.client is not None \
                and isinstance(self.client, firestore.Client) \
-               and self.__path_prefix is not None
+               and self.path_prefix is not None
 
+    # Closes the Firestore client, shared clients are only closed when released by their last manager
     def close_connection(self):
-        if self.initialized():
-            self.client.close()
+        # Buffered writes flushed first, connecting if needed
+        if self.__buffered_writer is not None:
+            self.__buffered_writer.close()
+        self.__connect_pending = False
+        for watch in list(self.__watches):
+            watch.stop()
+        if self.__fs_client is not None:
+            if self.__write_coalescer is not None:
+                self.__write_coalescer.close()
+            if self.__shared_client:
+                fs_client_pool.release(self.__fs_client)
+            else:
+                self.__fs_client.close()
+            self.__fs_client = None
+            for fs_client in list(self.__clients):
+                fs_client.close()
+            self.__clients = weakref.WeakSet()
+            self.__thread_clients = threading.local()
+
+    # Retry policy from app config
+    @staticmethod
+    def _fs_config_retry_policy(config):
+        if config.get('FSM_RETRY') is False:
+            return None
+        budget = config.get('FSM_RETRY_BUDGET')
+        return RetryPolicy(deadline=config.get('FSM_RETRY_DEADLINE') or FSM_RETRY_DEADLINE,
+                           timeout=config.get('FSM_RETRY_TIMEOUT'),
+                           budget=RetryBudget(ratio=budget if budget is not None else FSM_RETRY_BUDGET,
+                                              reserve=config.get('FSM_RETRY_BUDGET_RESERVE') or
+                                              FSM_RETRY_BUDGET_RESERVE))
+
+    # Retry and timeout arguments of a Firestore call, calls that are not idempotent are not retried
+    def _fs_retry(self, idempotent=True) -> dict:
+        return fs_retry_kwargs(self.__retry_policy, idempotent)
+
+    # Logs an exception raised in method, and records it in the current operation if instrumented
+    def _fs_log_error(self, e, method):
+        logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}".format(e.__class__, e, method.__name__))
+        fs_record_error(e)
+
+    # Firestore write batch supporting preconditions on set()
+    def _fs_batch(self):
+        return GFSWriteBatch(self.client)
+
+    # Write mode for a single call: write_mode argument if provided, otherwise the manager write mode
+    def _fs_write_mode(self, write_mode=None):
+        return write_mode if write_mode in FSM_WRITE_MODES else self.__write_mode
+
+    # Write option asserting the document exists, or was last updated at fs_last_update_time if provided
+    def _fs_write_option(self, fs_last_update_time=None):
+        if fs_last_update_time is not None:
+            return self.client.write_option(last_update_time=fs_last_update_time)
+        return self.client.write_option(exists=True)
+
+    # Firestore collection path for lookup methods
+    # If lookup_collection provided, lookup_collection takes precedence over app_object class name
+    # Collection is under parent_doc_path if present, otherwise under the current app path prefix
+    def _fs_collection_path(self, app_object=None, parent_doc_path=None, lookup_collection=None):
+        col_path = None
+        if lookup_collection is None:
+            if app_object is not None:
+                lookup_collection = app_object.__class__.__name__
+        if lookup_collection is not None:
+            if parent_doc_path is not None:
+                col_path = parent_doc_path + '/' + lookup_collection
+            else:
+                col_path = self.path_prefix + '/' + lookup_collection
+        return col_path
+
+    # Removes cached documents modified by the manager, and the cached queries of their collections
+    # fs_doc_path: a single document, fs_collection_path: every document in a collection
+    def _fs_cache_invalidate(self, fs_doc_path=None, fs_collection_path=None):
+        if self.__cache is not None:
+            if fs_doc_path is not None:
+                self.__cache.invalidate(fs_doc_path)
+            if fs_collection_path is not None:
+                self.__cache.invalidate_prefix(fs_collection_path + '/')
+        if self.__query_cache is not None:
+            if fs_doc_path is not None:
+                self.__query_cache.invalidate(fs_doc_path.rpartition('/')[0])
+            if fs_collection_path is not None:
+                # Collection and subcollections of its documents
+                self.__query_cache.invalidate(fs_collection_path)
+                self.__query_cache.invalidate_prefix(fs_collection_path + '/')
+
+    # Removes the cached queries of a collection where documents were created
+    def _fs_query_cache_invalidate(self, col_path):
+        if self.__query_cache is not None:
+            self.__query_cache.invalidate(col_path)
+
+    # Returns the list of document snapshots of query, served from the query cache if enabled and use_cache
+    # key: normalized query, see QueryCache.key
+    def _fs_cached_query(self, query, key, use_cache=True) -> list:
+        cache = self.__query_cache if use_cache else None
+        if cache is None:
+            return list(query.stream(**self._fs_retry()))
+        results = cache.get(key)
+        if results is None:
+            token = cache.begin(key)
+            try:
+                results = list(query.stream(**self._fs_retry()))
+            finally:
+                cache.put(key, results, token)
+        return results
+
+    # Writes the document fs_doc_ref of an indexed collection and its index lookup documents atomically, in a
+    # transaction reading the indexed values of the document before the write, see gfs_manager.indexes
+    # operation: FSM_INDEX_SET, FSM_INDEX_MERGE, FSM_INDEX_UPDATE or FSM_INDEX_DELETE
+    # Raises NotFound and FailedPrecondition as the write options of unindexed writes, and AlreadyExists if a value of
+    # a unique index is indexed for another document
+    # Returns the write result of the document
+    def _fs_indexed_write(self, fs_doc_ref, indexes, operation, properties=None, increments=None, exists=False,
+                          fs_last_update_time=None):
+        client = self.client
+
+        def indexed_write(transaction):
+            fs_doc = fs_doc_ref.get(transaction=transaction, **self._fs_retry())
+            fs_index_check(fs_doc, exists, fs_last_update_time)
+            fs_index_write(transaction, client, fs_doc_ref, indexes, operation, fs_doc.to_dict(), properties,
+                           increments)
+
+        transactional = FSTransactional(indexed_write)
+        try:
+            transactional(client.transaction())
+        finally:
+            self.__contention_stats.record(fs_doc_ref.path, transactional.attempts, transactional.aborted)
+        return transactional.write_results[0]
+
+    # Returns the set of paths of the existing documents amongst fs_doc_refs, with a single read
+    def _fs_existing_paths(self, fs_doc_refs) -> set:
+        if not fs_doc_refs:
+            return set()
+        return set(fs_doc.reference.path for fs_doc in self.client.get_all(fs_doc_refs, **self._fs_retry())
+                   if fs_doc.exists)
 
     def validate_properties(self, doc_properties):
         validation = False
@@ -82,6 +590,7 @@ class GFSManager:
     # If no fs_collection_path provided, FS Document is created under a FS Collection called as the app_object class
     # Under the current GFSManager Firestore realm (self.path_prefix)
 
+    @fs_instrumented
     def fs_doc_store(self, app_object, doc_properties, fs_collection_path=None, *args, **kwargs):
         fs_id = None
         fs_stored_time = None
@@ -98,68 +607,511 @@ class GFSManager:
             # Creates a Firestore Document at parent collection fs_collection_path
             # If collection path does not exist, Firestore creates it automatically
             try:
-                fs_stored_time, fs_stored_object = self.client.collection(fs_collection_path).add(
-                    document_data=doc_properties)
-                # TODO: Validate stored object returned (class and contains id and path property)
+                # Document id generated client side, as CollectionReference.add() does
+                # Writing a new document id is idempotent: a retried store does not fail on the document written by
+                # a previous attempt
+                fs_stored_object = self.client.collection(fs_collection_path).document()
+                indexes = fs_collection_indexes(fs_collection_path)
+                if indexes:
+                    # New document and its index lookup documents in the same batched write
+                    batch = self._fs_batch()
+                    batch.set(fs_stored_object, doc_properties)
+                    for index in indexes.values():
+                        index.writes(batch, self.client, fs_stored_object.path, None, doc_properties)
+                    # Not idempotent with unique indexes: a retried write would fail on the lookup documents
+                    fs_stored_time = batch.commit(**self._fs_retry(
+                        not any(index.unique for index in indexes.values())))[0].update_time
+                else:
+                    fs_stored_time = fs_stored_object.set(doc_properties, **self._fs_retry()).update_time
                 fs_id = fs_stored_object.id
                 fs_path = fs_stored_object.path
                 result = True
             except Exception as e:
-                logging.log(level=logging.ERROR,
-                            msg="Exception {}:{} Method: {}".format(e.__class__, e, self.init_app.__name__))
+                self._fs_log_error(e, self.fs_doc_store)
                 result = False
+            self._fs_query_cache_invalidate(fs_collection_path)
         return fs_stored_time, fs_id, fs_path, result
 
     # Given an existing id, replaces current object properties with doc_properties
-    def fs_doc_update(self, fs_id, doc_properties, fs_collection_path=None, *args, **kwargs):
+    # If fs_last_update_time is provided, the document is only replaced if it was last updated at that time
+    # write_mode overrides the manager write mode (FSM_WRITE_PRECONDITION, FSM_WRITE_STRICT) for this call
+    @fs_instrumented
+    def fs_doc_update(self, fs_id, doc_properties, fs_collection_path=None, fs_last_update_time=None,
+                      write_mode=None, *args, **kwargs):
         fs_stored_time = None
         fs_path = None
         result = False
         if self.validate_properties(doc_properties=doc_properties):
             try:
                 fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
-                if fs_doc_ref.get().exists:
-                    fs_write_result = fs_doc_ref.set(document_data=doc_properties)
-                    result = isinstance(fs_write_result, firestore.types.write.WriteResult)
-                    if result:
-                        # Read actual values from Firestore
-                        fs_stored_time = fs_write_result.update_time
-                        fs_path = fs_doc_ref.path
-                        # Updated existing FS document
+                indexes = fs_collection_indexes(fs_collection_path)
+                if indexes:
+                    # Existence and last update time checked by the transaction, in both write modes
+                    fs_stored_time = self._fs_indexed_write(fs_doc_ref, indexes, FSM_INDEX_SET, doc_properties,
+                                                            exists=True,
+                                                            fs_last_update_time=fs_last_update_time).update_time
+                    fs_path = fs_doc_ref.path
+                    result = True
+                else:
+                    if self._fs_write_mode(write_mode) == FSM_WRITE_STRICT:
+                        # Read before writing
+                        if fs_doc_ref.get(**self._fs_retry()).exists:
+                            option = self._fs_write_option(fs_last_update_time) \
+                                if fs_last_update_time is not None else None
+                        else:
+                            fs_doc_ref = None
+                    else:
+                        # Firestore checks the document exists when committing the write
+                        option = self._fs_write_option(fs_last_update_time)
+                    if fs_doc_ref is not None:
+                        batch = self._fs_batch()
+                        batch.set(fs_doc_ref, doc_properties, option=option)
+                        # Replacing a document is idempotent, unless its last update time is asserted
+                        fs_write_result = batch.commit(**self._fs_retry(fs_last_update_time is None))[0]
+                        result = isinstance(fs_write_result, firestore.types.write.WriteResult)
+                        if result:
+                            # Read actual values from Firestore
+                            fs_stored_time = fs_write_result.update_time
+                            fs_path = fs_doc_ref.path
+                            # Updated existing FS document
+            except (NotFound, FailedPrecondition):
+                # Non existent document or precondition not met
+                result = False
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_update)
+                result = False
+            if fs_collection_path is not None:
+                self._fs_cache_invalidate(fs_doc_path=fs_collection_path + '/' + fs_id)
+        return fs_stored_time, fs_id, fs_path, result
+
+    # Write-behind store: same as fs_doc_store, the document is written in the background by the buffered writer
+    # The document id is generated client side, fs_stored_time is None and result is True once the write is buffered
+    # Without a buffered writer the document is stored immediately
+    # Returns (fs_stored_time, fs_id, fs_path, result)
+    @fs_instrumented
+    def fs_doc_store_buffered(self, app_object, doc_properties, fs_collection_path=None, *args, **kwargs):
+        if self.__buffered_writer is None:
+            return self.fs_doc_store(app_object, doc_properties, fs_collection_path)
+        # Lazy mode: connected first, spilled writes are recovered before the new writes
+        self._fs_ensure_connected()
+        fs_path = None
+        if fs_collection_path is None:
+            fs_collection_path = self.path_prefix + '/' + app_object.__class__.__name__
+        if self.validate_properties(doc_properties=doc_properties):
+            try:
+                fs_path = self.__buffered_writer.store(fs_collection_path, doc_properties)
+            except Exception as e:
+                # Values not spillable
+                self._fs_log_error(e, self.fs_doc_store_buffered)
+        return None, fs_path.rpartition('/')[2] if fs_path is not None else None, fs_path, fs_path is not None
+
+    # Write-behind merge: same as fs_doc_merge without increments, written in the background by the buffered writer
+    # Without a buffered writer the properties are merged immediately
+    # Returns (fs_stored_time, fs_id, fs_path, result)
+    @fs_instrumented
+    def fs_doc_merge_buffered(self, fs_id, doc_properties, fs_collection_path=None, *args, **kwargs):
+        if self.__buffered_writer is None:
+            return self.fs_doc_merge(fs_id, doc_properties, fs_collection_path)
+        self._fs_ensure_connected()
+        result = False
+        fs_doc_path = fs_collection_path + '/' + fs_id
+        if self.validate_properties(doc_properties=doc_properties):
+            try:
+                result = self.__buffered_writer.merge(fs_doc_path, doc_properties)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_merge_buffered)
+        return None, fs_id, fs_doc_path if result else None, result
+
+    # Merges doc_properties into the document fs_id, created if it does not exist (set with merge)
+    # increments: dictionary of {property: amount} added to numeric properties with Firestore Increment transforms,
+    # without reading the document
+    # With a write coalescer the write is buffered and merged with the other writes of the document until the next
+    # flush, fs_stored_time is then None, writes of indexed collections are not buffered
+    # Returns (fs_stored_time, fs_id, fs_path, result)
+    @fs_instrumented
+    def fs_doc_merge(self, fs_id, doc_properties=None, fs_collection_path=None, increments=None, *args, **kwargs):
+        fs_stored_time = None
+        fs_path = None
+        result = False
+        if doc_properties is None or self.validate_properties(doc_properties=doc_properties):
+            try:
+                fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
+                indexes = fs_collection_indexes(fs_collection_path)
+                if indexes:
+                    # Not coalesced: index lookup documents written with the document
+                    fs_stored_time = self._fs_indexed_write(fs_doc_ref, indexes, FSM_INDEX_MERGE, doc_properties,
+                                                            increments).update_time
+                    self._fs_cache_invalidate(fs_doc_path=fs_doc_ref.path)
+                elif self.__write_coalescer is not None:
+                    self.__write_coalescer.update(fs_doc_ref.path, doc_properties, increments)
+                else:
+                    data = dict(doc_properties or {})
+                    for name, amount in (increments or {}).items():
+                        data[name] = firestore.Increment(amount)
+                    # Increments are not idempotent
+                    fs_stored_time = fs_doc_ref.set(data, merge=True, **self._fs_retry(not increments)).update_time
+                    self._fs_cache_invalidate(fs_doc_path=fs_doc_ref.path)
+                fs_path = fs_doc_ref.path
+                result = True
             except Exception as e:
-                logging.log(level=logging.ERROR,
-                            msg="Exception {}:{} Method: {}".format(e.__class__, e, self.init_app.__name__))
+                self._fs_log_error(e, self.fs_doc_merge)
                 result = False
         return fs_stored_time, fs_id, fs_path, result
 
-    def fs_doc_properties(self, fs_id, fs_collection_path=None, *args, **kwargs) -> dict:
+    # Runs fn(transaction, *args) in a Firestore transaction: documents read with transaction.get() and the writes of
+    # transaction.set(), update() and delete() are committed atomically
+    # Transactions aborted by concurrent writes to the documents read are run again, up to max_attempts
+    # name: key of the transaction in the contention statistics, fn name by default
+    # Returns (value, result): value returned by fn in the committed attempt, result True if committed
+    @fs_instrumented
+    def fs_transaction(self, fn, *args, max_attempts=FSM_TRANSACTION_MAX_ATTEMPTS, name=None):
+        value = None
+        result = False
+        transactional = FSTransactional(fn)
+        # Firestore Operation
+        try:
+            value = transactional(self.client.transaction(max_attempts=max_attempts), *args)
+            result = True
+        except Exception as e:
+            self._fs_log_error(e, self.fs_transaction)
+            value = None
+        self.__contention_stats.record(name or fn.__name__, transactional.attempts, transactional.aborted)
+        # Also invalidated if the commit failed, it may have been applied
+        for fs_doc_path in transactional.write_paths:
+            self._fs_cache_invalidate(fs_doc_path=fs_doc_path)
+        return value, result
+
+    # Read-modify-write of the document fs_id in a transaction, concurrent writes are not lost
+    # transform: function called with the document properties, None if the document does not exist, returning the
+    #   new document properties, or None to leave the document unchanged
+    #   transform is called again when the transaction is run again, it must not have side effects
+    # field_transforms: dictionary of {property: transform} applied by Firestore to the document, without reading it
+    #   {'views': firestore.Increment(1), 'tags': firestore.ArrayUnion(['new']), 'seen': firestore.SERVER_TIMESTAMP}
+    #   Without transform, field transforms are written with a single update() of an existing document, with no read
+    #   nor transaction
+    # Returns (fs_updated_time, fs_id, fs_path, result), result is True if the document exists after the write
+    # fs_updated_time is None if nothing was written
+    @fs_instrumented
+    def fs_doc_transform(self, fs_id, transform=None, fs_collection_path=None, field_transforms=None,
+                         max_attempts=FSM_TRANSACTION_MAX_ATTEMPTS, *args, **kwargs):
+        fs_updated_time = None
+        fs_path = None
+        result = False
+        # Invalid collection paths or ids fail as the other writes do
+        try:
+            fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
+        except Exception as e:
+            self._fs_log_error(e, self.fs_doc_transform)
+            return fs_updated_time, fs_id, fs_path, result
+        if transform is None:
+            if field_transforms:
+                # Firestore Operation
+                try:
+                    # Transforms are not idempotent
+                    fs_updated_time = fs_doc_ref.update(field_transforms, **self._fs_retry(False)).update_time
+                    fs_path = fs_doc_ref.path
+                    result = True
+                except NotFound:
+                    result = False
+                except Exception as e:
+                    self._fs_log_error(e, self.fs_doc_transform)
+                    result = False
+        else:
+            def read_modify_write(transaction):
+                fs_doc = fs_doc_ref.get(transaction=transaction, **self._fs_retry())
+                properties = transform(fs_doc.to_dict() if fs_doc.exists else None)
+                if properties is not None:
+                    transaction.set(fs_doc_ref, properties)
+                    # Field transforms applied to the new properties
+                    if field_transforms:
+                        transaction.update(fs_doc_ref, field_transforms)
+                    return True
+                if field_transforms and fs_doc.exists:
+                    transaction.update(fs_doc_ref, field_transforms)
+                return fs_doc.exists
+
+            transactional = FSTransactional(read_modify_write)
+            # Firestore Operation
+            try:
+                result = transactional(self.client.transaction(max_attempts=max_attempts))
+                if transactional.write_results:
+                    fs_updated_time = transactional.write_results[-1].update_time
+                fs_path = fs_doc_ref.path if result else None
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_transform)
+                result = False
+            self.__contention_stats.record(fs_doc_ref.path, transactional.attempts, transactional.aborted)
+        self._fs_cache_invalidate(fs_doc_path=fs_doc_ref.path)
+        return fs_updated_time, fs_id, fs_path, result
+
+    # Returns the properties of an existing document, None if the document does not exist
+    # Served from the document cache if enabled and use_cache
+    @fs_instrumented
+    def fs_doc_properties(self, fs_id, fs_collection_path=None, use_cache=True, *args, **kwargs) -> dict:
         fs_doc_properties = None
         fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
         if isinstance(fs_doc_ref, firestore.DocumentReference):
-            if fs_doc_ref.get().exists:
-                fs_doc_snapshot = fs_doc_ref.get()
-        fs_doc_properties = fs_doc_snapshot.to_dict()
+            fs_doc_snapshot = self._fs_cached_get(fs_doc_ref, use_cache)
+            if fs_doc_snapshot is not None:
+                fs_doc_properties = fs_doc_snapshot.to_dict()
         return fs_doc_properties
 
+    # Reads a document through the document cache
+    # Returns the document snapshot, None if the document does not exist
+    def _fs_cached_get(self, fs_doc_ref, use_cache=True):
+        cache = self.__cache if use_cache else None
+        if cache is not None:
+            fs_doc = cache.get(fs_doc_ref.path)
+            if fs_doc is not None:
+                return fs_doc
+        fs_doc = fs_doc_ref.get(**self._fs_retry())
+        if not fs_doc.exists:
+            return None
+        if cache is not None:
+            cache.put(fs_doc_ref.path, fs_doc)
+        return fs_doc
+
+    @fs_instrumented
     def fs_doc_exist(self, fs_doc_path) -> bool:
         doc_ref = self.client.document(fs_doc_path)
-        return doc_ref.get().exists
+        return doc_ref.get(**self._fs_retry()).exists
 
-    def fs_doc_delete(self, fs_id, fs_path):
+    # Deletes an existing Firestore Document
+    # If fs_last_update_time is provided, the document is only deleted if it was last updated at that time
+    # write_mode overrides the manager write mode (FSM_WRITE_PRECONDITION, FSM_WRITE_STRICT) for this call
+    @fs_instrumented
+    def fs_doc_delete(self, fs_id, fs_path, fs_last_update_time=None, write_mode=None):
         result = False
         fs_deleted_time = None
         if fs_id is not None:
             doc = self.client.document(fs_path)
             if isinstance(doc, firestore.DocumentReference):
                 if doc.id == fs_id:
-                    if doc.get().exists:
-                        # The Firestore Document delete() operations returns a DatetimeWithNanoseconds in python
-                        fs_deleted_time = doc.delete()
-                        result = not doc.get().exists
+                    try:
+                        indexes = fs_collection_indexes(doc.path.rpartition('/')[0])
+                        if indexes:
+                            # Index lookup documents deleted with the document, the delete time is not returned
+                            self._fs_indexed_write(doc, indexes, FSM_INDEX_DELETE, exists=True,
+                                                   fs_last_update_time=fs_last_update_time)
+                            result = True
+                        elif self._fs_write_mode(write_mode) == FSM_WRITE_STRICT:
+                            if doc.get(**self._fs_retry()).exists:
+                                option = self._fs_write_option(fs_last_update_time) \
+                                    if fs_last_update_time is not None else None
+                                # The Firestore Document delete() operations returns a DatetimeWithNanoseconds
+                                fs_deleted_time = doc.delete(option=option, **self._fs_retry(option is None))
+                                result = not doc.get(**self._fs_retry()).exists
+                        else:
+                            # Firestore checks the document exists when committing the delete
+                            # Not idempotent: a retried delete would fail on the document deleted by the first attempt
+                            fs_deleted_time = doc.delete(option=self._fs_write_option(fs_last_update_time),
+                                                         **self._fs_retry(False))
+                            result = True
+                    except (NotFound, FailedPrecondition):
+                        # Non existent document or precondition not met
+                        fs_deleted_time = None
+                        result = False
+                    self._fs_cache_invalidate(fs_doc_path=doc.path)
         return fs_deleted_time, fs_id, fs_path, result
 
-    def fs_query_by_id(self, lookup_id, app_object=None, parent_doc_path=None, lookup_collection=None) \
-            -> DocumentSnapshot:
+    # Splits items in chunks of at most batch_size elements, and processes every chunk with chunk_worker
+    # Chunks are processed concurrently, up to max_workers at a time
+    # Returns the concatenation of every chunk_worker result, in the same order as items
+    @staticmethod
+    def _fs_run_chunks(items, chunk_worker, batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS) -> list:
+        batch_size = max(1, min(batch_size, FS_MAX_BATCH_SIZE))
+        chunks = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+        # Worker threads run in the current instrumented operation
+        chunk_worker = fs_bind_operation(chunk_worker)
+        results = []
+        if len(chunks) <= 1 or max_workers <= 1:
+            for chunk in chunks:
+                results.extend(chunk_worker(chunk))
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+                # executor.map yields chunk results in submission order
+                for chunk_results in executor.map(chunk_worker, chunks):
+                    results.extend(chunk_results)
+        return results
+
+    # Creates one new Firestore Document per element of docs_properties, using batched writes
+    # Same collection path rules as fs_doc_store
+    # Returns a list of (fs_stored_time, fs_id, fs_path, result) in the same order as docs_properties
+    @fs_instrumented
+    def fs_docs_store_many(self, app_object, docs_properties, fs_collection_path=None,
+                           batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS, *args, **kwargs) -> list:
+        if fs_collection_path is None:
+            fs_collection_name = app_object.__class__.__name__
+            fs_collection_path = self.path_prefix + '/' + fs_collection_name
+        indexes = fs_collection_indexes(fs_collection_path)
+        # Index lookup documents written in the same batched writes, one write per index and document
+        batch_size = min(batch_size, FS_MAX_BATCH_SIZE // (1 + len(indexes)))
+
+        def store_chunk(chunk):
+            chunk_results = [(None, None, None, False)] * len(chunk)
+            writes = []
+            try:
+                batch = self._fs_batch()
+                col_ref = self.client.collection(fs_collection_path)
+                for i, doc_properties in enumerate(chunk):
+                    if self.validate_properties(doc_properties=doc_properties):
+                        # Document id generated client side, as CollectionReference.add() does, see fs_doc_store
+                        fs_doc_ref = col_ref.document()
+                        batch.set(fs_doc_ref, doc_properties)
+                        for index in indexes.values():
+                            index.writes(batch, self.client, fs_doc_ref.path, None, doc_properties)
+                        writes.append((i, fs_doc_ref))
+                if writes:
+                    # Not idempotent with unique indexes, a value indexed for another document fails the chunk
+                    fs_write_results = batch.commit(**self._fs_retry(
+                        not any(index.unique for index in indexes.values())))
+                    for (i, fs_doc_ref), fs_write_result in zip(writes, fs_write_results):
+                        chunk_results[i] = (fs_write_result.update_time, fs_doc_ref.id, fs_doc_ref.path, True)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_docs_store_many)
+                # Batched writes are atomic: no document in the chunk was stored
+                chunk_results = [(None, None, None, False)] * len(chunk)
+            self._fs_query_cache_invalidate(fs_collection_path)
+            return chunk_results
+
+        return self._fs_run_chunks(list(docs_properties), store_chunk, batch_size, max_workers)
+
+    # Commits a batched write of write_op (set or delete) for every (i, fs_doc_ref, data) in writes
+    # Precondition mode: documents existence is asserted by Firestore. If the chunk fails because a document does not
+    # exist, the non existent documents are found with a single read and the rest of the chunk is committed again
+    # Strict mode: documents existence is read before writing
+    # Returns the list of writes committed and the list of their write results
+    def _fs_commit_existing(self, writes, write_op, write_mode=None):
+        strict = self._fs_write_mode(write_mode) == FSM_WRITE_STRICT
+        if strict:
+            existing = self._fs_existing_paths([fs_doc_ref for i, fs_doc_ref, data in writes])
+            writes = [w for w in writes if w[1].path in existing]
+        for attempt in range(0, 2):
+            if not writes:
+                return writes, []
+            batch = self._fs_batch()
+            option = None if strict else self.client.write_option(exists=True)
+            for i, fs_doc_ref, data in writes:
+                if write_op == 'set':
+                    batch.set(fs_doc_ref, data, option=option)
+                else:
+                    batch.delete(fs_doc_ref, option=option)
+            try:
+                # Deletes asserting the documents exist are not idempotent
+                fs_write_results = batch.commit(**self._fs_retry(write_op == 'set' or strict))
+                if write_op == 'delete':
+                    # Delete operations report the batch commit time
+                    fs_write_results = [batch.commit_time] * len(writes)
+                else:
+                    fs_write_results = [fs_write_result.update_time for fs_write_result in fs_write_results]
+                return writes, fs_write_results
+            except (NotFound, FailedPrecondition):
+                if strict or attempt > 0:
+                    raise
+                existing = self._fs_existing_paths([fs_doc_ref for i, fs_doc_ref, data in writes])
+                writes = [w for w in writes if w[1].path in existing]
+        return [], []
+
+    # Given a dictionary of {fs_id: doc_properties}, replaces every existing object properties, using batched writes
+    # Non existent documents are not created
+    # Returns a list of (fs_stored_time, fs_id, fs_path, result) in the same order as docs_properties
+    @fs_instrumented
+    def fs_docs_update_many(self, docs_properties, fs_collection_path=None,
+                            batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS, write_mode=None,
+                            *args, **kwargs) -> list:
+        def update_chunk(chunk):
+            chunk_results = [(None, fs_id, None, False) for fs_id, doc_properties in chunk]
+            try:
+                col_ref = self.client.collection(fs_collection_path)
+                writes = [(i, col_ref.document(document_id=fs_id), doc_properties)
+                          for i, (fs_id, doc_properties) in enumerate(chunk)
+                          if self.validate_properties(doc_properties=doc_properties)]
+                writes, fs_write_times = self._fs_commit_existing(writes, 'set', write_mode)
+                for (i, fs_doc_ref, data), fs_write_time in zip(writes, fs_write_times):
+                    chunk_results[i] = (fs_write_time, fs_doc_ref.id, fs_doc_ref.path, True)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_docs_update_many)
+                chunk_results = [(None, fs_id, None, False) for fs_id, doc_properties in chunk]
+            if fs_collection_path is not None:
+                for fs_id, doc_properties in chunk:
+                    self._fs_cache_invalidate(fs_doc_path=fs_collection_path + '/' + fs_id)
+            return chunk_results
+
+        return self._fs_run_chunks(list(docs_properties.items()), update_chunk, batch_size, max_workers)
+
+    # Given a list of (fs_id, fs_path) pairs, deletes every existing Firestore Document, using batched writes
+    # Returns a list of (fs_deleted_time, fs_id, fs_path, result) in the same order as fs_docs
+    @fs_instrumented
+    def fs_docs_delete_many(self, fs_docs, batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS,
+                            write_mode=None, *args, **kwargs) -> list:
+        fs_docs = list(fs_docs)
+        # Index lookup documents deleted in the same batched writes, one write per index and document
+        max_indexes = max([len(fs_collection_indexes(fs_path.rpartition('/')[0]))
+                           for fs_id, fs_path in fs_docs if fs_path is not None] + [0])
+        batch_size = min(batch_size, FS_MAX_BATCH_SIZE // (1 + max_indexes))
+
+        def delete_chunk(chunk):
+            chunk_results = [(None, fs_id, fs_path, False) for fs_id, fs_path in chunk]
+            try:
+                writes = []
+                indexed_writes = []
+                for i, (fs_id, fs_path) in enumerate(chunk):
+                    if fs_id is not None:
+                        doc = self.client.document(fs_path)
+                        if doc.id == fs_id:
+                            if fs_collection_indexes(doc.path.rpartition('/')[0]):
+                                indexed_writes.append((i, doc, None))
+                            else:
+                                writes.append((i, doc, None))
+                writes, fs_deleted_times = self._fs_commit_existing(writes, 'delete', write_mode)
+                for (i, doc, data), fs_deleted_time in zip(writes, fs_deleted_times):
+                    fs_id, fs_path = chunk[i]
+                    chunk_results[i] = (fs_deleted_time, fs_id, fs_path, True)
+                if indexed_writes:
+                    deleted_paths, fs_deleted_time = self._fs_delete_indexed([doc for i, doc, data in indexed_writes])
+                    for i, doc, data in indexed_writes:
+                        if doc.path in deleted_paths:
+                            fs_id, fs_path = chunk[i]
+                            chunk_results[i] = (fs_deleted_time, fs_id, fs_path, True)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_docs_delete_many)
+                chunk_results = [(None, fs_id, fs_path, False) for fs_id, fs_path in chunk]
+            for fs_id, fs_path in chunk:
+                if fs_path is not None:
+                    self._fs_cache_invalidate(fs_doc_path=fs_path)
+            return chunk_results
+
+        return self._fs_run_chunks(fs_docs, delete_chunk, batch_size, max_workers)
+
+    # Deletes the existing documents amongst fs_doc_refs and their index lookup documents with one batched write
+    # The documents are read first, their deletes assert they were not updated since, the batch is read and committed
+    # again once if a document was updated concurrently
+    # Returns the set of paths of the documents deleted and the commit time
+    def _fs_delete_indexed(self, fs_doc_refs):
+        client = self.client
+        for attempt in range(0, 2):
+            fs_docs = [fs_doc for fs_doc in client.get_all(fs_doc_refs, **self._fs_retry()) if fs_doc.exists]
+            if not fs_docs:
+                break
+            batch = self._fs_batch()
+            for fs_doc in fs_docs:
+                fs_doc_path = fs_doc.reference.path
+                batch.delete(fs_doc.reference, option=client.write_option(last_update_time=fs_doc.update_time))
+                for index in fs_collection_indexes(fs_doc_path.rpartition('/')[0]).values():
+                    index.writes(batch, client, fs_doc_path, fs_doc.to_dict(), None)
+            try:
+                # Deletes with preconditions are not idempotent
+                batch.commit(**self._fs_retry(False))
+                return set(fs_doc.reference.path for fs_doc in fs_docs), batch.commit_time
+            except FailedPrecondition:
+                if attempt > 0:
+                    raise
+        return set(), None
+
+    # Served from the document cache if enabled and use_cache
+    @fs_instrumented
+    def fs_query_by_id(self, lookup_id, app_object=None, parent_doc_path=None, lookup_collection=None,
+                       use_cache=True) -> DocumentSnapshot:
         result = None
         if lookup_collection is None:
             if app_object is not None:
@@ -172,27 +1124,98 @@ class GFSManager:
                 col_path = parent_doc_path + '/' + lookup_collection
             else:
                 # Default collection path
-                col_path = self.__path_prefix + '/' + lookup_collection
+                col_path = self.path_prefix + '/' + lookup_collection
 
             # Firestore Operation
             try:
                 fs_doc_ref = self.client.collection(col_path).document(document_id=lookup_id)
-                fs_doc = fs_doc_ref.get()
-                if fs_doc.exists:
-                    result = fs_doc
+                result = self._fs_cached_get(fs_doc_ref, use_cache)
             except Exception as e:
-                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}".format(e.__class__, e,
-                                                                                         self.fs_query_by_id.__name__))
+                self._fs_log_error(e, self.fs_query_by_id)
                 result = None
         return result
 
+    # Reads several documents with batched gets (Client.get_all) of at most batch_size documents,
+    # up to max_workers requests in flight
+    # fs_doc_refs: dictionary of {key: document reference}
+    # field_paths: optional list of properties to return (field mask), other properties are not transferred
+    # Returns a dictionary of {key: document snapshot}, None for non existent documents
+    # Complete documents are read through the document cache if enabled and use_cache
+    def _fs_get_all(self, fs_doc_refs, field_paths=None, use_cache=True, batch_size=FS_GET_ALL_BATCH_SIZE,
+                    max_workers=FS_BATCH_MAX_WORKERS) -> dict:
+        cache = self.__cache if use_cache and field_paths is None else None
+        results = {}
+        pending = []
+        for key, fs_doc_ref in fs_doc_refs.items():
+            fs_doc = cache.get(fs_doc_ref.path) if cache is not None else None
+            if fs_doc is not None:
+                results[key] = fs_doc
+            else:
+                pending.append((key, fs_doc_ref))
+
+        def get_chunk(chunk):
+            keys = {fs_doc_ref.path: key for key, fs_doc_ref in chunk}
+            chunk_results = {key: None for key, fs_doc_ref in chunk}
+            # Documents are not returned in request order
+            for fs_doc in self.client.get_all([fs_doc_ref for key, fs_doc_ref in chunk], field_paths=field_paths,
+                                              **self._fs_retry()):
+                if fs_doc.exists:
+                    chunk_results[keys[fs_doc.reference.path]] = fs_doc
+                    if cache is not None:
+                        cache.put(fs_doc.reference.path, fs_doc)
+            return list(chunk_results.items())
+
+        results.update(self._fs_run_chunks(pending, get_chunk, batch_size, max_workers))
+        return results
+
+    # Batched variant of fs_query_by_id, same collection path rules
+    # Returns a dictionary of {lookup_id: document snapshot}, None for non existent documents, or None on error
+    # field_paths: optional list of properties to return (field mask)
+    @fs_instrumented
+    def fs_query_by_ids(self, lookup_ids, app_object=None, parent_doc_path=None, lookup_collection=None,
+                        field_paths=None, use_cache=True, batch_size=FS_GET_ALL_BATCH_SIZE,
+                        max_workers=FS_BATCH_MAX_WORKERS) -> dict:
+        results = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                col_ref = self.client.collection(col_path)
+                fs_doc_refs = {lookup_id: col_ref.document(document_id=lookup_id) for lookup_id in lookup_ids}
+                results = self._fs_get_all(fs_doc_refs, field_paths, use_cache, batch_size, max_workers)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_query_by_ids)
+                results = None
+        return results
+
+    # Batched variant of fs_doc_exist
+    # Returns a dictionary of {fs_doc_path: bool}, or None on error
+    # Only document names are transferred (empty field mask)
+    @fs_instrumented
+    def fs_docs_exist(self, fs_doc_paths, batch_size=FS_GET_ALL_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS) \
+            -> dict:
+        results = None
+        # Firestore Operation
+        try:
+            fs_doc_refs = {fs_doc_path: self.client.document(fs_doc_path) for fs_doc_path in fs_doc_paths}
+            fs_docs = self._fs_get_all(fs_doc_refs, field_paths=[], use_cache=False, batch_size=batch_size,
+                                       max_workers=max_workers)
+            results = {fs_doc_path: fs_doc is not None for fs_doc_path, fs_doc in fs_docs.items()}
+        except Exception as e:
+            self._fs_log_error(e, self.fs_docs_exist)
+            results = None
+        return results
+
     # Return all Firestore documents representing objects of the same class/collection
     # stored under the same parent document
 
-    def fs_query_by_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None) -> list:
+    @fs_instrumented
+    def fs_query_by_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None, use_cache=True) \
+            -> list:
         # By design Firestore collection is mapped to derived class name dynamically
         # Returns a list of objects Firestore document snapshot (contains id, reference to Firestore and path)
         # If lookup_collection provided, lookup_collection takes precedence
+        # Served from the query cache if enabled and use_cache
         results = None
         if lookup_collection is None:
             if app_object is not None:
@@ -205,30 +1228,26 @@ class GFSManager:
                 col_path = parent_doc_path + '/' + lookup_collection
             else:
                 # Default collection path
-                col_path = self.__path_prefix + '/' + lookup_collection
+                col_path = self.path_prefix + '/' + lookup_collection
 
             # Firestore Operation
             try:
-                col_ref = self.__fs_client.collection(col_path)
-                docs = col_ref.stream()
-                # docs is a class generator
-                # Add every doc to results list
-                # to cast every object to Firestore DocumentSnapshot object
-                results = []
-                for doc in docs:
-                    results.append(doc)
+                col_ref = self.client.collection(col_path)
+                # Every doc of the collection as a Firestore DocumentSnapshot object
+                results = self._fs_cached_query(col_ref, QueryCache.key(col_path), use_cache)
             except Exception as e:
-                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}".format(e.__class__, e,
-                                                                                         self.fs_query_by_collection.__name__))
+                self._fs_log_error(e, self.fs_query_by_collection)
                 results = None
 
         return results
 
-    def fs_query_by_properties(self, lookup_properties, app_object=None, parent_doc_path=None, lookup_collection=None) \
-            -> list:
+    @fs_instrumented
+    def fs_query_by_properties(self, lookup_properties, app_object=None, parent_doc_path=None, lookup_collection=None,
+                               use_cache=True) -> list:
         # By design Firestore collection is mapped to derived class name dynamically
         # Returns a list of objects Firestore document snapshot (contains id, reference to Firestore and path)
         # If lookup_collection provided, lookup_collection takes precedence
+        # Served from the query cache if enabled and use_cache
         results = None
         if lookup_collection is None:
             if app_object is not None:
@@ -241,69 +1260,874 @@ class GFSManager:
                 col_path = parent_doc_path + '/' + lookup_collection
             else:
                 # Default collection path
-                col_path = self.__path_prefix + '/' + lookup_collection
+                col_path = self.path_prefix + '/' + lookup_collection
 
             # Firestore Operation
             try:
-                col_ref = self.__fs_client.collection(col_path)
-                for lookup_property in lookup_properties:
-                    # Firestore warning produced if no FieldFilter class used
-                    # query = query.where(field_path=lookup_property, op_string='==',
-                    # value=lookup_properties.get(lookup_property))
-                    query = col_ref.where(filter=FieldFilter(field_path=lookup_property, op_string='==',
-                                                             value=lookup_properties.get(lookup_property)))
-                docs = query.stream()
-                # Docs return a class generator
-                # Add every doc to results list
-                # to cast every object to Firestore DocumentSnapshot object
-
-                # docs is a class generator
-                # Add every doc to results list
-                # to cast every object to Firestore DocumentSnapshot object
-                results = []
-                for doc in docs:
-                    results.append(doc)
+                col_ref = self.client.collection(col_path)
+                # Every property filter is chained to the same query
+                query = self._fs_build_query(col_ref, lookup_properties=lookup_properties)
+                # Every matching doc as a Firestore DocumentSnapshot object
+                results = self._fs_cached_query(query, QueryCache.key(col_path, lookup_properties=lookup_properties),
+                                                use_cache)
             except Exception as e:
-                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}"
-                            .format(e.__class__, e, self.fs_query_by_collection.__name__))
+                self._fs_log_error(e, self.fs_query_by_properties)
                 results = None
 
         return results
 
-    def fs_delete_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None):
-        # Deletes all the current objects in a collection
-        # By design Firestore collection maps to derived class name dynamically
-        result = False
-        if lookup_collection is None:
-            if app_object is not None:
-                lookup_collection = app_object.__class__.__name__
-
-        # Lookup collection provided or populated from app_object
-        if lookup_collection is not None:
-            # Include paren_doc_path if present
-            if parent_doc_path is not None:
-                col_path = parent_doc_path + '/' + lookup_collection
+    # Builds a Firestore query from a collection reference
+    # lookup_properties: dictionary of {property: value} equality filters
+    # filters: list of (property, operator, value) filters, operator in FS_QUERY_OPERATORS
+    # order_by: list of properties, or (property, direction) pairs with direction 'ASCENDING' or 'DESCENDING'
+    # select: list of properties to return (field projection), other properties are not transferred
+    # All filters are chained (logical AND)
+    @staticmethod
+    def _fs_build_query(col_ref, lookup_properties=None, filters=None, order_by=None, limit=None, offset=None,
+                        select=None):
+        query = col_ref
+        all_filters = [(k, '==', v) for k, v in (lookup_properties or {}).items()] + list(filters or [])
+        for field_path, op_string, value in all_filters:
+            if op_string not in FS_QUERY_OPERATORS:
+                raise ValueError("Invalid query operator {} for property {}".format(op_string, field_path))
+            # Firestore warning produced if no FieldFilter class used
+            query = query.where(filter=FieldFilter(field_path=field_path, op_string=op_string, value=value))
+        for order in order_by or []:
+            if isinstance(order, str):
+                query = query.order_by(order)
             else:
-                # Default collection path
-                col_path = self.__path_prefix + '/' + lookup_collection
-                # Firestore Operation
+                field_path, direction = order
+                query = query.order_by(field_path, direction=direction)
+        if select is not None:
+            query = query.select(select)
+        if offset is not None:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    # Compound query on a collection, same collection path rules as fs_query_by_collection
+    # Filters, ordering, offset, limit and field projections (select) are applied by Firestore
+    # Served from the query cache if enabled and use_cache
+    # Returns a list of Firestore document snapshots, or None on error
+    # Example:
+    #   fs_query(lookup_collection='User', lookup_properties={'status': 'active'},
+    #            filters=[('age', '>=', 18), ('tags', 'array_contains', 'admin')],
+    #            order_by=[('age', 'DESCENDING')], limit=20, select=['name', 'age'])
+    @fs_instrumented
+    def fs_query(self, app_object=None, parent_doc_path=None, lookup_collection=None, lookup_properties=None,
+                 filters=None, order_by=None, limit=None, offset=None, select=None, use_cache=True) -> list:
+        results = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                col_ref = self.client.collection(col_path)
+                query = self._fs_build_query(col_ref, lookup_properties=lookup_properties, filters=filters,
+                                             order_by=order_by, limit=limit, offset=offset, select=select)
+                key = QueryCache.key(col_path, lookup_properties=lookup_properties, filters=filters,
+                                     order_by=order_by, limit=limit, offset=offset, select=select)
+                results = self._fs_cached_query(query, key, use_cache)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_query)
+                results = None
+        return results
+
+    # Runs a single aggregation (count, sum or avg) on query and returns its value
+    # Firestore client libraries without sum/avg aggregations (google-cloud-firestore < 2.14) fall back to a scan of
+    # the projected field only
+    # retry_kwargs: retry and timeout arguments of the Firestore call
+    @staticmethod
+    def _fs_aggregate(query, aggregation, field_path=None, retry_kwargs=None):
+        retry_kwargs = retry_kwargs or {}
+        if aggregation == 'count':
+            return query.count(alias=aggregation).get(**retry_kwargs)[0][0].value
+        if hasattr(query, aggregation):
+            return getattr(query, aggregation)(field_path, alias=aggregation).get(**retry_kwargs)[0][0].value
+        # Only numeric values are aggregated, as Firestore does
+        values = [doc.to_dict().get(field_path) for doc in query.select([field_path]).stream(**retry_kwargs)]
+        values = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        if aggregation == 'sum':
+            return sum(values)
+        return sum(values) / len(values) if values else None
+
+    def _fs_aggregate_collection(self, aggregation, field_path=None, app_object=None, parent_doc_path=None,
+                                 lookup_collection=None, lookup_properties=None, filters=None):
+        result = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties,
+                                             filters=filters)
+                result = self._fs_aggregate(query, aggregation, field_path, self._fs_retry())
+            except Exception as e:
+                # Logged as an error of the public method: fs_count, fs_sum or fs_avg
+                self._fs_log_error(e, getattr(self, 'fs_' + aggregation))
+                result = None
+        return result
+
+    # Server side aggregations on a collection, same collection path and filters as fs_query
+    # Documents are not transferred, returns the aggregation value, or None on error
+    @fs_instrumented
+    def fs_count(self, app_object=None, parent_doc_path=None, lookup_collection=None, lookup_properties=None,
+                 filters=None) -> int:
+        return self._fs_aggregate_collection('count', None, app_object, parent_doc_path, lookup_collection,
+                                             lookup_properties, filters)
+
+    @fs_instrumented
+    def fs_sum(self, field_path, app_object=None, parent_doc_path=None, lookup_collection=None,
+               lookup_properties=None, filters=None):
+        return self._fs_aggregate_collection('sum', field_path, app_object, parent_doc_path, lookup_collection,
+                                             lookup_properties, filters)
+
+    # Average of the numeric values of field_path, None if no document has a numeric value for field_path
+    @fs_instrumented
+    def fs_avg(self, field_path, app_object=None, parent_doc_path=None, lookup_collection=None,
+               lookup_properties=None, filters=None):
+        return self._fs_aggregate_collection('avg', field_path, app_object, parent_doc_path, lookup_collection,
+                                             lookup_properties, filters)
+
+    # Yields every document snapshot of query, reading page_size documents per request
+    # Pages are ordered by document id and chained with start_after cursors
+    # start_after_id: id of the last document already processed, to resume an interrupted scan
+    def _fs_iter_pages(self, query, page_size=FS_QUERY_PAGE_SIZE, start_after_id=None):
+        for page in self._fs_iter_page_lists(query, page_size, start_after_id, self._fs_retry()):
+            for doc in page:
+                yield doc
+
+    # Yields lists of at most page_size document snapshots of query, see _fs_iter_pages
+    # retry_kwargs: retry and timeout arguments of every page query
+    @staticmethod
+    def _fs_iter_page_lists(query, page_size=FS_QUERY_PAGE_SIZE, start_after_id=None, retry_kwargs=None):
+        # Recursive queries are already ordered by document id, Firestore rejects repeated orderings
+        if not any(order.field.field_path == FieldPath.document_id() for order in getattr(query, '_orders', ())):
+            query = query.order_by(FieldPath.document_id())
+        cursor = {FieldPath.document_id(): start_after_id} if start_after_id is not None else None
+        page_size = max(1, page_size)
+        while True:
+            page_query = query.limit(page_size)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+            # Only one page of snapshots held in memory, stream closed before yielding
+            page = list(page_query.stream(**(retry_kwargs or {})))
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+            # Document reference cursor, valid for queries across subcollections too
+            cursor = {FieldPath.document_id(): page[-1].reference}
+
+    # Generator variant of fs_query_by_collection
+    # Yields Firestore document snapshots lazily, reading the collection in pages of page_size documents
+    # To resume an interrupted scan, provide the id of the last document processed as start_after_id
+    @fs_instrumented
+    def fs_iter_query_by_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None,
+                                    page_size=FS_QUERY_PAGE_SIZE, start_after_id=None) -> Iterator[DocumentSnapshot]:
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                col_ref = self.client.collection(col_path)
+                yield from self._fs_iter_pages(col_ref, page_size, start_after_id)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_iter_query_by_collection)
+
+    # Generator variant of fs_query_by_properties
+    # Yields Firestore document snapshots lazily, reading matching documents in pages of page_size documents
+    # To resume an interrupted scan, provide the id of the last document processed as start_after_id
+    @fs_instrumented
+    def fs_iter_query_by_properties(self, lookup_properties, app_object=None, parent_doc_path=None,
+                                    lookup_collection=None, page_size=FS_QUERY_PAGE_SIZE, start_after_id=None) \
+            -> Iterator[DocumentSnapshot]:
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties)
+                yield from self._fs_iter_pages(query, page_size, start_after_id)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_iter_query_by_properties)
+
+    # Id ranges splitting a collection in at most partitions parts of similar size, same collection path rules as
+    # fs_query_by_collection
+    # Split points are returned by a Firestore partition query on the collections of the same name under the
+    # collection parent document, split points of other collections than the collection are ignored
+    # Returns a list of (start_id, end_id) ranges, from start_id included to end_id excluded, None for open ends,
+    # or None on error
+    # Partitions are read with fs_iter_partition, by any thread or process
+    @fs_instrumented
+    def fs_collection_partitions(self, partitions, app_object=None, parent_doc_path=None, lookup_collection=None) \
+            -> list:
+        results = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
             try:
+                split_ids = []
+                if partitions > 1:
+                    collection_group = CollectionGroup(self.client.collection(col_path))
+                    for partition in collection_group.get_partitions(partitions - 1, **self._fs_retry()):
+                        if partition.end_at is not None and partition.end_at.path.rpartition('/')[0] == col_path:
+                            split_ids.append(partition.end_at.id)
+                bounds = [None] + split_ids + [None]
+                results = list(zip(bounds[:-1], bounds[1:]))
+            except Exception as e:
+                self._fs_log_error(e, self.fs_collection_partitions)
+                results = None
+        return results
+
+    # Query of the documents of a collection with ids from start_id included to end_id excluded
+    @staticmethod
+    def _fs_partition_query(col_ref, start_id=None, end_id=None, select=None):
+        query = col_ref.order_by(FieldPath.document_id())
+        if select is not None:
+            query = query.select(select)
+        if start_id is not None:
+            query = query.start_at({FieldPath.document_id(): col_ref.document(start_id)})
+        if end_id is not None:
+            query = query.end_before({FieldPath.document_id(): col_ref.document(end_id)})
+        return query
+
+    # Generator of the documents of a partition returned by fs_collection_partitions, read in pages of page_size
+    # documents
+    # select: optional list of properties to return (field projection)
+    @fs_instrumented
+    def fs_iter_partition(self, start_id=None, end_id=None, app_object=None, parent_doc_path=None,
+                          lookup_collection=None, page_size=FS_QUERY_PAGE_SIZE, select=None) \
+            -> Iterator[DocumentSnapshot]:
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_partition_query(self.client.collection(col_path), start_id, end_id, select)
+                yield from self._fs_iter_pages(query, page_size)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_iter_partition)
 
+    # Full scan of a collection, split with fs_collection_partitions, partitions read concurrently by max_workers
+    # threads, in pages of page_size documents
+    # callback: function called with every page (list of document snapshots), from the worker threads: pages of a
+    #   partition are delivered in order, pages of different partitions concurrently
+    #   An output sink is plugged with its write method, e.g. callback=sink.write
+    # Memory is bounded: at most one page per worker is held, a worker reads its next page once callback returns
+    # partitions: number of partitions, FS_SCAN_PARTITIONS_PER_WORKER per worker by default
+    # Returns the scan statistics, or None on error
+    #   {'partitions': partitions, 'documents': documents read, 'elapsed': seconds, 'docs_per_second': throughput,
+    #    'failed': (start_id, end_id) ranges of the partitions not completely read}
+    # Partitions failed are scanned again with fs_iter_partition, pages delivered before the failure are not
+    @fs_instrumented
+    def fs_scan_partitioned(self, callback, app_object=None, parent_doc_path=None, lookup_collection=None,
+                            partitions=None, max_workers=FS_BATCH_MAX_WORKERS, page_size=FS_QUERY_PAGE_SIZE,
+                            select=None) -> dict:
+        stats = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            max_workers = max(1, max_workers)
+            ranges = self.fs_collection_partitions(partitions or max_workers * FS_SCAN_PARTITIONS_PER_WORKER,
+                                                   app_object, parent_doc_path, lookup_collection)
+            if ranges is not None:
+                stats = {'partitions': len(ranges), 'documents': 0, 'elapsed': 0.0, 'docs_per_second': 0.0,
+                         'failed': []}
+                start = time.monotonic()
+                lock = threading.Lock()
                 col_ref = self.client.collection(col_path)
-                fs_docs = col_ref.stream()
 
+                def scan_partition(bounds):
+                    try:
+                        query = self._fs_partition_query(col_ref, *bounds, select=select)
+                        for page in self._fs_iter_page_lists(query, page_size, retry_kwargs=self._fs_retry()):
+                            callback(page)
+                            with lock:
+                                stats['documents'] += len(page)
+                    except Exception as e:
+                        self._fs_log_error(e, self.fs_scan_partitioned)
+                        with lock:
+                            stats['failed'].append(bounds)
+
+                # Worker threads run in the current instrumented operation
+                scan_partition = fs_bind_operation(scan_partition)
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(ranges))) as executor:
+                    list(executor.map(scan_partition, ranges))
+                stats['elapsed'] = time.monotonic() - start
+                stats['docs_per_second'] = stats['documents'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+                logging.log(level=logging.INFO, msg="Scanned {} documents from {} in {} partitions in {:.3f}s "
+                                                    "({:.1f} docs/s)".format(stats['documents'], col_path,
+                                                                             stats['partitions'], stats['elapsed'],
+                                                                             stats['docs_per_second']))
+        return stats
+
+    # Query of the documents of a partition of the collection col_path, and of the documents of their subcollections
+    # at any depth, ordered by path: subcollection documents follow their parent document
+    def _fs_recursive_partition_query(self, col_path, start_id=None, end_id=None):
+        query = self.client.collection(col_path).recursive()
+        if start_id is not None:
+            query = query.start_at({FieldPath.document_id(): col_path + '/' + start_id})
+        if end_id is not None:
+            query = query.end_before({FieldPath.document_id(): col_path + '/' + end_id})
+        return query
+
+    # Streaming export of collections to gzip compressed newline delimited JSON files in export_dir, see
+    # gfs_manager.export
+    # Exports the collection lookup_collection of parent_doc_path (app path prefix by default), or every collection of
+    # parent_doc_path if no collection is provided, with the documents of their subcollections at any depth
+    # Collections are split in partitions exported concurrently by max_workers threads, one file per partition, with
+    # one page of documents in memory per worker
+    # Document ids and paths relative to parent_doc_path are kept, fs_import imports them under any document
+    # resume: partitions exported by an interrupted export, recorded in the export checkpoint, are not exported again
+    # The manifest is written once every partition is exported
+    # Returns the export statistics, None on error:
+    # {'files', 'documents', 'elapsed', 'docs_per_second', 'failed': [files not exported]}
+    @fs_instrumented
+    def fs_export(self, export_dir, parent_doc_path=None, lookup_collection=None, partitions=None,
+                  max_workers=FS_BATCH_MAX_WORKERS, page_size=FS_QUERY_PAGE_SIZE, resume=True) -> dict:
+        stats = None
+        root = parent_doc_path or self.path_prefix
+        max_workers = max(1, max_workers)
+        # Firestore Operation
+        try:
+            os.makedirs(export_dir, exist_ok=True)
+            checkpoint_path = os.path.join(export_dir, FSM_EXPORT_CHECKPOINT)
+            checkpoint = Checkpoint.load(checkpoint_path) if resume else Checkpoint(checkpoint_path)
+            if checkpoint.state.get('root', root) != root:
+                raise ValueError('Export {} of {} resumed for {}'.format(export_dir, checkpoint.state['root'], root))
+            if lookup_collection is not None:
+                collection_ids = [lookup_collection]
+            else:
+                collection_ids = sorted(col_ref.id for col_ref in
+                                        self.client.document(root).collections(**self._fs_retry()))
+            # Partitions of the collections, kept by the checkpoint: resumed exports write the same files
+            planned = checkpoint.state.get('partitions', {})
+            for collection_id in collection_ids:
+                if collection_id not in planned:
+                    ranges = self.fs_collection_partitions(
+                        partitions or max_workers * FS_SCAN_PARTITIONS_PER_WORKER, parent_doc_path=root,
+                        lookup_collection=collection_id)
+                    if ranges is None:
+                        raise RuntimeError('Partitions of {}/{} not read'.format(root, collection_id))
+                    planned[collection_id] = ranges
+            checkpoint.update(lambda state: state.update(root=root, partitions=planned, done=state.get('done', {})))
+            tasks = [(collection_id, index, start_id, end_id) for collection_id in collection_ids
+                     for index, (start_id, end_id) in enumerate(planned[collection_id])
+                     if fs_export_file_name(collection_id, index) not in checkpoint.state['done']]
+            stats = {'files': 0, 'documents': 0, 'elapsed': 0.0, 'docs_per_second': 0.0, 'failed': []}
+            start = time.monotonic()
+            lock = threading.Lock()
+
+            def export_partition(task):
+                collection_id, index, start_id, end_id = task
+                file_name = fs_export_file_name(collection_id, index)
+                file_path = os.path.join(export_dir, file_name)
+                documents = 0
+                try:
+                    query = self._fs_recursive_partition_query(root + '/' + collection_id, start_id, end_id)
+                    # Partial files of interrupted exports are never read: written under a temporary name
+                    with gzip.open(file_path + '.part', 'wb', compresslevel=FSM_EXPORT_COMPRESS_LEVEL) as export_file:
+                        for page in self._fs_iter_page_lists(query, page_size, retry_kwargs=self._fs_retry()):
+                            export_file.write(b''.join(fs_export_line(fs_doc, root) for fs_doc in page))
+                            documents += len(page)
+                    os.replace(file_path + '.part', file_path)
+                    checkpoint.update(lambda state: state['done'].update({file_name: documents}))
+                    with lock:
+                        stats['files'] += 1
+                        stats['documents'] += documents
+                except Exception as e:
+                    self._fs_log_error(e, self.fs_export)
+                    with lock:
+                        stats['failed'].append(file_name)
+
+            # Worker threads run in the current instrumented operation
+            export_partition = fs_bind_operation(export_partition)
+            if tasks:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+                    list(executor.map(export_partition, tasks))
+            stats['elapsed'] = time.monotonic() - start
+            stats['docs_per_second'] = stats['documents'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+            if not stats['failed']:
+                done = checkpoint.state['done']
+                fs_write_json(os.path.join(export_dir, FSM_EXPORT_MANIFEST), {
+                    'version': FSM_EXPORT_FORMAT_VERSION, 'root': root,
+                    'collections': {collection_id: [fs_export_file_name(collection_id, index)
+                                                    for index in range(len(planned[collection_id]))]
+                                    for collection_id in collection_ids},
+                    'files': {file_name: done[file_name] for file_name in sorted(done)},
+                    'documents': sum(done.values())})
+            logging.log(level=logging.INFO, msg="Exported {} documents from {} in {} files in {:.3f}s ({:.1f} docs/s)"
+                        .format(stats['documents'], root, stats['files'], stats['elapsed'],
+                                stats['docs_per_second']))
+        except Exception as e:
+            self._fs_log_error(e, self.fs_export)
+            stats = None
+        return stats
+
+    # Streaming import of an export of fs_export under parent_doc_path (app path prefix by default)
+    # Documents are written with their ids and relative paths, replacing existing documents, with batched writes of
+    # batch_size documents, export files are imported concurrently by max_workers threads
+    # References to documents under the exported document are imported as references under parent_doc_path
+    # resume: files imported by an interrupted import under the same document, recorded in the import checkpoint, are
+    # not imported again
+    # Returns the import statistics, None on error (incomplete export):
+    # {'files', 'documents', 'elapsed', 'docs_per_second', 'failed': [files not imported]}
+    @fs_instrumented
+    def fs_import(self, export_dir, parent_doc_path=None, max_workers=FS_BATCH_MAX_WORKERS,
+                  batch_size=FS_MAX_BATCH_SIZE, resume=True) -> dict:
+        stats = None
+        root = parent_doc_path or self.path_prefix
+        batch_size = max(1, min(batch_size, FS_MAX_BATCH_SIZE))
+        # Firestore Operation
+        try:
+            manifest = fs_read_json(os.path.join(export_dir, FSM_EXPORT_MANIFEST))
+            if manifest is None:
+                raise FileNotFoundError('No complete export in {}'.format(export_dir))
+            checkpoint = Checkpoint.load(os.path.join(export_dir, FSM_IMPORT_CHECKPOINT))
+            if not resume:
+                checkpoint.state.pop(root, None)
+            imported = checkpoint.state.setdefault(root, {})
+            tasks = [file_name for file_name in manifest['files'] if file_name not in imported]
+            stats = {'files': 0, 'documents': 0, 'elapsed': 0.0, 'docs_per_second': 0.0, 'failed': []}
+            start = time.monotonic()
+            lock = threading.Lock()
+            client = self.client
+
+            def commit(batch_docs):
+                batch = self._fs_batch()
+                for path, data in batch_docs:
+                    batch.set(client.document(root + '/' + path), fs_decode_value(data, client, root))
+                # Replacing documents is idempotent
+                batch.commit(**self._fs_retry())
+
+            def import_file(file_name):
+                documents = 0
+                try:
+                    batch_docs = []
+                    for document in fs_read_export_file(os.path.join(export_dir, file_name)):
+                        batch_docs.append(document)
+                        if len(batch_docs) == batch_size:
+                            commit(batch_docs)
+                            documents += len(batch_docs)
+                            batch_docs = []
+                    if batch_docs:
+                        commit(batch_docs)
+                        documents += len(batch_docs)
+                    checkpoint.update(lambda state: state[root].update({file_name: documents}))
+                    with lock:
+                        stats['files'] += 1
+                        stats['documents'] += documents
+                except Exception as e:
+                    self._fs_log_error(e, self.fs_import)
+                    with lock:
+                        stats['failed'].append(file_name)
+                        stats['documents'] += documents
+
+            import_file = fs_bind_operation(import_file)
+            if tasks:
+                with ThreadPoolExecutor(max_workers=min(max(1, max_workers), len(tasks))) as executor:
+                    list(executor.map(import_file, tasks))
+            for collection_id in manifest['collections']:
+                self._fs_cache_invalidate(fs_collection_path=root + '/' + collection_id)
+            stats['elapsed'] = time.monotonic() - start
+            stats['docs_per_second'] = stats['documents'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+            logging.log(level=logging.INFO, msg="Imported {} documents under {} from {} files in {:.3f}s "
+                                                "({:.1f} docs/s)".format(stats['documents'], root, stats['files'],
+                                                                         stats['elapsed'], stats['docs_per_second']))
+        except Exception as e:
+            self._fs_log_error(e, self.fs_import)
+            stats = None
+        return stats
+
+    # Secondary indexes, see gfs_manager.indexes
+    # Lookup documents of the indexes registered for a collection are written with the documents by fs_doc_store,
+    # fs_doc_update, fs_doc_merge, fs_doc_delete, fs_model_store and fs_model_update: stores in the same batched write,
+    # other writes in a transaction reading the indexed values before the write, bulk stores and deletes in their
+    # batched writes, fs_delete_collection deletes the index collections
+    # Other writes (buffered, transforms, imports) do not maintain indexes, rebuild them with fs_index_rebuild
+
+    # Index entries of the documents of a collection whose property field is value
+    # A unique index lookup is a single document read, a non unique index lookup a read of the entries of the value
+    # Returns a list of entries {'fs_id', 'fs_path', included properties}, None on error or if field is not indexed
+    @fs_instrumented
+    def fs_index_lookup(self, field, value, app_object=None, parent_doc_path=None, lookup_collection=None) -> list:
+        results = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        index = fs_collection_indexes(col_path).get(field)
+        key = SecondaryIndex.key(value)
+        if index is not None and key is not None:
+            # Firestore Operation
+            try:
+                if index.unique:
+                    fs_doc = self.client.document(index.value_path(col_path, key)).get(**self._fs_retry())
+                    results = [fs_doc.to_dict()] if fs_doc.exists else []
+                else:
+                    results = [fs_doc.to_dict() for fs_doc in
+                               self.client.collection(index.value_path(col_path, key)).stream(**self._fs_retry())]
+            except Exception as e:
+                self._fs_log_error(e, self.fs_index_lookup)
+                results = None
+        return results
+
+    # Documents of a collection whose property field is value, read by id from the index entries
+    # Returns a list of document snapshots, None on error or if field is not indexed
+    @fs_instrumented
+    def fs_query_by_index(self, field, value, app_object=None, parent_doc_path=None, lookup_collection=None,
+                          use_cache=True) -> list:
+        results = None
+        entries = self.fs_index_lookup(field, value, app_object, parent_doc_path, lookup_collection)
+        if entries is not None:
+            fs_docs = self.fs_query_by_ids([entry['fs_id'] for entry in entries], app_object, parent_doc_path,
+                                           lookup_collection, use_cache=use_cache)
+            if fs_docs is not None:
+                # Entries of documents being deleted
+                results = [fs_docs[entry['fs_id']] for entry in entries if fs_docs[entry['fs_id']] is not None]
+        return results
+
+    # Rebuilds the index of the property field of a collection: deletes its lookup documents and writes the entries of
+    # every document of the collection, with one batched write per page of page_size documents
+    # Documents written during the rebuild may not be indexed, for unique indexes only the first document of every
+    # value is indexed (conflicts)
+    # Returns the rebuild statistics, None on error: {'documents', 'entries', 'conflicts'}
+    @fs_instrumented
+    def fs_index_rebuild(self, field, app_object=None, parent_doc_path=None, lookup_collection=None,
+                         page_size=FS_MAX_BATCH_SIZE) -> dict:
+        stats = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        index = fs_collection_indexes(col_path).get(field)
+        if index is not None:
+            # Firestore Operation
+            try:
+                client = self.client
+                if self._fs_delete_query(client.collection(index.index_path(col_path)).recursive())['failed']:
+                    raise RuntimeError('Index {} not deleted'.format(index.index_path(col_path)))
+                stats = {'documents': 0, 'entries': 0, 'conflicts': 0}
+                keys = set()
+                for page in self._fs_iter_page_lists(client.collection(col_path),
+                                                     max(1, min(page_size, FS_MAX_BATCH_SIZE)),
+                                                     retry_kwargs=self._fs_retry()):
+                    batch = self._fs_batch()
+                    entries = 0
+                    for fs_doc in page:
+                        properties = fs_doc.to_dict()
+                        key = index.key(properties.get(field))
+                        if key is None:
+                            continue
+                        if index.unique:
+                            if key in keys:
+                                stats['conflicts'] += 1
+                                continue
+                            keys.add(key)
+                        batch.set(client.document(index.lookup_path(col_path, key, fs_doc.id)),
+                                  index.entry(fs_doc.reference.path, properties))
+                        entries += 1
+                    if entries:
+                        batch.commit(**self._fs_retry())
+                    stats['documents'] += len(page)
+                    stats['entries'] += entries
+                if stats['conflicts']:
+                    logging.log(level=logging.WARNING, msg="{} documents of {} not indexed by {}: value indexed for "
+                                                           "another document".format(stats['conflicts'], col_path,
+                                                                                     field))
+            except Exception as e:
+                self._fs_log_error(e, self.fs_index_rebuild)
+                stats = None
+        return stats
+
+    # Typed models, see gfs_manager.models
+    # Model documents are stored in the model collection, under parent_doc_path if provided, otherwise under the
+    # current app path prefix
+
+    # Stores model as a new document, and sets its document metadata (fs_id, fs_path, fs_update_time)
+    # Returns (fs_stored_time, fs_id, fs_path, result) as fs_doc_store
+    @fs_instrumented
+    def fs_model_store(self, model, parent_doc_path=None):
+        schema = fs_model_schema(model.__class__)
+        doc_properties = schema.encode(model)
+        col_path = self._fs_collection_path(parent_doc_path=parent_doc_path, lookup_collection=schema.collection)
+        fs_stored_time, fs_id, fs_path, result = self.fs_doc_store(model, doc_properties, fs_collection_path=col_path)
+        if result:
+            schema.written(model, doc_properties, fs_id, fs_path, fs_stored_time)
+        return fs_stored_time, fs_id, fs_path, result
+
+    # Writes the properties of a stored model changed since it was read or last written, with a single update() of
+    # those properties instead of replacing the document
+    # No RPC is made if no property changed
+    # If fs_last_update_time is provided, the document is only updated if it was last updated at that time
+    # Returns (fs_updated_time, fs_id, fs_path, result), result is False for models not stored or non existent
+    # documents
+    @fs_instrumented
+    def fs_model_update(self, model, fs_last_update_time=None):
+        fs_updated_time = None
+        result = False
+        fs_id = model.fs_id
+        fs_path = model.fs_path
+        if fs_path is not None:
+            schema = fs_model_schema(model.__class__)
+            changes = schema.changes(model)
+            if not changes:
+                return model.fs_update_time, fs_id, fs_path, True
+            try:
+                # update() asserts the document exists
+                fs_doc_ref = self.client.document(fs_path)
+                indexes = fs_collection_indexes(fs_path.rpartition('/')[0])
+                if indexes:
+                    fs_updated_time = self._fs_indexed_write(fs_doc_ref, indexes, FSM_INDEX_UPDATE, changes,
+                                                             exists=True,
+                                                             fs_last_update_time=fs_last_update_time).update_time
+                else:
+                    option = self._fs_write_option(fs_last_update_time) if fs_last_update_time is not None else None
+                    fs_updated_time = fs_doc_ref.update(
+                        changes, option=option, **self._fs_retry(fs_last_update_time is None)).update_time
+                schema.written(model, {**model._fs_loaded, **changes}, fs_id, fs_path, fs_updated_time)
+                result = True
+            except (NotFound, FailedPrecondition):
+                # Non existent document or precondition not met
+                result = False
+            except Exception as e:
+                self._fs_log_error(e, self.fs_model_update)
+                result = False
+            self._fs_cache_invalidate(fs_doc_path=fs_path)
+        return fs_updated_time, fs_id, fs_path, result
+
+    # Reads a model by document id, None if the document does not exist
+    # Served from the document cache if enabled and use_cache
+    @fs_instrumented
+    def fs_model_get(self, model_class, fs_id, parent_doc_path=None, use_cache=True) -> Model:
+        schema = fs_model_schema(model_class)
+        fs_doc = self.fs_query_by_id(fs_id, parent_doc_path=parent_doc_path, lookup_collection=schema.collection,
+                                     use_cache=use_cache)
+        return schema.from_snapshot(fs_doc)
+
+    # Compound query returning models, same filters as fs_query
+    # Returns a list of models, or None on error
+    @fs_instrumented
+    def fs_query_models(self, model_class, parent_doc_path=None, lookup_properties=None, filters=None, order_by=None,
+                        limit=None, offset=None) -> list:
+        schema = fs_model_schema(model_class)
+        fs_docs = self.fs_query(parent_doc_path=parent_doc_path, lookup_collection=schema.collection,
+                                lookup_properties=lookup_properties, filters=filters, order_by=order_by, limit=limit,
+                                offset=offset)
+        return [schema.from_snapshot(fs_doc) for fs_doc in fs_docs] if fs_docs is not None else None
+
+    # Generator of the models of a collection, or of the documents matching lookup_properties, read in pages of
+    # page_size documents, see fs_iter_query_by_properties
+    @fs_instrumented
+    def fs_iter_models(self, model_class, parent_doc_path=None, lookup_properties=None, page_size=FS_QUERY_PAGE_SIZE,
+                       start_after_id=None) -> Iterator[Model]:
+        schema = fs_model_schema(model_class)
+        col_path = self._fs_collection_path(parent_doc_path=parent_doc_path, lookup_collection=schema.collection)
+        # Firestore Operation
+        try:
+            query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties)
+            for fs_doc in self._fs_iter_pages(query, page_size, start_after_id):
+                yield schema.from_snapshot(fs_doc)
+        except Exception as e:
+            self._fs_log_error(e, self.fs_iter_models)
+
+    # Watches a collection with a Firestore listener, same collection path rules as fs_query_by_collection
+    # Returns a started CollectionWatch keeping a local mirror {fs_id: properties} of the collection documents,
+    # or None on error
+    # callback: optional function called with the changes of every snapshot, see gfs_manager.watch.CollectionWatch
+    # Watches are stopped by close_connection
+    def fs_watch_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None, callback=None) \
+            -> CollectionWatch:
+        return self.fs_watch_query(app_object=app_object, parent_doc_path=parent_doc_path,
+                                   lookup_collection=lookup_collection, callback=callback)
+
+    # Watches the documents of a query, same collection path rules and filters as fs_query
+    # Listeners do not support offsets nor field projections
+    # Example: mirror of the active users
+    #   users = fs_watch_query(lookup_collection='User', lookup_properties={'status': 'active'})
+    #   users.wait_ready(timeout=10)
+    #   users.get(fs_id)
+    def fs_watch_query(self, app_object=None, parent_doc_path=None, lookup_collection=None, lookup_properties=None,
+                       filters=None, order_by=None, limit=None, callback=None) -> CollectionWatch:
+        watch = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties,
+                                             filters=filters, order_by=order_by, limit=limit)
+                watch = CollectionWatch(query, callback).start()
+                self.__watches.add(watch)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_watch_query)
+                watch = None
+        return watch
+
+    # Watches a collection with a Firestore listener invalidating the cached documents and queries of the collection
+    # changed by other processes, same collection path rules as fs_query_by_collection
+    # Returns a started CollectionWatch, or None on error, see fs_watch_query
+    # Queries and documents changed while the listener is reconnecting are invalidated once it is reopened, and
+    # expire after their time to live in the meantime
+    def fs_watch_cache(self, app_object=None, parent_doc_path=None, lookup_collection=None) -> CollectionWatch:
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+
+        def invalidate(changes):
+            if self.__cache is not None:
+                for change_type, fs_id, properties in changes:
+                    self.__cache.invalidate(col_path + '/' + fs_id)
+            if changes:
+                self._fs_query_cache_invalidate(col_path)
+
+        return self.fs_watch_query(app_object=app_object, parent_doc_path=parent_doc_path,
+                                   lookup_collection=lookup_collection, callback=invalidate)
+
+    # Sharded counters, see gfs_manager.counters
+    # A counter is a document of the FSM_COUNTERS_COLLECTION collection, under parent_doc_path if provided (counters
+    # of a document), otherwise under the app path prefix, with a subcollection of num_shards shard documents
+    # Increments are written to a random shard: a counter sustains about num_shards writes per second
+    # Example: views of a user document
+    #   fs_counter_increment('views', parent_doc_path=user_path)
+    #   fs_counter_value('views', parent_doc_path=user_path, max_age=10)
+
+    def _fs_counter_ref(self, counter_id, parent_doc_path=None):
+        col_path = self._fs_collection_path(parent_doc_path=parent_doc_path, lookup_collection=FSM_COUNTERS_COLLECTION)
+        return self.client.collection(col_path).document(counter_id)
+
+    # Adds amount to a counter, with an Increment transform on a random shard, buffered by the write coalescer if any
+    # Returns (fs_stored_time, counter_id, counter_path, result), fs_stored_time is None for buffered increments
+    @fs_instrumented
+    def fs_counter_increment(self, counter_id, amount=1, parent_doc_path=None, num_shards=FSM_COUNTER_SHARDS):
+        fs_stored_time = None
+        fs_path = None
+        result = False
+        # Firestore Operation
+        try:
+            counter_ref = self._fs_counter_ref(counter_id, parent_doc_path)
+            shard_ref = fs_counter_shard(counter_ref, num_shards)
+            if self.__write_coalescer is not None:
+                self.__write_coalescer.update(shard_ref.path, increments={FSM_COUNTER_FIELD: amount})
+            else:
+                # Increments are not idempotent
+                fs_stored_time = shard_ref.set({FSM_COUNTER_FIELD: firestore.Increment(amount)}, merge=True,
+                                               **self._fs_retry(False)).update_time
+            self.__counter_values.add(counter_ref.path, amount)
+            fs_path = counter_ref.path
+            result = True
+        except Exception as e:
+            self._fs_log_error(e, self.fs_counter_increment)
+            result = False
+        return fs_stored_time, counter_id, fs_path, result
+
+    # Value of a counter: sum of its shards, 0 for counters never incremented, None on error
+    # max_age: seconds a value read by the manager is served from memory, with the manager increments added
+    @fs_instrumented
+    def fs_counter_value(self, counter_id, parent_doc_path=None, max_age=None):
+        counter_path = self._fs_counter_ref(counter_id, parent_doc_path).path
+        value = self.__counter_values.get(counter_path, max_age) if max_age is not None else None
+        if value is None:
+            # Sum of the shards, computed by Firestore
+            value = self._fs_aggregate_collection('sum', FSM_COUNTER_FIELD, parent_doc_path=counter_path,
+                                                  lookup_collection=FSM_COUNTER_SHARDS_COLLECTION)
+            if value is not None:
+                self.__counter_values.put(counter_path, value)
+        return value
+
+    # Deletes the shards of a counter
+    @fs_instrumented
+    def fs_counter_delete(self, counter_id, parent_doc_path=None) -> bool:
+        result = False
+        # Firestore Operation
+        try:
+            counter_ref = self._fs_counter_ref(counter_id, parent_doc_path)
+            stats = self._fs_delete_query(counter_ref.collection(FSM_COUNTER_SHARDS_COLLECTION))
+            self.__counter_values.invalidate(counter_ref.path)
+            result = stats['failed'] == 0
+        except Exception as e:
+            self._fs_log_error(e, self.fs_counter_delete)
+            result = False
+        return result
+
+    # Deletes all the current objects in a collection
+    # By design Firestore collection maps to derived class name dynamically
+    # recursive: documents in subcollections of the collection documents, at any depth, are deleted too
+    # Documents are read in pages and deleted with batched writes of at most batch_size documents,
+    # up to max_workers batches committed concurrently
+    # progress_callback: optional function called with a statistics dictionary after every committed batch
+    #   {'deleted': documents deleted, 'failed': documents not deleted, 'elapsed': seconds,
+    #    'docs_per_second': throughput}
+    @fs_instrumented
+    def fs_delete_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None, write_mode=None,
+                             recursive=True, batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS,
+                             progress_callback=None):
+        result = False
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        # Lookup collection provided or populated from app_object
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                col_ref = self.client.collection(col_path)
+                # A recursive query returns the collection documents and all their descendants
+                query = col_ref.recursive() if recursive else col_ref
+                stats = self._fs_delete_query(query, batch_size, max_workers, progress_callback)
+                logging.log(level=logging.INFO, msg="Deleted {} documents from {} in {:.3f}s ({:.1f} docs/s)"
+                            .format(stats['deleted'], col_path, stats['elapsed'], stats['docs_per_second']))
+                # Index lookup documents of the collection, with the entries subcollections of non unique indexes
+                for index in fs_collection_indexes(col_path).values():
+                    index_path = index.index_path(col_path)
+                    index_stats = self._fs_delete_query(self.client.collection(index_path).recursive(), batch_size,
+                                                        max_workers)
+                    stats['failed'] += index_stats['failed']
+                    self._fs_cache_invalidate(fs_collection_path=index_path)
                 # Collection deletion fails is at least one document is not deleted
-                one_non_deleted = False
-                for fs_doc in fs_docs:
-                    fs_doc.reference.delete()
-                    one_non_deleted = one_non_deleted or fs_doc.reference.get().exists
-                result = not one_non_deleted
+                result = stats['failed'] == 0
+                if result and self._fs_write_mode(write_mode) == FSM_WRITE_STRICT:
+                    # Verify deletion reading the collection again
+                    result = len(list(query.limit(1).stream(**self._fs_retry()))) == 0
             except Exception as e:
-                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}"
-                            .format(e.__class__, e, self.fs_delete_collection.__name__))
+                self._fs_log_error(e, self.fs_delete_collection)
                 result = False
+            self._fs_cache_invalidate(fs_collection_path=col_path)
         return result
 
+    # Deletes every document returned by query
+    # Pages of batch_size * max_workers documents (document ids only) are read while the previous pages are being
+    # deleted, with at most max_workers batched writes in flight
+    # Returns the deletion statistics
+    def _fs_delete_query(self, query, batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_BATCH_MAX_WORKERS,
+                         progress_callback=None) -> dict:
+        batch_size = max(1, min(batch_size, FS_MAX_BATCH_SIZE))
+        max_workers = max(1, max_workers)
+        stats = {'deleted': 0, 'failed': 0, 'elapsed': 0.0, 'docs_per_second': 0.0}
+        start = time.monotonic()
+
+        def delete_chunk(fs_doc_refs):
+            batch = self._fs_batch()
+            for fs_doc_ref in fs_doc_refs:
+                batch.delete(fs_doc_ref)
+            # Deletes without preconditions are idempotent
+            batch.commit(**self._fs_retry())
+
+        def collect(done):
+            for future in done:
+                chunk_size = futures[future]
+                try:
+                    future.result()
+                    stats['deleted'] += chunk_size
+                except Exception as e:
+                    self._fs_log_error(e, self.fs_delete_collection)
+                    stats['failed'] += chunk_size
+                del futures[future]
+                stats['elapsed'] = time.monotonic() - start
+                stats['docs_per_second'] = stats['deleted'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+                if progress_callback is not None:
+                    progress_callback(dict(stats))
+
+        delete_chunk = fs_bind_operation(delete_chunk)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            query = query.select([FieldPath.document_id()])
+            for page in self._fs_iter_page_lists(query, page_size=batch_size * max_workers,
+                                                 retry_kwargs=self._fs_retry()):
+                for i in range(0, len(page), batch_size):
+                    if len(futures) >= max_workers:
+                        done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    chunk = [fs_doc.reference for fs_doc in page[i:i + batch_size]]
+                    futures[executor.submit(delete_chunk, chunk)] = len(chunk)
+            collect(wait(futures).done)
+        stats['elapsed'] = time.monotonic() - start
+        return stats
+
     # Validates whether an app can be integrated with gbq_manager
     @staticmethod
     def validate_app(app) -> bool:
@@ -337,3 +2161,7 @@ class GFSManager:
                                      (app.config['FSM_SA_KEY_JSON_FILE'] != ""
                                       and os.path.isfile(app.config['FSM_SA_KEY_JSON_FILE']))
         return validation
+
+
+# asyncio manager, imported last as it builds on GFSManager
+from gfs_manager.async_manager import AsyncGFSManager  # noqa: E402
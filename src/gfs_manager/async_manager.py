@@ -0,0 +1,1030 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud import firestore
+from google.cloud.firestore_v1.async_batch import AsyncWriteBatch
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from gfs_manager import GFSManager, _PreconditionSetBatch, FS_MAX_BATCH_SIZE, FS_QUERY_PAGE_SIZE, \
+    FSM_BACKEND_MEMORY, FSM_WRITE_MODES, FSM_WRITE_PRECONDITION, FSM_WRITE_STRICT
+from gfs_manager.cache import DocumentCache, QueryCache, FSM_CACHE_MAX_BYTES, FSM_CACHE_MAX_ENTRIES, \
+    FSM_QUERY_CACHE_MAX_BYTES, FSM_QUERY_CACHE_MAX_ENTRIES
+from gfs_manager.counters import CounterValues, fs_counter_shard, FSM_COUNTER_FIELD, FSM_COUNTER_SHARDS, \
+    FSM_COUNTER_SHARDS_COLLECTION, FSM_COUNTERS_COLLECTION
+from gfs_manager.indexes import SecondaryIndex, fs_collection_indexes, fs_index_check, fs_index_write, \
+    FSM_INDEX_DELETE, FSM_INDEX_MERGE, FSM_INDEX_SET, FSM_INDEX_UPDATE
+from gfs_manager.instrumentation import MetricsInstrumentation, fs_instrument_client, fs_instrumented, \
+    fs_record_error
+from gfs_manager.memory_backend import AsyncMemoryClient
+from gfs_manager.models import Model, fs_model_schema
+from gfs_manager.retry import RetryPolicy, fs_retry_kwargs
+from gfs_manager.transactions import AsyncFSTransactional, ContentionStats, FSM_TRANSACTION_MAX_ATTEMPTS
+
+# Default number of batched writes in flight for async bulk operations
+FS_ASYNC_MAX_CONCURRENCY = 16
+
+
+class GFSAsyncWriteBatch(_PreconditionSetBatch, AsyncWriteBatch):
+    pass
+
+
+# Google Firestore asyncio manager class
+# Same configuration, path conventions and methods as GFSManager, backed by firestore.AsyncClient
+# Methods performing Firestore operations are coroutines, query iterators are async generators
+# Example (FastAPI):
+#   fsm = AsyncGFSManager()
+#   @app.on_event('startup')
+#   async def startup():
+#       await fsm.init_app(app)
+class AsyncGFSManager:
+    def __init__(self):
+        self.__path_prefix = None
+        self.__fs_client = None
+        self.__write_mode = FSM_WRITE_PRECONDITION
+        self.__cache = None
+        self.__query_cache = None
+        self.__instrumentation = None
+        self.__retry_policy = RetryPolicy()
+        self.__counter_values = CounterValues()
+        self.__contention_stats = ContentionStats()
+
+    @property
+    def path_prefix(self):
+        return self.__path_prefix
+
+    @property
+    def write_mode(self):
+        return self.__write_mode
+
+    @property
+    def cache(self):
+        # Document cache, None if caching is disabled
+        return self.__cache
+
+    @property
+    def contention_stats(self):
+        return self.__contention_stats
+
+    def set_cache(self, cache):
+        self.__cache = cache
+
+    @property
+    def query_cache(self):
+        # Query result cache, None if caching is disabled
+        return self.__query_cache
+
+    # See GFSManager.set_query_cache, cached queries are only invalidated by the writes of the manager
+    def set_query_cache(self, query_cache):
+        self.__query_cache = query_cache
+
+    @property
+    def instrumentation(self):
+        # Operations instrumentation, None if disabled
+        return self.__instrumentation
+
+    # See GFSManager.set_instrumentation
+    def set_instrumentation(self, instrumentation):
+        self.__instrumentation = instrumentation
+        if instrumentation is not None and self.__fs_client is not None:
+            fs_instrument_client(self.__fs_client, async_client=True)
+
+    @property
+    def retry_policy(self):
+        # Retry policy of Firestore calls, None if calls are not retried
+        return self.__retry_policy
+
+    # See GFSManager.set_retry_policy
+    def set_retry_policy(self, retry_policy):
+        self.__retry_policy = retry_policy
+
+    @property
+    def client(self):
+        # Firestore async client
+        return self.__fs_client
+
+    # Validates whether an app can be integrated with the manager, see GFSManager.validate_app
+    validate_app = staticmethod(GFSManager.validate_app)
+    validate_properties = GFSManager.validate_properties
+    _fs_build_query = staticmethod(GFSManager._fs_build_query)
+    _fs_log_error = GFSManager._fs_log_error
+    _fs_config_retry_policy = staticmethod(GFSManager._fs_config_retry_policy)
+
+    async def init_app(self, app):
+        # Creates a firestore async client per application instance
+        # Using credentials from service account file
+        # Service Account role: access to Firestore for read/write
+        if self.validate_app(app):
+            self.__write_mode = app.config.get('FSM_WRITE_MODE') or FSM_WRITE_PRECONDITION
+            if app.config.get('FSM_CACHE_TTL'):
+                self.__cache = DocumentCache(
+                    max_entries=app.config.get('FSM_CACHE_MAX_ENTRIES') or FSM_CACHE_MAX_ENTRIES,
+                    max_bytes=app.config.get('FSM_CACHE_MAX_BYTES') or FSM_CACHE_MAX_BYTES,
+                    ttl=app.config['FSM_CACHE_TTL'])
+            if app.config.get('FSM_QUERY_CACHE_TTL'):
+                self.__query_cache = QueryCache(
+                    max_entries=app.config.get('FSM_QUERY_CACHE_MAX_ENTRIES') or FSM_QUERY_CACHE_MAX_ENTRIES,
+                    max_bytes=app.config.get('FSM_QUERY_CACHE_MAX_BYTES') or FSM_QUERY_CACHE_MAX_BYTES,
+                    ttl=app.config['FSM_QUERY_CACHE_TTL'])
+            if app.config.get('FSM_METRICS'):
+                self.__instrumentation = MetricsInstrumentation()
+            self.__retry_policy = self._fs_config_retry_policy(app.config)
+            # Release the client of a previous initialization
+            self.close_connection()
+            sa_creds_json_file = app.config['FSM_SA_KEY_JSON_FILE']
+            # Optional Google Cloud project, by default project from credentials
+            project = app.config.get('FSM_PROJECT')
+            kwargs = {'project': project} if project is not None else {}
+            # Optional backend, Firestore by default
+            client_class = AsyncMemoryClient if app.config.get('FSM_BACKEND') == FSM_BACKEND_MEMORY \
+                else firestore.AsyncClient
+            try:
+                if sa_creds_json_file == "":
+                    # Default Google Cloud application credentials
+                    self.__fs_client = client_class(**kwargs)
+                else:
+                    # Credential from file
+                    self.__fs_client = client_class.from_service_account_json(sa_creds_json_file, **kwargs)
+            except Exception as e:
+                self._fs_log_error(e, self.init_app)
+
+            if self.__fs_client is not None and self.__instrumentation is not None:
+                fs_instrument_client(self.__fs_client, async_client=True)
+
+            if self.__fs_client is not None:
+                # Dictionary with app details, versioning, owner, etc.
+                app_data = app.config['FSM_APP_INFO_DATA']
+                # Firestore operation
+                try:
+                    app_doc_ref = self.__fs_client.collection(app.config['FSM_APP_ROOT']).document(
+                        app.config['FSM_APP_OBJECTS_PATH'])
+                    if not (await app_doc_ref.get(**self._fs_retry())).exists:
+                        # Create Firestore document in collection apps at FSM_APP_OBJECTS_PATH from app config class
+                        await app_doc_ref.set(app_data, **self._fs_retry())
+                    self.__path_prefix = app.config['FSM_APP_ROOT'] + '/' + app.config['FSM_APP_OBJECTS_PATH']
+                except Exception as e:
+                    self._fs_log_error(e, self.init_app)
+
+    def initialized(self) -> bool:
+        return self.client is not None \
+               and isinstance(self.client, firestore.AsyncClient) \
+               and self.__path_prefix is not None
+
+    def close_connection(self):
+        if self.__fs_client is not None:
+            self.__fs_client.close()
+            self.__fs_client = None
+
+    def _fs_batch(self):
+        return GFSAsyncWriteBatch(self.client)
+
+    # See GFSManager._fs_retry
+    def _fs_retry(self, idempotent=True) -> dict:
+        return fs_retry_kwargs(self.__retry_policy, idempotent, async_call=True)
+
+    def _fs_write_mode(self, write_mode=None):
+        return write_mode if write_mode in FSM_WRITE_MODES else self.__write_mode
+
+    def _fs_write_option(self, fs_last_update_time=None):
+        if fs_last_update_time is not None:
+            return self.client.write_option(last_update_time=fs_last_update_time)
+        return self.client.write_option(exists=True)
+
+    def _fs_collection_path(self, app_object=None, parent_doc_path=None, lookup_collection=None):
+        col_path = None
+        if lookup_collection is None:
+            if app_object is not None:
+                lookup_collection = app_object.__class__.__name__
+        if lookup_collection is not None:
+            if parent_doc_path is not None:
+                col_path = parent_doc_path + '/' + lookup_collection
+            else:
+                col_path = self.__path_prefix + '/' + lookup_collection
+        return col_path
+
+    def _fs_cache_invalidate(self, fs_doc_path=None, fs_collection_path=None):
+        if self.__cache is not None:
+            if fs_doc_path is not None:
+                self.__cache.invalidate(fs_doc_path)
+            if fs_collection_path is not None:
+                self.__cache.invalidate_prefix(fs_collection_path + '/')
+        if self.__query_cache is not None:
+            if fs_doc_path is not None:
+                self.__query_cache.invalidate(fs_doc_path.rpartition('/')[0])
+            if fs_collection_path is not None:
+                self.__query_cache.invalidate(fs_collection_path)
+                self.__query_cache.invalidate_prefix(fs_collection_path + '/')
+
+    def _fs_query_cache_invalidate(self, col_path):
+        if self.__query_cache is not None:
+            self.__query_cache.invalidate(col_path)
+
+    # See GFSManager._fs_cached_query
+    async def _fs_cached_query(self, query, key, use_cache=True) -> list:
+        cache = self.__query_cache if use_cache else None
+        if cache is None:
+            return [doc async for doc in query.stream(**self._fs_retry())]
+        results = cache.get(key)
+        if results is None:
+            token = cache.begin(key)
+            try:
+                results = [doc async for doc in query.stream(**self._fs_retry())]
+            finally:
+                cache.put(key, results, token)
+        return results
+
+    # See GFSManager._fs_indexed_write
+    async def _fs_indexed_write(self, fs_doc_ref, indexes, operation, properties=None, increments=None, exists=False,
+                                fs_last_update_time=None):
+        client = self.client
+
+        async def indexed_write(transaction):
+            fs_doc = await fs_doc_ref.get(transaction=transaction, **self._fs_retry())
+            fs_index_check(fs_doc, exists, fs_last_update_time)
+            fs_index_write(transaction, client, fs_doc_ref, indexes, operation, fs_doc.to_dict(), properties,
+                           increments)
+
+        transactional = AsyncFSTransactional(indexed_write)
+        try:
+            await transactional(client.transaction())
+        finally:
+            self.__contention_stats.record(fs_doc_ref.path, transactional.attempts, transactional.aborted)
+        return transactional.write_results[0]
+
+    async def _fs_existing_paths(self, fs_doc_refs) -> set:
+        if not fs_doc_refs:
+            return set()
+        return set([fs_doc.reference.path async for fs_doc in self.client.get_all(fs_doc_refs, **self._fs_retry())
+                    if fs_doc.exists])
+
+    async def _fs_cached_get(self, fs_doc_ref, use_cache=True):
+        cache = self.__cache if use_cache else None
+        if cache is not None:
+            fs_doc = cache.get(fs_doc_ref.path)
+            if fs_doc is not None:
+                return fs_doc
+        fs_doc = await fs_doc_ref.get(**self._fs_retry())
+        if not fs_doc.exists:
+            return None
+        if cache is not None:
+            cache.put(fs_doc_ref.path, fs_doc)
+        return fs_doc
+
+    @fs_instrumented
+    async def fs_doc_store(self, app_object, doc_properties, fs_collection_path=None, *args, **kwargs):
+        fs_id = None
+        fs_stored_time = None
+        fs_path = None
+        result = False
+        if fs_collection_path is None:
+            fs_collection_path = self.path_prefix + '/' + app_object.__class__.__name__
+        if self.validate_properties(doc_properties=doc_properties):
+            try:
+                # Document id generated client side, see GFSManager.fs_doc_store
+                fs_stored_object = self.client.collection(fs_collection_path).document()
+                indexes = fs_collection_indexes(fs_collection_path)
+                if indexes:
+                    batch = self._fs_batch()
+                    batch.set(fs_stored_object, doc_properties)
+                    for index in indexes.values():
+                        index.writes(batch, self.client, fs_stored_object.path, None, doc_properties)
+                    fs_stored_time = (await batch.commit(**self._fs_retry(
+                        not any(index.unique for index in indexes.values()))))[0].update_time
+                else:
+                    fs_stored_time = (await fs_stored_object.set(doc_properties, **self._fs_retry())).update_time
+                fs_id = fs_stored_object.id
+                fs_path = fs_stored_object.path
+                result = True
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_store)
+                result = False
+            self._fs_query_cache_invalidate(fs_collection_path)
+        return fs_stored_time, fs_id, fs_path, result
+
+    @fs_instrumented
+    async def fs_doc_update(self, fs_id, doc_properties, fs_collection_path=None, fs_last_update_time=None,
+                            write_mode=None, *args, **kwargs):
+        fs_stored_time = None
+        fs_path = None
+        result = False
+        if self.validate_properties(doc_properties=doc_properties):
+            try:
+                fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
+                indexes = fs_collection_indexes(fs_collection_path)
+                if indexes:
+                    fs_stored_time = (await self._fs_indexed_write(fs_doc_ref, indexes, FSM_INDEX_SET, doc_properties,
+                                                                   exists=True,
+                                                                   fs_last_update_time=fs_last_update_time)
+                                      ).update_time
+                    fs_path = fs_doc_ref.path
+                    result = True
+                else:
+                    option = self._fs_write_option(fs_last_update_time)
+                    if self._fs_write_mode(write_mode) == FSM_WRITE_STRICT:
+                        # Read before writing
+                        if not (await fs_doc_ref.get(**self._fs_retry())).exists:
+                            fs_doc_ref = None
+                        elif fs_last_update_time is None:
+                            option = None
+                    if fs_doc_ref is not None:
+                        batch = self._fs_batch()
+                        batch.set(fs_doc_ref, doc_properties, option=option)
+                        fs_write_result = (await batch.commit(**self._fs_retry(fs_last_update_time is None)))[0]
+                        fs_stored_time = fs_write_result.update_time
+                        fs_path = fs_doc_ref.path
+                        result = True
+            except (NotFound, FailedPrecondition):
+                # Non existent document or precondition not met
+                result = False
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_update)
+                result = False
+            if fs_collection_path is not None:
+                self._fs_cache_invalidate(fs_doc_path=fs_collection_path + '/' + fs_id)
+        return fs_stored_time, fs_id, fs_path, result
+
+    # Merge of properties and increments, see GFSManager.fs_doc_merge
+    # Writes are not buffered: write coalescing runs in a background thread and is only supported by GFSManager
+    @fs_instrumented
+    async def fs_doc_merge(self, fs_id, doc_properties=None, fs_collection_path=None, increments=None, *args,
+                           **kwargs):
+        fs_stored_time = None
+        fs_path = None
+        result = False
+        if doc_properties is None or self.validate_properties(doc_properties=doc_properties):
+            try:
+                fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
+                indexes = fs_collection_indexes(fs_collection_path)
+                if indexes:
+                    fs_stored_time = (await self._fs_indexed_write(fs_doc_ref, indexes, FSM_INDEX_MERGE, doc_properties,
+                                                                   increments)).update_time
+                else:
+                    data = dict(doc_properties or {})
+                    for name, amount in (increments or {}).items():
+                        data[name] = firestore.Increment(amount)
+                    fs_stored_time = (await fs_doc_ref.set(data, merge=True, **self._fs_retry(not increments))
+                                      ).update_time
+                self._fs_cache_invalidate(fs_doc_path=fs_doc_ref.path)
+                fs_path = fs_doc_ref.path
+                result = True
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_merge)
+                result = False
+        return fs_stored_time, fs_id, fs_path, result
+
+    # fn is a coroutine function: await fn(transaction, *args)
+    @fs_instrumented
+    async def fs_transaction(self, fn, *args, max_attempts=FSM_TRANSACTION_MAX_ATTEMPTS, name=None):
+        value = None
+        result = False
+        transactional = AsyncFSTransactional(fn)
+        # Firestore Operation
+        try:
+            value = await transactional(self.client.transaction(max_attempts=max_attempts), *args)
+            result = True
+        except Exception as e:
+            self._fs_log_error(e, self.fs_transaction)
+            value = None
+        self.__contention_stats.record(name or fn.__name__, transactional.attempts, transactional.aborted)
+        for fs_doc_path in transactional.write_paths:
+            self._fs_cache_invalidate(fs_doc_path=fs_doc_path)
+        return value, result
+
+    # transform is a function, not a coroutine function
+    @fs_instrumented
+    async def fs_doc_transform(self, fs_id, transform=None, fs_collection_path=None, field_transforms=None,
+                               max_attempts=FSM_TRANSACTION_MAX_ATTEMPTS, *args, **kwargs):
+        fs_updated_time = None
+        fs_path = None
+        result = False
+        # Invalid collection paths or ids fail as the other writes do
+        try:
+            fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
+        except Exception as e:
+            self._fs_log_error(e, self.fs_doc_transform)
+            return fs_updated_time, fs_id, fs_path, result
+        if transform is None:
+            if field_transforms:
+                # Firestore Operation
+                try:
+                    fs_updated_time = (await fs_doc_ref.update(field_transforms, **self._fs_retry(False))
+                                       ).update_time
+                    fs_path = fs_doc_ref.path
+                    result = True
+                except NotFound:
+                    result = False
+                except Exception as e:
+                    self._fs_log_error(e, self.fs_doc_transform)
+                    result = False
+        else:
+            async def read_modify_write(transaction):
+                fs_doc = await fs_doc_ref.get(transaction=transaction, **self._fs_retry())
+                properties = transform(fs_doc.to_dict() if fs_doc.exists else None)
+                if properties is not None:
+                    transaction.set(fs_doc_ref, properties)
+                    if field_transforms:
+                        transaction.update(fs_doc_ref, field_transforms)
+                    return True
+                if field_transforms and fs_doc.exists:
+                    transaction.update(fs_doc_ref, field_transforms)
+                return fs_doc.exists
+
+            transactional = AsyncFSTransactional(read_modify_write)
+            # Firestore Operation
+            try:
+                result = await transactional(self.client.transaction(max_attempts=max_attempts))
+                if transactional.write_results:
+                    fs_updated_time = transactional.write_results[-1].update_time
+                fs_path = fs_doc_ref.path if result else None
+            except Exception as e:
+                self._fs_log_error(e, self.fs_doc_transform)
+                result = False
+            self.__contention_stats.record(fs_doc_ref.path, transactional.attempts, transactional.aborted)
+        self._fs_cache_invalidate(fs_doc_path=fs_doc_ref.path)
+        return fs_updated_time, fs_id, fs_path, result
+
+    @fs_instrumented
+    async def fs_doc_properties(self, fs_id, fs_collection_path=None, use_cache=True, *args, **kwargs) -> dict:
+        fs_doc_properties = None
+        fs_doc_ref = self.client.collection(fs_collection_path).document(document_id=fs_id)
+        fs_doc_snapshot = await self._fs_cached_get(fs_doc_ref, use_cache)
+        if fs_doc_snapshot is not None:
+            fs_doc_properties = fs_doc_snapshot.to_dict()
+        return fs_doc_properties
+
+    @fs_instrumented
+    async def fs_doc_exist(self, fs_doc_path) -> bool:
+        return (await self.client.document(fs_doc_path).get(**self._fs_retry())).exists
+
+    @fs_instrumented
+    async def fs_doc_delete(self, fs_id, fs_path, fs_last_update_time=None, write_mode=None):
+        result = False
+        fs_deleted_time = None
+        if fs_id is not None:
+            doc = self.client.document(fs_path)
+            if doc.id == fs_id:
+                try:
+                    indexes = fs_collection_indexes(doc.path.rpartition('/')[0])
+                    if indexes:
+                        await self._fs_indexed_write(doc, indexes, FSM_INDEX_DELETE, exists=True,
+                                                     fs_last_update_time=fs_last_update_time)
+                        result = True
+                    elif self._fs_write_mode(write_mode) == FSM_WRITE_STRICT:
+                        if (await doc.get(**self._fs_retry())).exists:
+                            option = self._fs_write_option(fs_last_update_time) \
+                                if fs_last_update_time is not None else None
+                            fs_deleted_time = await doc.delete(option=option, **self._fs_retry(option is None))
+                            result = not (await doc.get(**self._fs_retry())).exists
+                    else:
+                        # Firestore checks the document exists when committing the delete, not retried
+                        fs_deleted_time = await doc.delete(option=self._fs_write_option(fs_last_update_time),
+                                                           **self._fs_retry(False))
+                        result = True
+                except (NotFound, FailedPrecondition):
+                    # Non existent document or precondition not met
+                    fs_deleted_time = None
+                    result = False
+                self._fs_cache_invalidate(fs_doc_path=doc.path)
+        return fs_deleted_time, fs_id, fs_path, result
+
+    @fs_instrumented
+    async def fs_query_by_id(self, lookup_id, app_object=None, parent_doc_path=None, lookup_collection=None,
+                             use_cache=True) -> DocumentSnapshot:
+        result = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                fs_doc_ref = self.client.collection(col_path).document(document_id=lookup_id)
+                result = await self._fs_cached_get(fs_doc_ref, use_cache)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_query_by_id)
+                result = None
+        return result
+
+    @fs_instrumented
+    async def fs_query(self, app_object=None, parent_doc_path=None, lookup_collection=None, lookup_properties=None,
+                       filters=None, order_by=None, limit=None, offset=None, select=None, use_cache=True) -> list:
+        results = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties,
+                                             filters=filters, order_by=order_by, limit=limit, offset=offset,
+                                             select=select)
+                key = QueryCache.key(col_path, lookup_properties=lookup_properties, filters=filters,
+                                     order_by=order_by, limit=limit, offset=offset, select=select)
+                results = await self._fs_cached_query(query, key, use_cache)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_query)
+                results = None
+        return results
+
+    @fs_instrumented
+    async def fs_query_by_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None,
+                                     use_cache=True) -> list:
+        return await self.fs_query(app_object=app_object, parent_doc_path=parent_doc_path,
+                                   lookup_collection=lookup_collection, use_cache=use_cache)
+
+    @fs_instrumented
+    async def fs_query_by_properties(self, lookup_properties, app_object=None, parent_doc_path=None,
+                                     lookup_collection=None, use_cache=True) -> list:
+        return await self.fs_query(app_object=app_object, parent_doc_path=parent_doc_path,
+                                   lookup_collection=lookup_collection, lookup_properties=lookup_properties,
+                                   use_cache=use_cache)
+
+    # Async generator of lists of at most page_size document snapshots of query, see GFSManager._fs_iter_page_lists
+    @staticmethod
+    async def _fs_iter_page_lists(query, page_size=FS_QUERY_PAGE_SIZE, start_after_id=None, retry_kwargs=None):
+        if not any(order.field.field_path == FieldPath.document_id() for order in getattr(query, '_orders', ())):
+            query = query.order_by(FieldPath.document_id())
+        cursor = {FieldPath.document_id(): start_after_id} if start_after_id is not None else None
+        page_size = max(1, page_size)
+        while True:
+            page_query = query.limit(page_size)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+            page = [doc async for doc in page_query.stream(**(retry_kwargs or {}))]
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+            cursor = {FieldPath.document_id(): page[-1].reference}
+
+    async def _fs_iter_query(self, method_name, col_path, lookup_properties, page_size, start_after_id):
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties)
+                async for page in self._fs_iter_page_lists(query, page_size, start_after_id, self._fs_retry()):
+                    for doc in page:
+                        yield doc
+            except Exception as e:
+                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}".format(e.__class__, e, method_name))
+                fs_record_error(e)
+
+    # Async generator variants of fs_query_by_collection and fs_query_by_properties, see GFSManager
+    # async for doc in fsm.fs_iter_query_by_collection(app_object=user, page_size=200): ...
+    @fs_instrumented
+    async def fs_iter_query_by_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None,
+                                          page_size=FS_QUERY_PAGE_SIZE, start_after_id=None) \
+            -> AsyncIterator[DocumentSnapshot]:
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        async for doc in self._fs_iter_query(self.fs_iter_query_by_collection.__name__, col_path, None, page_size,
+                                             start_after_id):
+            yield doc
+
+    @fs_instrumented
+    async def fs_iter_query_by_properties(self, lookup_properties, app_object=None, parent_doc_path=None,
+                                          lookup_collection=None, page_size=FS_QUERY_PAGE_SIZE, start_after_id=None) \
+            -> AsyncIterator[DocumentSnapshot]:
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        async for doc in self._fs_iter_query(self.fs_iter_query_by_properties.__name__, col_path, lookup_properties,
+                                             page_size, start_after_id):
+            yield doc
+
+    # Secondary indexes, see GFSManager.fs_index_lookup and gfs_manager.indexes
+    @fs_instrumented
+    async def fs_index_lookup(self, field, value, app_object=None, parent_doc_path=None, lookup_collection=None) \
+            -> list:
+        results = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        index = fs_collection_indexes(col_path).get(field)
+        key = SecondaryIndex.key(value)
+        if index is not None and key is not None:
+            try:
+                if index.unique:
+                    fs_doc = await self.client.document(index.value_path(col_path, key)).get(**self._fs_retry())
+                    results = [fs_doc.to_dict()] if fs_doc.exists else []
+                else:
+                    results = [fs_doc.to_dict() async for fs_doc in
+                               self.client.collection(index.value_path(col_path, key)).stream(**self._fs_retry())]
+            except Exception as e:
+                self._fs_log_error(e, self.fs_index_lookup)
+                results = None
+        return results
+
+    @fs_instrumented
+    async def fs_query_by_index(self, field, value, app_object=None, parent_doc_path=None, lookup_collection=None) \
+            -> list:
+        results = None
+        entries = await self.fs_index_lookup(field, value, app_object, parent_doc_path, lookup_collection)
+        if entries is not None:
+            try:
+                fs_doc_refs = [self.client.document(entry['fs_path']) for entry in entries]
+                fs_docs = {fs_doc.reference.path: fs_doc async for fs_doc in
+                           self.client.get_all(fs_doc_refs, **self._fs_retry()) if fs_doc.exists}
+                results = [fs_docs[entry['fs_path']] for entry in entries if entry['fs_path'] in fs_docs]
+            except Exception as e:
+                self._fs_log_error(e, self.fs_query_by_index)
+                results = None
+        return results
+
+    # Typed models, see GFSManager.fs_model_store and gfs_manager.models
+    @fs_instrumented
+    async def fs_model_store(self, model, parent_doc_path=None):
+        schema = fs_model_schema(model.__class__)
+        doc_properties = schema.encode(model)
+        col_path = self._fs_collection_path(parent_doc_path=parent_doc_path, lookup_collection=schema.collection)
+        fs_stored_time, fs_id, fs_path, result = await self.fs_doc_store(model, doc_properties,
+                                                                         fs_collection_path=col_path)
+        if result:
+            schema.written(model, doc_properties, fs_id, fs_path, fs_stored_time)
+        return fs_stored_time, fs_id, fs_path, result
+
+    @fs_instrumented
+    async def fs_model_update(self, model, fs_last_update_time=None):
+        fs_updated_time = None
+        result = False
+        fs_id = model.fs_id
+        fs_path = model.fs_path
+        if fs_path is not None:
+            schema = fs_model_schema(model.__class__)
+            changes = schema.changes(model)
+            if not changes:
+                return model.fs_update_time, fs_id, fs_path, True
+            try:
+                fs_doc_ref = self.client.document(fs_path)
+                indexes = fs_collection_indexes(fs_path.rpartition('/')[0])
+                if indexes:
+                    fs_updated_time = (await self._fs_indexed_write(fs_doc_ref, indexes, FSM_INDEX_UPDATE, changes,
+                                                                    exists=True,
+                                                                    fs_last_update_time=fs_last_update_time)
+                                       ).update_time
+                else:
+                    option = self._fs_write_option(fs_last_update_time) if fs_last_update_time is not None else None
+                    fs_updated_time = (await fs_doc_ref.update(
+                        changes, option=option, **self._fs_retry(fs_last_update_time is None))).update_time
+                schema.written(model, {**model._fs_loaded, **changes}, fs_id, fs_path, fs_updated_time)
+                result = True
+            except (NotFound, FailedPrecondition):
+                # Non existent document or precondition not met
+                result = False
+            except Exception as e:
+                self._fs_log_error(e, self.fs_model_update)
+                result = False
+            self._fs_cache_invalidate(fs_doc_path=fs_path)
+        return fs_updated_time, fs_id, fs_path, result
+
+    @fs_instrumented
+    async def fs_model_get(self, model_class, fs_id, parent_doc_path=None, use_cache=True) -> Model:
+        schema = fs_model_schema(model_class)
+        fs_doc = await self.fs_query_by_id(fs_id, parent_doc_path=parent_doc_path,
+                                           lookup_collection=schema.collection, use_cache=use_cache)
+        return schema.from_snapshot(fs_doc)
+
+    @fs_instrumented
+    async def fs_query_models(self, model_class, parent_doc_path=None, lookup_properties=None, filters=None,
+                              order_by=None, limit=None, offset=None) -> list:
+        schema = fs_model_schema(model_class)
+        fs_docs = await self.fs_query(parent_doc_path=parent_doc_path, lookup_collection=schema.collection,
+                                      lookup_properties=lookup_properties, filters=filters, order_by=order_by,
+                                      limit=limit, offset=offset)
+        return [schema.from_snapshot(fs_doc) for fs_doc in fs_docs] if fs_docs is not None else None
+
+    @fs_instrumented
+    async def fs_iter_models(self, model_class, parent_doc_path=None, lookup_properties=None,
+                             page_size=FS_QUERY_PAGE_SIZE, start_after_id=None) -> AsyncIterator[Model]:
+        schema = fs_model_schema(model_class)
+        col_path = self._fs_collection_path(parent_doc_path=parent_doc_path, lookup_collection=schema.collection)
+        async for fs_doc in self._fs_iter_query(self.fs_iter_models.__name__, col_path, lookup_properties, page_size,
+                                                start_after_id):
+            yield schema.from_snapshot(fs_doc)
+
+    # Sharded counters, see GFSManager.fs_counter_increment and gfs_manager.counters
+    def _fs_counter_ref(self, counter_id, parent_doc_path=None):
+        col_path = self._fs_collection_path(parent_doc_path=parent_doc_path, lookup_collection=FSM_COUNTERS_COLLECTION)
+        return self.client.collection(col_path).document(counter_id)
+
+    @fs_instrumented
+    async def fs_counter_increment(self, counter_id, amount=1, parent_doc_path=None, num_shards=FSM_COUNTER_SHARDS):
+        fs_stored_time = None
+        fs_path = None
+        result = False
+        # Firestore Operation
+        try:
+            counter_ref = self._fs_counter_ref(counter_id, parent_doc_path)
+            shard_ref = fs_counter_shard(counter_ref, num_shards)
+            fs_stored_time = (await shard_ref.set({FSM_COUNTER_FIELD: firestore.Increment(amount)}, merge=True,
+                                                  **self._fs_retry(False))).update_time
+            self.__counter_values.add(counter_ref.path, amount)
+            fs_path = counter_ref.path
+            result = True
+        except Exception as e:
+            self._fs_log_error(e, self.fs_counter_increment)
+            result = False
+        return fs_stored_time, counter_id, fs_path, result
+
+    @fs_instrumented
+    async def fs_counter_value(self, counter_id, parent_doc_path=None, max_age=None):
+        counter_path = self._fs_counter_ref(counter_id, parent_doc_path).path
+        value = self.__counter_values.get(counter_path, max_age) if max_age is not None else None
+        if value is None:
+            value = await self._fs_aggregate_collection('sum', FSM_COUNTER_FIELD, parent_doc_path=counter_path,
+                                                        lookup_collection=FSM_COUNTER_SHARDS_COLLECTION)
+            if value is not None:
+                self.__counter_values.put(counter_path, value)
+        return value
+
+    @fs_instrumented
+    async def fs_counter_delete(self, counter_id, parent_doc_path=None) -> bool:
+        result = False
+        # Firestore Operation
+        try:
+            counter_ref = self._fs_counter_ref(counter_id, parent_doc_path)
+            stats = await self._fs_delete_query(counter_ref.collection(FSM_COUNTER_SHARDS_COLLECTION))
+            self.__counter_values.invalidate(counter_ref.path)
+            result = stats['failed'] == 0
+        except Exception as e:
+            self._fs_log_error(e, self.fs_counter_delete)
+            result = False
+        return result
+
+    async def _fs_aggregate_collection(self, aggregation, field_path=None, app_object=None, parent_doc_path=None,
+                                       lookup_collection=None, lookup_properties=None, filters=None):
+        result = None
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                query = self._fs_build_query(self.client.collection(col_path), lookup_properties=lookup_properties,
+                                             filters=filters)
+                retry_kwargs = self._fs_retry()
+                if aggregation == 'count':
+                    result = (await query.count(alias=aggregation).get(**retry_kwargs))[0][0].value
+                elif hasattr(query, aggregation):
+                    result = (await getattr(query, aggregation)(field_path, alias=aggregation).get(**retry_kwargs)
+                              )[0][0].value
+                else:
+                    # Scan of the projected field only, see GFSManager._fs_aggregate
+                    values = [doc.to_dict().get(field_path)
+                              async for doc in query.select([field_path]).stream(**retry_kwargs)]
+                    values = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+                    if aggregation == 'sum':
+                        result = sum(values)
+                    else:
+                        result = sum(values) / len(values) if values else None
+            except Exception as e:
+                # Logged as an error of the public method: fs_count, fs_sum or fs_avg
+                self._fs_log_error(e, getattr(self, 'fs_' + aggregation))
+                result = None
+        return result
+
+    @fs_instrumented
+    async def fs_count(self, app_object=None, parent_doc_path=None, lookup_collection=None, lookup_properties=None,
+                       filters=None) -> int:
+        return await self._fs_aggregate_collection('count', None, app_object, parent_doc_path, lookup_collection,
+                                                   lookup_properties, filters)
+
+    @fs_instrumented
+    async def fs_sum(self, field_path, app_object=None, parent_doc_path=None, lookup_collection=None,
+                     lookup_properties=None, filters=None):
+        return await self._fs_aggregate_collection('sum', field_path, app_object, parent_doc_path,
+                                                   lookup_collection, lookup_properties, filters)
+
+    @fs_instrumented
+    async def fs_avg(self, field_path, app_object=None, parent_doc_path=None, lookup_collection=None,
+                     lookup_properties=None, filters=None):
+        return await self._fs_aggregate_collection('avg', field_path, app_object, parent_doc_path,
+                                                   lookup_collection, lookup_properties, filters)
+
+    # Splits items in chunks of at most batch_size elements, and awaits chunk_worker(chunk) for every chunk
+    # At most max_workers chunks are in flight at a time
+    # Returns the concatenation of every chunk_worker result, in the same order as items
+    @staticmethod
+    async def _fs_run_chunks(items, chunk_worker, batch_size=FS_MAX_BATCH_SIZE,
+                             max_workers=FS_ASYNC_MAX_CONCURRENCY) -> list:
+        batch_size = max(1, min(batch_size, FS_MAX_BATCH_SIZE))
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def run_chunk(chunk):
+            async with semaphore:
+                return await chunk_worker(chunk)
+
+        chunks = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+        results = []
+        for chunk_results in await asyncio.gather(*[run_chunk(chunk) for chunk in chunks]):
+            results.extend(chunk_results)
+        return results
+
+    # See GFSManager._fs_commit_existing
+    async def _fs_commit_existing(self, writes, write_op, write_mode=None):
+        strict = self._fs_write_mode(write_mode) == FSM_WRITE_STRICT
+        if strict:
+            existing = await self._fs_existing_paths([fs_doc_ref for i, fs_doc_ref, data in writes])
+            writes = [w for w in writes if w[1].path in existing]
+        for attempt in range(0, 2):
+            if not writes:
+                return writes, []
+            batch = self._fs_batch()
+            option = None if strict else self.client.write_option(exists=True)
+            for i, fs_doc_ref, data in writes:
+                if write_op == 'set':
+                    batch.set(fs_doc_ref, data, option=option)
+                else:
+                    batch.delete(fs_doc_ref, option=option)
+            try:
+                fs_write_results = await batch.commit(**self._fs_retry(write_op == 'set' or strict))
+                if write_op == 'delete':
+                    fs_write_results = [batch.commit_time] * len(writes)
+                else:
+                    fs_write_results = [fs_write_result.update_time for fs_write_result in fs_write_results]
+                return writes, fs_write_results
+            except (NotFound, FailedPrecondition):
+                if strict or attempt > 0:
+                    raise
+                existing = await self._fs_existing_paths([fs_doc_ref for i, fs_doc_ref, data in writes])
+                writes = [w for w in writes if w[1].path in existing]
+        return [], []
+
+    # Bulk operations, see GFSManager fs_docs_store_many, fs_docs_update_many and fs_docs_delete_many
+    # Batched writes are committed concurrently on the event loop, up to max_workers at a time
+    @fs_instrumented
+    async def fs_docs_store_many(self, app_object, docs_properties, fs_collection_path=None,
+                                 batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_ASYNC_MAX_CONCURRENCY,
+                                 *args, **kwargs) -> list:
+        if fs_collection_path is None:
+            fs_collection_path = self.path_prefix + '/' + app_object.__class__.__name__
+        indexes = fs_collection_indexes(fs_collection_path)
+        batch_size = min(batch_size, FS_MAX_BATCH_SIZE // (1 + len(indexes)))
+
+        async def store_chunk(chunk):
+            chunk_results = [(None, None, None, False)] * len(chunk)
+            writes = []
+            try:
+                batch = self._fs_batch()
+                col_ref = self.client.collection(fs_collection_path)
+                for i, doc_properties in enumerate(chunk):
+                    if self.validate_properties(doc_properties=doc_properties):
+                        fs_doc_ref = col_ref.document()
+                        batch.set(fs_doc_ref, doc_properties)
+                        for index in indexes.values():
+                            index.writes(batch, self.client, fs_doc_ref.path, None, doc_properties)
+                        writes.append((i, fs_doc_ref))
+                if writes:
+                    fs_write_results = await batch.commit(**self._fs_retry(
+                        not any(index.unique for index in indexes.values())))
+                    for (i, fs_doc_ref), fs_write_result in zip(writes, fs_write_results):
+                        chunk_results[i] = (fs_write_result.update_time, fs_doc_ref.id, fs_doc_ref.path, True)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_docs_store_many)
+                chunk_results = [(None, None, None, False)] * len(chunk)
+            self._fs_query_cache_invalidate(fs_collection_path)
+            return chunk_results
+
+        return await self._fs_run_chunks(list(docs_properties), store_chunk, batch_size, max_workers)
+
+    @fs_instrumented
+    async def fs_docs_update_many(self, docs_properties, fs_collection_path=None, batch_size=FS_MAX_BATCH_SIZE,
+                                  max_workers=FS_ASYNC_MAX_CONCURRENCY, write_mode=None, *args, **kwargs) -> list:
+        async def update_chunk(chunk):
+            chunk_results = [(None, fs_id, None, False) for fs_id, doc_properties in chunk]
+            try:
+                col_ref = self.client.collection(fs_collection_path)
+                writes = [(i, col_ref.document(document_id=fs_id), doc_properties)
+                          for i, (fs_id, doc_properties) in enumerate(chunk)
+                          if self.validate_properties(doc_properties=doc_properties)]
+                writes, fs_write_times = await self._fs_commit_existing(writes, 'set', write_mode)
+                for (i, fs_doc_ref, data), fs_write_time in zip(writes, fs_write_times):
+                    chunk_results[i] = (fs_write_time, fs_doc_ref.id, fs_doc_ref.path, True)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_docs_update_many)
+                chunk_results = [(None, fs_id, None, False) for fs_id, doc_properties in chunk]
+            if fs_collection_path is not None:
+                for fs_id, doc_properties in chunk:
+                    self._fs_cache_invalidate(fs_doc_path=fs_collection_path + '/' + fs_id)
+            return chunk_results
+
+        return await self._fs_run_chunks(list(docs_properties.items()), update_chunk, batch_size, max_workers)
+
+    @fs_instrumented
+    async def fs_docs_delete_many(self, fs_docs, batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_ASYNC_MAX_CONCURRENCY,
+                                  write_mode=None, *args, **kwargs) -> list:
+        fs_docs = list(fs_docs)
+        max_indexes = max([len(fs_collection_indexes(fs_path.rpartition('/')[0]))
+                           for fs_id, fs_path in fs_docs if fs_path is not None] + [0])
+        batch_size = min(batch_size, FS_MAX_BATCH_SIZE // (1 + max_indexes))
+
+        async def delete_chunk(chunk):
+            chunk_results = [(None, fs_id, fs_path, False) for fs_id, fs_path in chunk]
+            try:
+                writes = []
+                indexed_writes = []
+                for i, (fs_id, fs_path) in enumerate(chunk):
+                    if fs_id is not None:
+                        doc = self.client.document(fs_path)
+                        if doc.id == fs_id:
+                            if fs_collection_indexes(doc.path.rpartition('/')[0]):
+                                indexed_writes.append((i, doc, None))
+                            else:
+                                writes.append((i, doc, None))
+                writes, fs_deleted_times = await self._fs_commit_existing(writes, 'delete', write_mode)
+                for (i, doc, data), fs_deleted_time in zip(writes, fs_deleted_times):
+                    fs_id, fs_path = chunk[i]
+                    chunk_results[i] = (fs_deleted_time, fs_id, fs_path, True)
+                if indexed_writes:
+                    deleted_paths, fs_deleted_time = await self._fs_delete_indexed(
+                        [doc for i, doc, data in indexed_writes])
+                    for i, doc, data in indexed_writes:
+                        if doc.path in deleted_paths:
+                            fs_id, fs_path = chunk[i]
+                            chunk_results[i] = (fs_deleted_time, fs_id, fs_path, True)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_docs_delete_many)
+                chunk_results = [(None, fs_id, fs_path, False) for fs_id, fs_path in chunk]
+            for fs_id, fs_path in chunk:
+                if fs_path is not None:
+                    self._fs_cache_invalidate(fs_doc_path=fs_path)
+            return chunk_results
+
+        return await self._fs_run_chunks(fs_docs, delete_chunk, batch_size, max_workers)
+
+    # See GFSManager._fs_delete_indexed
+    async def _fs_delete_indexed(self, fs_doc_refs):
+        client = self.client
+        for attempt in range(0, 2):
+            fs_docs = [fs_doc async for fs_doc in client.get_all(fs_doc_refs, **self._fs_retry()) if fs_doc.exists]
+            if not fs_docs:
+                break
+            batch = self._fs_batch()
+            for fs_doc in fs_docs:
+                fs_doc_path = fs_doc.reference.path
+                batch.delete(fs_doc.reference, option=client.write_option(last_update_time=fs_doc.update_time))
+                for index in fs_collection_indexes(fs_doc_path.rpartition('/')[0]).values():
+                    index.writes(batch, client, fs_doc_path, fs_doc.to_dict(), None)
+            try:
+                await batch.commit(**self._fs_retry(False))
+                return set(fs_doc.reference.path for fs_doc in fs_docs), batch.commit_time
+            except FailedPrecondition:
+                if attempt > 0:
+                    raise
+        return set(), None
+
+    # See GFSManager.fs_delete_collection
+    @fs_instrumented
+    async def fs_delete_collection(self, app_object=None, parent_doc_path=None, lookup_collection=None,
+                                   write_mode=None, recursive=True, batch_size=FS_MAX_BATCH_SIZE,
+                                   max_workers=FS_ASYNC_MAX_CONCURRENCY, progress_callback=None):
+        result = False
+        col_path = self._fs_collection_path(app_object, parent_doc_path, lookup_collection)
+        if col_path is not None:
+            # Firestore Operation
+            try:
+                col_ref = self.client.collection(col_path)
+                query = col_ref.recursive() if recursive else col_ref
+                stats = await self._fs_delete_query(query, batch_size, max_workers, progress_callback)
+                for index in fs_collection_indexes(col_path).values():
+                    index_path = index.index_path(col_path)
+                    index_stats = await self._fs_delete_query(self.client.collection(index_path).recursive(),
+                                                              batch_size, max_workers)
+                    stats['failed'] += index_stats['failed']
+                    self._fs_cache_invalidate(fs_collection_path=index_path)
+                result = stats['failed'] == 0
+                if result and self._fs_write_mode(write_mode) == FSM_WRITE_STRICT:
+                    result = len([doc async for doc in query.limit(1).stream(**self._fs_retry())]) == 0
+            except Exception as e:
+                self._fs_log_error(e, self.fs_delete_collection)
+                result = False
+            self._fs_cache_invalidate(fs_collection_path=col_path)
+        return result
+
+    async def _fs_delete_query(self, query, batch_size=FS_MAX_BATCH_SIZE, max_workers=FS_ASYNC_MAX_CONCURRENCY,
+                               progress_callback=None) -> dict:
+        batch_size = max(1, min(batch_size, FS_MAX_BATCH_SIZE))
+        max_workers = max(1, max_workers)
+        stats = {'deleted': 0, 'failed': 0, 'elapsed': 0.0, 'docs_per_second': 0.0}
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def delete_chunk(fs_doc_refs):
+            try:
+                batch = self._fs_batch()
+                for fs_doc_ref in fs_doc_refs:
+                    batch.delete(fs_doc_ref)
+                await batch.commit(**self._fs_retry())
+                stats['deleted'] += len(fs_doc_refs)
+            except Exception as e:
+                self._fs_log_error(e, self.fs_delete_collection)
+                stats['failed'] += len(fs_doc_refs)
+            finally:
+                semaphore.release()
+            stats['elapsed'] = time.monotonic() - start
+            stats['docs_per_second'] = stats['deleted'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+            if progress_callback is not None:
+                progress_callback(dict(stats))
+
+        tasks = []
+        query = query.select([FieldPath.document_id()])
+        async for page in self._fs_iter_page_lists(query, page_size=batch_size * max_workers,
+                                                   retry_kwargs=self._fs_retry()):
+            for i in range(0, len(page), batch_size):
+                # Bounded number of batched writes in flight
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(delete_chunk([doc.reference for doc in page[i:i + batch_size]])))
+        await asyncio.gather(*tasks)
+        stats['elapsed'] = time.monotonic() - start
+        return stats
@@ -0,0 +1,358 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from gfs_manager import GFSManager, FSM_BACKEND_MEMORY, FSM_BACKENDS
+from gfs_manager.instrumentation import Instrumentation
+
+# Benchmark of GFSManager operations: latency percentiles, throughput, RPCs per operation and peak memory
+# Runs against the in-memory backend (default), or Firestore: set FIRESTORE_EMULATOR_HOST to use the Firestore emulator
+# Usage: python -m gfs_manager.benchmark --sizes 100,1000 --concurrency 1,8 --output results.json
+# Compare with a previous run: python -m gfs_manager.benchmark --baseline results.json
+# Fork stress test: python -m gfs_manager.benchmark --stress 4x8
+
+# Benchmarked operations, in execution order for every collection size and concurrency level
+FSM_BENCHMARK_OPERATIONS = ['store', 'update', 'query_by_id', 'query_by_collection', 'query_by_properties', 'delete',
+                            'delete_collection']
+FSM_BENCHMARK_SIZES = [100, 1000]
+FSM_BENCHMARK_CONCURRENCY = [1, 8]
+# Number of queries run by the collection query benchmarks
+FSM_BENCHMARK_QUERIES = 20
+# Relative increase of latency (p50, p95) or decrease of throughput reported as a regression
+FSM_BENCHMARK_THRESHOLD = 0.2
+# Store and read back operations per thread of the fork stress test
+FSM_STRESS_OPERATIONS = 100
+
+
+class BenchmarkApp:
+    def __init__(self, backend=FSM_BACKEND_MEMORY, sa_key_json_file='', project=None):
+        self.config = {'FSM_SA_KEY_JSON_FILE': sa_key_json_file,
+                       'FSM_APP_ROOT': 'gfs_benchmarks',
+                       'FSM_APP_OBJECTS_PATH': 'gfs_manager_benchmark',
+                       'FSM_APP_INFO_DATA': {'description': 'GFSManager benchmark'},
+                       'FSM_BACKEND': backend,
+                       'FSM_PROJECT': project}
+
+
+# Value at percentile (0-100) of sorted values, nearest rank
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percentile // 100))
+    return sorted_values[int(rank) - 1]
+
+
+# Counts the RPCs of the manager operations, recorded by the manager instrumentation on every backend (Firestore,
+# emulator, in-memory), and forwards the hooks to the instrumentation of the manager, if any
+class _RPCCounter(Instrumentation):
+    def __init__(self, instrumentation=None):
+        self.instrumentation = instrumentation
+        self.rpc_counts = {}
+        self.__lock = threading.Lock()
+
+    def on_operation_start(self, operation):
+        if self.instrumentation is not None:
+            self.instrumentation.on_operation_start(operation)
+
+    def on_rpc(self, operation, rpc, elapsed, error=None):
+        with self.__lock:
+            self.rpc_counts[rpc] = self.rpc_counts.get(rpc, 0) + 1
+        if self.instrumentation is not None:
+            self.instrumentation.on_rpc(operation, rpc, elapsed, error)
+
+    def on_operation_end(self, operation):
+        if self.instrumentation is not None:
+            self.instrumentation.on_operation_end(operation)
+
+
+def _document(i) -> dict:
+    return {'i': i, 'name': 'doc-{}'.format(i), 'group': i % 10, 'tags': ['t{}'.format(i % 3)]}
+
+
+class Benchmark:
+    # trace_memory: measures peak memory with tracemalloc, which slows down Python code and inflates latencies
+    def __init__(self, fs: GFSManager, sizes=None, concurrency=None, operations=None, queries=FSM_BENCHMARK_QUERIES,
+                 trace_memory=True):
+        self.fs = fs
+        self.trace_memory = trace_memory
+        self.sizes = sizes or FSM_BENCHMARK_SIZES
+        self.concurrency = concurrency or FSM_BENCHMARK_CONCURRENCY
+        self.operations = operations or FSM_BENCHMARK_OPERATIONS
+        self.queries = queries
+
+    # Runs op(arg) for every arg with concurrency threads, returns the measurements of the run
+    def _measure(self, operation, size, concurrency, op, args) -> dict:
+        latencies = []
+        errors = 0
+
+        def timed(arg):
+            start = time.perf_counter()
+            ok = op(arg)
+            return time.perf_counter() - start, ok
+
+        # RPCs of the measured operations counted by the manager instrumentation
+        instrumentation = self.fs.instrumentation
+        rpc_counter = _RPCCounter(instrumentation)
+        self.fs.set_instrumentation(rpc_counter)
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            if concurrency <= 1:
+                results = [timed(arg) for arg in args]
+            else:
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    results = list(executor.map(timed, args))
+        finally:
+            self.fs.set_instrumentation(instrumentation)
+        elapsed = time.perf_counter() - start
+        peak_memory = None
+        if self.trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        for latency, ok in results:
+            latencies.append(latency)
+            errors += 0 if ok else 1
+        latencies.sort()
+        ops = len(latencies)
+        result = {'operation': operation, 'collection_size': size, 'concurrency': concurrency, 'ops': ops,
+                  'errors': errors, 'elapsed': elapsed, 'ops_per_second': ops / elapsed if elapsed else None,
+                  'latency_ms': {'p50': _percentile(latencies, 50) * 1000, 'p95': _percentile(latencies, 95) * 1000,
+                                 'p99': _percentile(latencies, 99) * 1000, 'mean': sum(latencies) / ops * 1000,
+                                 'max': latencies[-1] * 1000} if ops else None,
+                  'rpcs_per_op': None, 'peak_memory_bytes': peak_memory}
+        if ops:
+            result['rpcs_per_op'] = {rpc: count / ops for rpc, count in rpc_counter.rpc_counts.items()}
+        return result
+
+    # Runs the benchmarked operations on a new collection of size documents
+    def run_scenario(self, size, concurrency) -> list:
+        results = []
+        collection = 'Benchmark_{}_{}_{}'.format(size, concurrency, uuid.uuid4().hex[:8])
+        col_path = self.fs.path_prefix + '/' + collection
+        fs_ids = []
+
+        def store(i):
+            fs_stored_time, fs_id, fs_path, result = self.fs.fs_doc_store(None, _document(i), fs_collection_path=col_path)
+            fs_ids.append(fs_id)
+            return result
+
+        def populate():
+            # Collection documents for operations that do not create them, not measured
+            if not fs_ids:
+                stored = self.fs.fs_docs_store_many(None, [_document(i) for i in range(size)],
+                                                    fs_collection_path=col_path)
+                fs_ids.extend(fs_id for fs_stored_time, fs_id, fs_path, result in stored if result)
+
+        for operation in self.operations:
+            if operation == 'store':
+                results.append(self._measure(operation, size, concurrency, store, range(size)))
+                continue
+            populate()
+            if operation == 'update':
+                results.append(self._measure(
+                    operation, size, concurrency,
+                    lambda fs_id: self.fs.fs_doc_update(fs_id, dict(_document(0), updated=True),
+                                                        fs_collection_path=col_path)[3],
+                    list(fs_ids)))
+            elif operation == 'query_by_id':
+                results.append(self._measure(
+                    operation, size, concurrency,
+                    lambda fs_id: self.fs.fs_query_by_id(fs_id, lookup_collection=collection,
+                                                         use_cache=False) is not None,
+                    list(fs_ids)))
+            elif operation == 'query_by_collection':
+                results.append(self._measure(
+                    operation, size, concurrency,
+                    lambda i: len(self.fs.fs_query_by_collection(lookup_collection=collection)) == size,
+                    range(self.queries)))
+            elif operation == 'query_by_properties':
+                results.append(self._measure(
+                    operation, size, concurrency,
+                    lambda i: self.fs.fs_query_by_properties({'group': i % 10}, lookup_collection=collection)
+                    is not None,
+                    range(self.queries)))
+            elif operation == 'delete':
+                results.append(self._measure(
+                    operation, size, concurrency,
+                    lambda fs_id: self.fs.fs_doc_delete(fs_id, col_path + '/' + fs_id)[3],
+                    list(fs_ids)))
+                fs_ids.clear()
+            elif operation == 'delete_collection':
+                # A single operation deleting the whole collection, using the concurrency level as max workers
+                results.append(self._measure(
+                    operation, size, 1,
+                    lambda i: self.fs.fs_delete_collection(lookup_collection=collection, max_workers=concurrency),
+                    range(1)))
+                results[-1]['concurrency'] = concurrency
+                fs_ids.clear()
+        # Benchmark documents left by a partial list of operations
+        if fs_ids:
+            self.fs.fs_delete_collection(lookup_collection=collection)
+        return results
+
+    def run(self) -> dict:
+        results = []
+        for size in self.sizes:
+            for concurrency in self.concurrency:
+                results.extend(self.run_scenario(size, concurrency))
+        return {'timestamp': time.time(), 'python': platform.python_version(),
+                'client': self.fs.client.__class__.__name__, 'results': results}
+
+
+# Fork stress test: processes forked after the manager is connected (gunicorn workers with preloaded app), each
+# running threads that store documents and read them back
+# Every process must use its own client, and every document read must match the document stored
+# Returns {'processes', 'threads', 'ops', 'errors', 'mismatches', 'clients_rebuilt', 'elapsed', 'ops_per_second'}
+def run_stress(fs: GFSManager, processes=4, threads=8, operations=FSM_STRESS_OPERATIONS) -> dict:
+    collection = 'Stress_{}'.format(uuid.uuid4().hex[:8])
+    col_path = fs.path_prefix + '/' + collection
+    # Client of the parent process, inherited by the forked processes
+    parent_client = fs.client
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_stress_process, args=(fs, parent_client, col_path, threads, operations,
+                                                             results), name='gfs-manager-stress-{}'.format(i))
+               for i in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    process_results = [results.get() for worker in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    fs.fs_delete_collection(lookup_collection=collection)
+    ops = sum(r['ops'] for r in process_results)
+    return {'processes': processes, 'threads': threads, 'ops': ops,
+            'errors': sum(r['errors'] for r in process_results) + sum(1 for w in workers if w.exitcode),
+            'mismatches': sum(r['mismatches'] for r in process_results),
+            'clients_rebuilt': sum(1 for r in process_results if r['client_rebuilt']),
+            'elapsed': elapsed, 'ops_per_second': ops / elapsed if elapsed else None}
+
+
+def _stress_process(fs, parent_client, col_path, threads, operations, results):
+    counts = {'ops': 0, 'errors': 0, 'mismatches': 0}
+    lock = threading.Lock()
+
+    def run(t):
+        ops = errors = mismatches = 0
+        for i in range(operations):
+            document = {'pid': os.getpid(), 'thread': t, 'i': i}
+            fs_stored_time, fs_id, fs_path, result = fs.fs_doc_store(None, document, fs_collection_path=col_path)
+            properties = fs.fs_doc_properties(fs_id, fs_collection_path=col_path, use_cache=False) if result else None
+            ops += 2
+            errors += 0 if result else 1
+            mismatches += 0 if not result or properties == document else 1
+        with lock:
+            counts['ops'] += ops
+            counts['errors'] += errors
+            counts['mismatches'] += mismatches
+
+    client_rebuilt = False
+    # Results always sent, the parent process waits for them
+    try:
+        client_rebuilt = fs.client is not parent_client
+        workers = [threading.Thread(target=run, args=(t,)) for t in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        fs.close_connection()
+    except Exception:
+        counts['errors'] += 1
+    finally:
+        results.put(dict(counts, client_rebuilt=client_rebuilt))
+
+
+# Compares two benchmark runs, returns the regressions of current against baseline
+# A regression is a latency (p50, p95) or throughput worse than baseline by more than threshold (relative)
+def compare_results(baseline, current, threshold=FSM_BENCHMARK_THRESHOLD) -> list:
+    regressions = []
+    baseline_results = {(r['operation'], r['collection_size'], r['concurrency']): r for r in baseline['results']}
+    for r in current['results']:
+        key = (r['operation'], r['collection_size'], r['concurrency'])
+        b = baseline_results.get(key)
+        if b is None or not b['latency_ms'] or not r['latency_ms']:
+            continue
+        metrics = [('p50', b['latency_ms']['p50'], r['latency_ms']['p50'], 1),
+                   ('p95', b['latency_ms']['p95'], r['latency_ms']['p95'], 1),
+                   ('ops_per_second', b['ops_per_second'], r['ops_per_second'], -1)]
+        for metric, before, after, sign in metrics:
+            if before and after and sign * (after - before) / before > threshold:
+                regressions.append({'operation': key[0], 'collection_size': key[1], 'concurrency': key[2],
+                                    'metric': metric, 'baseline': before, 'current': after})
+    return regressions
+
+
+def _int_list(value) -> list:
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m gfs_manager.benchmark', description='GFSManager benchmark')
+    parser.add_argument('--backend', choices=FSM_BACKENDS, default=FSM_BACKEND_MEMORY)
+    parser.add_argument('--sa-key-json-file', default='', help='Service account key file, Firestore backend')
+    parser.add_argument('--project', default=None)
+    parser.add_argument('--sizes', type=_int_list, default=FSM_BENCHMARK_SIZES, help='Collection sizes, e.g. 100,1000')
+    parser.add_argument('--concurrency', type=_int_list, default=FSM_BENCHMARK_CONCURRENCY,
+                        help='Concurrency levels, e.g. 1,8')
+    parser.add_argument('--operations', type=lambda v: v.split(','), default=FSM_BENCHMARK_OPERATIONS,
+                        help=','.join(FSM_BENCHMARK_OPERATIONS))
+    parser.add_argument('--queries', type=int, default=FSM_BENCHMARK_QUERIES)
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false',
+                        help='Do not measure peak memory, latencies are not inflated by memory tracing')
+    parser.add_argument('--output', default=None, help='JSON results file, standard output by default')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=FSM_BENCHMARK_THRESHOLD)
+    parser.add_argument('--stress', default=None, metavar='PROCESSESxTHREADS',
+                        help='Fork stress test instead of the benchmark, e.g. 4x8')
+    parser.add_argument('--stress-operations', type=int, default=FSM_STRESS_OPERATIONS,
+                        help='Stores per thread of the fork stress test')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.operations) - set(FSM_BENCHMARK_OPERATIONS)
+    if unknown:
+        parser.error('unknown operations: {}'.format(', '.join(sorted(unknown))))
+
+    fs = GFSManager()
+    fs.init_app(BenchmarkApp(args.backend, args.sa_key_json_file, args.project))
+    if not fs.initialized():
+        print('GFSManager initialization failed', file=sys.stderr)
+        return 2
+    try:
+        if args.stress:
+            processes, threads = _int_list(args.stress.replace('x', ','))
+            report = run_stress(fs, processes, threads, args.stress_operations)
+        else:
+            report = Benchmark(fs, args.sizes, args.concurrency, args.operations, args.queries,
+                               args.trace_memory).run()
+    finally:
+        fs.close_connection()
+
+    exit_code = 0
+    if args.stress:
+        exit_code = 1 if report['errors'] or report['mismatches'] else 0
+    elif args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare_results(json.load(f), report, args.threshold)
+        exit_code = 1 if report['regressions'] else 0
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,333 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from google.cloud.firestore_v1.base_collection import _auto_id
+
+from gfs_manager.export import fs_decode_value, fs_encode_value
+
+# Default write-behind settings
+# Writes buffered before stores and updates wait for the background flushes (backpressure)
+FSM_BUFFER_MAX_SIZE = 10000
+# Writes committed by a batched write, and buffered writes triggering a flush before the flush interval
+FSM_BUFFER_BATCH_SIZE = 500
+# Seconds between flushes of the buffered writes
+FSM_BUFFER_INTERVAL = 1.0
+# Failed flushes of a batch before its writes are dropped
+FSM_BUFFER_MAX_FAILURES = 5
+# Records of written documents in the spill file before it is rewritten with the buffered writes only
+FSM_BUFFER_COMPACT_RECORDS = 10000
+
+# Write operations
+FSM_BUFFER_STORE = 'store'
+FSM_BUFFER_MERGE = 'merge'
+# Spill file record of written writes
+FSM_BUFFER_WRITTEN = 'written'
+
+
+# Spill file line of a record, newline delimited JSON: data only, nothing is executed when reading a spill file
+# Buffered writes: [sequence, operation, fs_doc_path, properties], properties encoded as export files are (typed values,
+# absolute references, sentinels by name, see gfs_manager.export)
+# Written writes: [FSM_BUFFER_WRITTEN, [sequences]]
+def _fs_spill_line(record) -> bytes:
+    if record[0] != FSM_BUFFER_WRITTEN:
+        sequence, operation, fs_doc_path, properties = record
+        record = (sequence, operation, fs_doc_path, fs_encode_value(properties, ''))
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def _fs_process_running(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Write-behind buffer of document stores and merges, committed by a background thread with batched writes
+# Buffered writes are flushed every interval seconds, or as soon as batch_size writes are buffered, in write order
+# Backpressure: when max_size writes are buffered, writes wait up to timeout seconds (forever if None) for a flush
+# to make room, and are rejected if the buffer is still full
+# Spill file: every buffered write is appended to spill_path before being buffered, and the writes are marked written
+# once committed; writes buffered by a process that crashed are buffered again by recover()
+# Spilled writes survive a process crash, not an operating system crash, unless fsync is set
+# Writes of a failed flush are retried by the next flushes, and dropped after max_failures failed flushes
+# Forked child processes start with an empty buffer, see _fs_after_fork
+# Counts: writes buffered, committed, flushes, writes rejected (buffer full) and dropped (failed flushes)
+class BufferedWriter:
+    def __init__(self, manager, max_size=FSM_BUFFER_MAX_SIZE, batch_size=FSM_BUFFER_BATCH_SIZE,
+                 interval=FSM_BUFFER_INTERVAL, timeout=None, spill_path=None, fsync=False,
+                 max_failures=FSM_BUFFER_MAX_FAILURES):
+        self.manager = manager
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.spill_path = spill_path
+        self.fsync = fsync
+        self.max_failures = max_failures
+        # Buffered writes: (sequence, operation, fs_doc_path, properties)
+        self.__pending = collections.deque()
+        # Writes being committed by a flush
+        self.__in_flight = []
+        self.__sequence = 0
+        self.__failures = 0
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__flush_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.__spill = None
+        self.__spilled_written = 0
+        self.writes = 0
+        self.committed = 0
+        self.flushes = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    # Number of buffered writes, including the writes being committed
+    def __len__(self):
+        return len(self.__pending) + len(self.__in_flight)
+
+    # Buffers the store of a new document in the collection fs_collection_path, with an id generated client side
+    # Returns the path of the document, None if the buffer is full
+    def store(self, fs_collection_path, properties):
+        fs_doc_path = fs_collection_path + '/' + _auto_id()
+        return fs_doc_path if self._fs_put(FSM_BUFFER_STORE, fs_doc_path, properties) else None
+
+    # Buffers the merge of properties into the document at fs_doc_path, created if it does not exist
+    # Returns False if the buffer is full
+    def merge(self, fs_doc_path, properties) -> bool:
+        return self._fs_put(FSM_BUFFER_MERGE, fs_doc_path, properties)
+
+    def _fs_put(self, operation, fs_doc_path, properties) -> bool:
+        with self.__changed:
+            if len(self) >= self.max_size:
+                self.__changed.notify_all()
+                if not self.__changed.wait_for(lambda: len(self) < self.max_size, self.timeout):
+                    self.rejected += 1
+                    logging.log(level=logging.ERROR, msg="Write buffer full, write of {} rejected".format(fs_doc_path))
+                    return False
+            self.__sequence += 1
+            write = (self.__sequence, operation, fs_doc_path, dict(properties))
+            if self.spill_path is not None:
+                self._fs_spill([write])
+            self.__pending.append(write)
+            self.writes += 1
+            if len(self.__pending) >= self.batch_size:
+                self.__changed.notify_all()
+            self._fs_start()
+        return True
+
+    # Starts the background thread, called holding the lock
+    def _fs_start(self):
+        if self.__thread is None and not self.__stopped.is_set():
+            self.__thread = threading.Thread(target=self._fs_run, name='gfs-manager-writer', daemon=True)
+            self.__thread.start()
+
+    # Spill file records: buffered writes, and (FSM_BUFFER_WRITTEN, sequences of written writes), see _fs_spill_line
+    def _fs_spill(self, records):
+        if self.__spill is None:
+            self.__spill = open(self.spill_path, 'ab')
+        self.__spill.write(b''.join(_fs_spill_line(record) for record in records))
+        self.__spill.flush()
+        if self.fsync:
+            os.fsync(self.__spill.fileno())
+
+    # Buffers again the writes of the spill file not marked written, and of the spill files of forked child processes
+    # that are no longer running, returns the number of writes recovered
+    # Called once the manager is connected, before buffering writes, recovered writes are numbered after the writes
+    # already buffered
+    # A truncated last record (crash while spilling) is ignored, a spill file with other invalid records is not
+    # recovered: the error is logged and the file kept as spill_path.unrecovered-<time>
+    def recover(self) -> int:
+        if self.spill_path is None:
+            return 0
+        # Spilled references are decoded with the client of the manager
+        client = self.manager.client
+        if client is None:
+            logging.log(level=logging.ERROR, msg="Spill file {} not recovered: not connected".format(self.spill_path))
+            return 0
+        child_paths = self._fs_child_spill_paths()
+        writes = []
+        for spill_path in [self.spill_path] + child_paths:
+            try:
+                writes.extend(self._fs_read_spill(spill_path, client))
+            except Exception as e:
+                # Unreadable spill file kept aside, not rewritten by the compaction of the spill file
+                kept_path = '{}.unrecovered-{}'.format(spill_path, time.strftime('%Y%m%d%H%M%S'))
+                os.replace(spill_path, kept_path)
+                self.manager._fs_log_error(e, self.recover)
+                logging.log(level=logging.ERROR, msg="Spill file {} not recovered, kept in {}".format(
+                    spill_path, kept_path))
+                if spill_path in child_paths:
+                    child_paths.remove(spill_path)
+        with self.__changed:
+            for sequence, operation, fs_doc_path, properties in writes:
+                self.__sequence += 1
+                self.__pending.append((self.__sequence, operation, fs_doc_path, properties))
+            self.writes += len(writes)
+            if writes or os.path.exists(self.spill_path):
+                self._fs_compact()
+            if writes:
+                self._fs_start()
+        # Writes of the child processes now spilled to the spill file of the writer
+        for spill_path in child_paths:
+            os.remove(spill_path)
+        return len(writes)
+
+    # Writes of a spill file not marked written, in write order
+    # Only a last line not terminated is a record truncated by a crash, ignored: other invalid records raise
+    def _fs_read_spill(self, spill_path, client) -> list:
+        if not os.path.exists(spill_path):
+            return []
+        writes = {}
+        with open(spill_path, 'rb') as spill:
+            for line in spill:
+                if not line.endswith(b'\n'):
+                    logging.log(level=logging.WARNING, msg="Spill file {} truncated: last record ignored".format(
+                        spill_path))
+                    break
+                record = json.loads(line)
+                if record[0] == FSM_BUFFER_WRITTEN:
+                    for sequence in record[1]:
+                        writes.pop(sequence, None)
+                else:
+                    sequence, operation, fs_doc_path, properties = record
+                    writes[sequence] = (sequence, operation, fs_doc_path, fs_decode_value(properties, client, ''))
+        return [write for sequence, write in sorted(writes.items())]
+
+    # Spill files of forked child processes no longer running: spill_path.<pid>
+    def _fs_child_spill_paths(self) -> list:
+        directory, name = os.path.split(os.path.abspath(self.spill_path))
+        child_paths = []
+        for file_name in sorted(os.listdir(directory)):
+            pid = file_name[len(name) + 1:]
+            if file_name.startswith(name + '.') and pid.isdigit() and not _fs_process_running(int(pid)):
+                child_paths.append(os.path.join(directory, file_name))
+        return child_paths
+
+    # Forked child process: the buffered writes belong to the parent process, which commits them
+    # The child process buffers its own writes, and spills them to spill_path.<pid>, recovered by the next recover()
+    # of the parent spill file once the child process is no longer running
+    def _fs_after_fork(self):
+        self.__pending = collections.deque()
+        self.__in_flight = []
+        self.__failures = 0
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__flush_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        # Spill file of the parent process, still written by the parent
+        self.__spill = None
+        self.__spilled_written = 0
+        if self.spill_path is not None:
+            self.spill_path = '{}.{}'.format(self.spill_path, os.getpid())
+
+    # Rewrites the spill file with the buffered writes only, called holding the lock
+    def _fs_compact(self):
+        if self.spill_path is None:
+            return
+        if self.__spill is not None:
+            self.__spill.close()
+            self.__spill = None
+        tmp_path = self.spill_path + '.tmp'
+        with open(tmp_path, 'wb') as spill:
+            spill.write(b''.join(_fs_spill_line(write) for write in self.__in_flight + list(self.__pending)))
+            spill.flush()
+            os.fsync(spill.fileno())
+        os.replace(tmp_path, self.spill_path)
+        self.__spilled_written = 0
+
+    # Commits the buffered writes, returns the number of writes committed
+    def flush(self) -> int:
+        written = 0
+        with self.__flush_lock:
+            while True:
+                with self.__changed:
+                    if not self.__pending:
+                        break
+                    self.__in_flight = [self.__pending.popleft()
+                                        for i in range(min(self.batch_size, len(self.__pending)))]
+                    batch_writes = self.__in_flight
+                try:
+                    self._fs_commit(batch_writes)
+                    committed = True
+                    self.__failures = 0
+                except Exception as e:
+                    self.manager._fs_log_error(e, self.flush)
+                    committed = False
+                    self.__failures += 1
+                with self.__changed:
+                    self.__in_flight = []
+                    if committed or self.__failures >= self.max_failures:
+                        if committed:
+                            written += len(batch_writes)
+                        else:
+                            self.dropped += len(batch_writes)
+                            self.__failures = 0
+                            logging.log(level=logging.ERROR, msg="{} buffered writes dropped after {} failed flushes"
+                                        .format(len(batch_writes), self.max_failures))
+                        if self.spill_path is not None:
+                            self._fs_spill([(FSM_BUFFER_WRITTEN, tuple(write[0] for write in batch_writes))])
+                            self.__spilled_written += len(batch_writes)
+                            if not self.__pending or self.__spilled_written >= FSM_BUFFER_COMPACT_RECORDS:
+                                self._fs_compact()
+                    else:
+                        # Retried by the next flush, before the writes buffered since
+                        self.__pending.extendleft(reversed(batch_writes))
+                    self.__changed.notify_all()
+                if not committed:
+                    break
+            self.committed += written
+            self.flushes += 1
+        return written
+
+    def _fs_commit(self, batch_writes):
+        client = self.manager.client
+        batch = self.manager._fs_batch()
+        for sequence, operation, fs_doc_path, properties in batch_writes:
+            batch.set(client.document(fs_doc_path), properties, merge=operation == FSM_BUFFER_MERGE)
+        # Stores of new ids and merges of values are idempotent
+        batch.commit(**self.manager._fs_retry())
+        for sequence, operation, fs_doc_path, properties in batch_writes:
+            self.manager._fs_cache_invalidate(fs_doc_path=fs_doc_path)
+
+    # Flushes every interval seconds, or when batch_size writes are buffered
+    def _fs_run(self):
+        while not self.__stopped.is_set():
+            with self.__changed:
+                self.__changed.wait_for(lambda: self.__stopped.is_set() or len(self.__pending) >= self.batch_size or
+                                        len(self) >= self.max_size, self.interval)
+            if self.__stopped.is_set():
+                break
+            # Failed flushes retried after an interval
+            if self.__pending and not self.flush() and self.__pending:
+                self.__stopped.wait(self.interval)
+
+    # Stops the background thread, commits the buffered writes and closes the spill file
+    # Writes buffered later start a new background thread
+    def close(self):
+        with self.__changed:
+            self.__stopped.set()
+            self.__changed.notify_all()
+        thread = self.__thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        while self.__pending and self.flush():
+            pass
+        with self.__changed:
+            self.__thread = None
+            self.__stopped.clear()
+            if self.__spill is not None:
+                self.__spill.close()
+                self.__spill = None
+        if self.__pending:
+            logging.log(level=logging.ERROR, msg="{} buffered writes not written{}".format(
+                len(self.__pending), ", kept in " + self.spill_path if self.spill_path is not None else ""))
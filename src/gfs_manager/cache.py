@@ -0,0 +1,259 @@
+import datetime
+import threading
+import time
+
+from cachetools import TTLCache
+
+# Default document cache settings
+FSM_CACHE_MAX_ENTRIES = 1024
+FSM_CACHE_MAX_BYTES = 16 * 1024 * 1024
+FSM_CACHE_TTL = 60
+
+
+# Approximate storage size of a Firestore value, following Firestore storage size rules
+# https://cloud.google.com/firestore/docs/storage-size
+def fs_value_size(value) -> int:
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, datetime.datetime)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(fs_value_size(k) + fs_value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(fs_value_size(v) for v in value)
+    if hasattr(value, 'path'):
+        # Document references
+        return len(value.path.encode('utf-8')) + 1
+    # Geo points and other values
+    return 16
+
+
+# Approximate size of a cached Firestore document snapshot: document path and properties
+def fs_snapshot_size(fs_doc) -> int:
+    return fs_value_size(fs_doc.reference.path) + 32 + fs_value_size(fs_doc.to_dict() or {})
+
+
+# TTL and LRU cache bounded by number of entries and by size in bytes
+# Counts evictions of least recently used entries (expired entries are not counted as evictions)
+class _BoundedTTLCache(TTLCache):
+    def __init__(self, max_entries, max_bytes, ttl, timer=time.monotonic, getsizeof=None):
+        super().__init__(maxsize=max_bytes, ttl=ttl, timer=timer, getsizeof=getsizeof)
+        self.max_entries = max_entries
+        self.evictions = 0
+
+    def __setitem__(self, key, value, **kwargs):
+        if key not in self:
+            self.expire()
+            while len(self) >= self.max_entries:
+                self.popitem()
+        super().__setitem__(key, value, **kwargs)
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+# In-process read-through cache of Firestore document snapshots, keyed by document path
+# Bounded by number of entries (max_entries) and approximate size in bytes (max_bytes)
+# Entries expire after ttl seconds, least recently used entries are evicted first
+# Any object implementing get, put, invalidate, invalidate_prefix, clear and stats can be plugged into GFSManager
+class DocumentCache:
+    def __init__(self, max_entries=FSM_CACHE_MAX_ENTRIES, max_bytes=FSM_CACHE_MAX_BYTES, ttl=FSM_CACHE_TTL,
+                 timer=time.monotonic):
+        self.__lock = threading.RLock()
+        self.__cache = _BoundedTTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, timer=timer,
+                                        getsizeof=fs_snapshot_size)
+        self.__hits = 0
+        self.__misses = 0
+
+    # Returns the cached document snapshot at fs_doc_path, None if not cached or expired
+    def get(self, fs_doc_path):
+        with self.__lock:
+            fs_doc = self.__cache.get(fs_doc_path)
+            if fs_doc is None:
+                self.__misses += 1
+            else:
+                self.__hits += 1
+            return fs_doc
+
+    def put(self, fs_doc_path, fs_doc):
+        with self.__lock:
+            try:
+                self.__cache[fs_doc_path] = fs_doc
+            except ValueError:
+                # Document larger than the cache size limit, not cached
+                self.__cache.pop(fs_doc_path, None)
+
+    def invalidate(self, fs_doc_path):
+        with self.__lock:
+            self.__cache.pop(fs_doc_path, None)
+
+    # Invalidates every cached document whose path starts with prefix, i.e. every document in a collection
+    def invalidate_prefix(self, prefix):
+        with self.__lock:
+            for fs_doc_path in [k for k in self.__cache.keys() if k.startswith(prefix)]:
+                self.__cache.pop(fs_doc_path, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__cache.evictions,
+                    'entries': len(self.__cache), 'bytes': self.__cache.currsize}
+
+
+# Default query cache settings
+FSM_QUERY_CACHE_MAX_ENTRIES = 256
+FSM_QUERY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+FSM_QUERY_CACHE_TTL = 30
+
+
+# Hashable form of a filter value, tagged with its type: equal values of different types (True and 1) are different
+# queries
+def _fs_freeze(value):
+    if isinstance(value, dict):
+        return 'map', tuple(sorted((k, _fs_freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return 'list', tuple(_fs_freeze(v) for v in value)
+    if hasattr(value, 'path') and not isinstance(value, str):
+        # Document references
+        return 'ref', value.path
+    try:
+        hash(value)
+    except TypeError:
+        return value.__class__.__name__, repr(value)
+    return value.__class__.__name__, value
+
+
+def _fs_results_size(results) -> int:
+    return 64 + sum(fs_snapshot_size(fs_doc) for fs_doc in results)
+
+
+# In-process cache of query results (lists of Firestore document snapshots), keyed by normalized query, see key()
+# Bounded by number of queries (max_entries) and approximate size in bytes of their documents (max_bytes)
+# Entries expire after ttl seconds, least recently used entries are evicted first
+# The cached queries of a collection are invalidated by invalidate(collection path), called by the manager writes
+# Queries run concurrently with an invalidation of their collection are not cached: begin() before running a query,
+# put() once it returned
+# Any object implementing key, get, begin, put, invalidate, invalidate_prefix, clear and stats can be plugged into
+# GFSManager
+class QueryCache:
+    def __init__(self, max_entries=FSM_QUERY_CACHE_MAX_ENTRIES, max_bytes=FSM_QUERY_CACHE_MAX_BYTES,
+                 ttl=FSM_QUERY_CACHE_TTL, timer=time.monotonic):
+        self.__lock = threading.RLock()
+        self.__cache = _BoundedTTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, timer=timer,
+                                        getsizeof=_fs_results_size)
+        # Keys of the cached queries by collection path, including keys of evicted and expired entries until the
+        # index is rebuilt
+        self.__keys = {}
+        self.__indexed = 0
+        # Queries running by collection path: [queries running, invalidations of the collection since the first one]
+        self.__running = {}
+        self.__hits = 0
+        self.__misses = 0
+        self.__invalidations = 0
+
+    # Normalized query: collection path, filters in any order (equality lookup properties are '==' filters), ordering
+    # with explicit directions, limit, offset and field projection in any order
+    @staticmethod
+    def key(col_path, lookup_properties=None, filters=None, order_by=None, limit=None, offset=None, select=None):
+        all_filters = [(k, '==', v) for k, v in (lookup_properties or {}).items()] + list(filters or [])
+        filters_key = tuple(sorted(set((field_path, op_string, _fs_freeze(value))
+                                       for field_path, op_string, value in all_filters), key=repr))
+        order_key = tuple((order, 'ASCENDING') if isinstance(order, str) else tuple(order) for order in order_by or [])
+        select_key = tuple(sorted(select)) if select is not None else None
+        return col_path, filters_key, order_key, limit, offset, select_key
+
+    # Returns a copy of the cached results of a query, None if not cached or expired
+    def get(self, key) -> list:
+        with self.__lock:
+            results = self.__cache.get(key)
+            if results is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+            return list(results)
+
+    # Starts a query, returns the token of put()
+    def begin(self, key):
+        with self.__lock:
+            running = self.__running.setdefault(key[0], [0, 0])
+            running[0] += 1
+            return running[1]
+
+    # Ends a query started with begin(), caching its results unless its collection was invalidated in the meantime
+    # results: None if the query failed, nothing is cached
+    def put(self, key, results, token):
+        col_path = key[0]
+        with self.__lock:
+            running = self.__running.get(col_path)
+            current = running is not None and running[1] == token
+            if running is not None:
+                running[0] -= 1
+                if running[0] <= 0:
+                    del self.__running[col_path]
+            if results is None or not current:
+                return
+            try:
+                self.__cache[key] = list(results)
+            except ValueError:
+                # Results larger than the cache size limit, not cached
+                self.__cache.pop(key, None)
+                return
+            keys = self.__keys.setdefault(col_path, set())
+            if key not in keys:
+                keys.add(key)
+                self.__indexed += 1
+                if self.__indexed > 2 * self.__cache.max_entries:
+                    self._fs_reindex()
+
+    # Index of the keys of the cached entries, called holding the lock
+    def _fs_reindex(self):
+        self.__cache.expire()
+        self.__keys = {}
+        for key in self.__cache.keys():
+            self.__keys.setdefault(key[0], set()).add(key)
+        self.__indexed = len(self.__cache)
+
+    # Invalidates every cached query of the collection col_path
+    def invalidate(self, col_path):
+        with self.__lock:
+            running = self.__running.get(col_path)
+            if running is not None:
+                running[1] += 1
+            keys = self.__keys.pop(col_path, None)
+            if keys:
+                self.__indexed -= len(keys)
+                self.__invalidations += 1
+                for key in keys:
+                    self.__cache.pop(key, None)
+
+    # Invalidates every cached query of the collections whose path starts with prefix, i.e. every subcollection of a
+    # document
+    def invalidate_prefix(self, prefix):
+        with self.__lock:
+            for col_path in [p for p in set(self.__keys) | set(self.__running) if p.startswith(prefix)]:
+                self.invalidate(col_path)
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.__keys = {}
+            self.__indexed = 0
+            for running in self.__running.values():
+                running[1] += 1
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__cache.evictions,
+                    'invalidations': self.__invalidations, 'entries': len(self.__cache),
+                    'bytes': self.__cache.currsize}
@@ -0,0 +1,81 @@
+import os
+import threading
+
+from google.cloud import firestore
+
+from gfs_manager.fork import fs_fork_check, fs_register_at_fork
+
+
+# Registry of Firestore clients shared by several managers in the same process
+# Clients are keyed by client class, credentials file and project: managers for different apps (FSM_APP_ROOT,
+# FSM_APP_OBJECTS_PATH) using the same service account share one client, hence one gRPC channel
+# Clients are reference counted and only closed when released by their last user
+# Clients are per process: the clients of the parent process are dropped by a forked child process, see gfs_manager.fork
+class ClientPool:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # key: [client, reference count]
+        self.__clients = {}
+        self.__pid = os.getpid()
+        fs_register_at_fork(self)
+
+    # Forked child process: clients of the parent process are abandoned, the next acquire creates new clients
+    def _fs_after_fork(self):
+        self.__lock = threading.Lock()
+        self.__clients = {}
+        self.__pid = os.getpid()
+
+    @staticmethod
+    def client_key(sa_creds_json_file='', project=None, client_class=firestore.Client):
+        # Empty credentials file: default Google Cloud application credentials
+        creds = os.path.abspath(sa_creds_json_file) if sa_creds_json_file else ''
+        return client_class.__name__, creds, project
+
+    # Returns a client for the credentials file and project, created on first use
+    def acquire(self, sa_creds_json_file='', project=None, client_class=firestore.Client):
+        key = self.client_key(sa_creds_json_file, project, client_class)
+        self.__pid = fs_fork_check(self, self.__pid)
+        with self.__lock:
+            entry = self.__clients.get(key)
+            if entry is None:
+                # Project from credentials or environment unless provided
+                kwargs = {'project': project} if project is not None else {}
+                if sa_creds_json_file:
+                    client = client_class.from_service_account_json(sa_creds_json_file, **kwargs)
+                else:
+                    client = client_class(**kwargs)
+                entry = self.__clients[key] = [client, 0]
+            entry[1] += 1
+            return entry[0]
+
+    # Releases a client acquired from the pool, the client is closed when it has no users left
+    # Returns True if the client was closed
+    def release(self, client) -> bool:
+        with self.__lock:
+            for key, entry in self.__clients.items():
+                if entry[0] is client:
+                    entry[1] -= 1
+                    if entry[1] > 0:
+                        return False
+                    del self.__clients[key]
+                    break
+            else:
+                return False
+        client.close()
+        return True
+
+    # Number of users of client, 0 if the client does not belong to the pool
+    def references(self, client) -> int:
+        with self.__lock:
+            for entry in self.__clients.values():
+                if entry[0] is client:
+                    return entry[1]
+        return 0
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__clients)
+
+
+# Process wide client pool used by GFSManager
+fs_client_pool = ClientPool()
@@ -0,0 +1,181 @@
+import logging
+import random
+import threading
+import time
+
+from google.cloud import firestore
+
+# Default sharded counter settings
+# Counters collection, under the app path prefix or a parent document
+FSM_COUNTERS_COLLECTION = 'Counters'
+# Subcollection of the shard documents of a counter
+FSM_COUNTER_SHARDS_COLLECTION = 'shards'
+# Shards of a counter: Firestore sustains about one write per second to a single document
+FSM_COUNTER_SHARDS = 10
+# Property of the shard documents holding the shard count
+FSM_COUNTER_FIELD = 'count'
+
+# Default write coalescing settings
+# Seconds between flushes of the buffered writes
+FSM_COALESCE_INTERVAL = 1.0
+# Firestore limit of write operations in a single batched write
+_FS_MAX_BATCH_SIZE = 500
+
+
+# Random shard document of a counter, shards are created by their first increment
+def fs_counter_shard(counter_ref, num_shards=FSM_COUNTER_SHARDS):
+    shard_id = str(random.randrange(max(1, num_shards)))
+    return counter_ref.collection(FSM_COUNTER_SHARDS_COLLECTION).document(shard_id)
+
+
+# Aggregated counter values read by the manager, by counter path, with their read time
+# Increments made by the manager are added to the cached values
+class CounterValues:
+    def __init__(self, timer=time.monotonic):
+        self.__values = {}
+        self.__lock = threading.Lock()
+        self.__timer = timer
+
+    # Cached value read less than max_age seconds ago, None if not cached or older
+    def get(self, counter_path, max_age):
+        with self.__lock:
+            entry = self.__values.get(counter_path)
+        if entry is None or self.__timer() - entry[1] > max_age:
+            return None
+        return entry[0]
+
+    def put(self, counter_path, value):
+        with self.__lock:
+            self.__values[counter_path] = (value, self.__timer())
+
+    def add(self, counter_path, amount):
+        with self.__lock:
+            entry = self.__values.get(counter_path)
+            if entry is not None:
+                self.__values[counter_path] = (entry[0] + amount, entry[1])
+
+    def invalidate(self, counter_path):
+        with self.__lock:
+            self.__values.pop(counter_path, None)
+
+
+# Write buffer merging the updates of the same document into a single write per flush interval
+# Buffered updates of a document are merged: the last value of every property is written, increments of a property
+# are added up, and written with a single set(merge=True) creating the document if it does not exist
+# Buffered writes are committed by a background thread every interval seconds, with batched writes of up to 500
+# documents, and on flush() and close()
+# Writes of a failed flush are buffered again, under the updates buffered since
+# Counts: writes buffered, documents written by flushes and flushes
+class WriteCoalescer:
+    def __init__(self, manager, interval=FSM_COALESCE_INTERVAL):
+        self.manager = manager
+        self.interval = interval
+        # {fs_doc_path: (properties, increments)}
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.writes = 0
+        self.documents_written = 0
+        self.flushes = 0
+
+    # Number of documents with buffered writes
+    def __len__(self):
+        return len(self.__pending)
+
+    # Buffers an update of the document at fs_doc_path
+    # properties: dictionary of {property: value}, increments: dictionary of {property: amount}
+    def update(self, fs_doc_path, properties=None, increments=None):
+        with self.__lock:
+            pending_properties, pending_increments = self.__pending.get(fs_doc_path, ({}, {}))
+            self.__pending[fs_doc_path] = self._fs_merge(pending_properties, pending_increments, properties,
+                                                         increments)
+            self.writes += 1
+            if self.__thread is None and not self.__stopped.is_set():
+                self.__thread = threading.Thread(target=self._fs_run, name='gfs-manager-coalescer', daemon=True)
+                self.__thread.start()
+
+    # Later properties replace earlier properties and increments, later increments are added up
+    @staticmethod
+    def _fs_merge(properties, increments, later_properties=None, later_increments=None):
+        properties = dict(properties)
+        increments = dict(increments)
+        for name, value in (later_properties or {}).items():
+            properties[name] = value
+            increments.pop(name, None)
+        for name, amount in (later_increments or {}).items():
+            if name in properties and isinstance(properties[name], (int, float)):
+                properties[name] += amount
+            else:
+                increments[name] = increments.get(name, 0) + amount
+        return properties, increments
+
+    # Commits every buffered write, returns the number of documents written
+    def flush(self) -> int:
+        with self.__flush_lock:
+            with self.__lock:
+                pending = self.__pending
+                self.__pending = {}
+            items = list(pending.items())
+            written = 0
+            for i in range(0, len(items), _FS_MAX_BATCH_SIZE):
+                chunk = items[i:i + _FS_MAX_BATCH_SIZE]
+                try:
+                    written += self._fs_commit(chunk)
+                except Exception as e:
+                    self.manager._fs_log_error(e, self.flush)
+                    self._fs_requeue(chunk)
+            self.documents_written += written
+            self.flushes += 1
+            return written
+
+    def _fs_commit(self, chunk) -> int:
+        client = self.manager.client
+        batch = self.manager._fs_batch()
+        for fs_doc_path, (properties, increments) in chunk:
+            data = dict(properties)
+            for name, amount in increments.items():
+                data[name] = firestore.Increment(amount)
+            batch.set(client.document(fs_doc_path), data, merge=True)
+        # Increments are not idempotent
+        batch.commit(**self.manager._fs_retry(not any(increments for path, (p, increments) in chunk)))
+        for fs_doc_path, data in chunk:
+            self.manager._fs_cache_invalidate(fs_doc_path=fs_doc_path)
+        return len(chunk)
+
+    def _fs_requeue(self, chunk):
+        with self.__lock:
+            for fs_doc_path, (properties, increments) in chunk:
+                later = self.__pending.get(fs_doc_path)
+                if later is not None:
+                    properties, increments = self._fs_merge(properties, increments, *later)
+                self.__pending[fs_doc_path] = (properties, increments)
+
+    def _fs_run(self):
+        while not self.__stopped.wait(self.interval):
+            if self.__pending:
+                self.flush()
+
+    # Forked child process: the buffered writes belong to the parent process, which commits them
+    def _fs_after_fork(self):
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    # Stops the background thread and commits the buffered writes
+    # Writes buffered later start a new background thread
+    def close(self):
+        self.__stopped.set()
+        thread = self.__thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if self.__pending:
+            self.flush()
+        self.__thread = None
+        self.__stopped.clear()
+        if self.__pending:
+            logging.log(level=logging.ERROR, msg="{} documents with buffered writes not written"
+                        .format(len(self.__pending)))
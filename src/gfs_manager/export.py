@@ -0,0 +1,141 @@
+import base64
+import datetime
+import gzip
+import json
+import math
+import os
+import threading
+
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.cloud.firestore_v1 import GeoPoint, transforms
+from google.cloud.firestore_v1.base_document import BaseDocumentReference
+
+# Export files
+# Manifest written once an export is complete: source root, collections, partitions, files and document counts
+FSM_EXPORT_MANIFEST = 'manifest.json'
+# Partitions of the export in progress, and the partitions exported
+FSM_EXPORT_CHECKPOINT = 'export_checkpoint.json'
+# Files imported, by import root
+FSM_IMPORT_CHECKPOINT = 'import_checkpoint.json'
+# Gzip compressed newline delimited JSON, one file per collection partition
+FSM_EXPORT_SUFFIX = '.ndjson.gz'
+FSM_EXPORT_FORMAT_VERSION = 1
+# Compression level of export files, fast compression as exports are bound by the Firestore reads
+FSM_EXPORT_COMPRESS_LEVEL = 6
+
+# Sentinels of the client library, compared by identity, encoded by name (written values, see buffered_writer)
+_FS_SENTINELS = {'SERVER_TIMESTAMP': transforms.SERVER_TIMESTAMP, 'DELETE_FIELD': transforms.DELETE_FIELD}
+
+
+# Name of the file of a collection partition
+def fs_export_file_name(collection_id, index) -> str:
+    return '{}-{:05d}{}'.format(collection_id, index, FSM_EXPORT_SUFFIX)
+
+
+# JSON value of a Firestore value
+# Values with no JSON type are tagged objects: {'$timestamp': RFC 3339}, {'$bytes': base64}, {'$geo': [lat, lng]},
+# {'$ref': path}, {'$float': 'NaN' | 'Infinity' | '-Infinity'}, maps with keys starting with '$' are {'$map': map}
+# Sentinels of written values are {'$sentinel': 'SERVER_TIMESTAMP' | 'DELETE_FIELD'}
+# References to root and to documents under root are relative to root, to be imported under another root
+def fs_encode_value(value, root):
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else {'$float': repr(value).replace('inf', 'Infinity').replace(
+            'nan', 'NaN')}
+    if isinstance(value, datetime.datetime):
+        if isinstance(value, DatetimeWithNanoseconds):
+            return {'$timestamp': value.rfc3339()}
+        return {'$timestamp': value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, GeoPoint):
+        return {'$geo': [value.latitude, value.longitude]}
+    if isinstance(value, BaseDocumentReference):
+        path = value.path
+        return {'$ref': path[len(root) + 1:] if path == root or path.startswith(root + '/') else '/' + path}
+    if isinstance(value, (list, tuple)):
+        return [fs_encode_value(v, root) for v in value]
+    if isinstance(value, dict):
+        encoded = {k: fs_encode_value(v, root) for k, v in value.items()}
+        return {'$map': encoded} if any(k.startswith('$') for k in value) else encoded
+    for name, sentinel in _FS_SENTINELS.items():
+        if value is sentinel:
+            return {'$sentinel': name}
+    raise TypeError('Value of type {} not exportable'.format(value.__class__.__name__))
+
+
+# Firestore value of a JSON value, relative references are resolved under root
+def fs_decode_value(value, client, root):
+    if isinstance(value, list):
+        return [fs_decode_value(v, client, root) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        tag, tagged = next(iter(value.items()))
+        if tag == '$timestamp':
+            return DatetimeWithNanoseconds.from_rfc3339(tagged)
+        if tag == '$bytes':
+            return base64.b64decode(tagged)
+        if tag == '$geo':
+            return GeoPoint(*tagged)
+        if tag == '$ref':
+            if tagged.startswith('/'):
+                return client.document(tagged[1:])
+            return client.document(root + '/' + tagged if tagged else root)
+        if tag == '$float':
+            return float(tagged)
+        if tag == '$sentinel':
+            return _FS_SENTINELS[tagged]
+        if tag == '$map':
+            value = tagged
+    return {k: fs_decode_value(v, client, root) for k, v in value.items()}
+
+
+# Export file line of a document: {'path': document path relative to root, 'data': properties}
+def fs_export_line(fs_doc, root) -> bytes:
+    line = {'path': fs_doc.reference.path[len(root) + 1:], 'data': fs_encode_value(fs_doc.to_dict(), root)}
+    return json.dumps(line, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+# Streams the (path relative to the export root, JSON properties) of the documents of an export file
+def fs_read_export_file(file_path):
+    with gzip.open(file_path, 'rb') as export_file:
+        for line in export_file:
+            if line.strip():
+                document = json.loads(line)
+                yield document['path'], document['data']
+
+
+# Writes a JSON file atomically, readers never see a partially written file
+def fs_write_json(file_path, data):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+    os.replace(tmp_path, file_path)
+
+
+def fs_read_json(file_path, default=None):
+    if not os.path.exists(file_path):
+        return default
+    with open(file_path) as json_file:
+        return json.load(json_file)
+
+
+# Checkpoint of an export or import, saved to file_path every time a unit of work (partition, file) completes
+# state: JSON serializable dictionary, updated through update()
+class Checkpoint:
+    def __init__(self, file_path, state=None):
+        self.file_path = file_path
+        self.state = state if state is not None else {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def load(cls, file_path):
+        return cls(file_path, fs_read_json(file_path, {}))
+
+    # Calls fn(state) and saves the checkpoint
+    def update(self, fn):
+        with self.__lock:
+            fn(self.state)
+            fs_write_json(self.file_path, self.state)
@@ -0,0 +1,50 @@
+import os
+import threading
+import weakref
+
+# Client policies: Firestore clients used by the threads of a process
+# One client per credentials file and project, shared by the managers and threads of the process (gRPC channels are
+# thread safe and multiplex concurrent calls)
+FSM_CLIENT_SHARED = 'shared'
+# One client per manager, shared by the threads using the manager
+FSM_CLIENT_MANAGER = 'manager'
+# One client per manager and thread, for threads making many concurrent calls (one gRPC channel each)
+FSM_CLIENT_THREAD = 'thread'
+FSM_CLIENT_POLICIES = [FSM_CLIENT_SHARED, FSM_CLIENT_MANAGER, FSM_CLIENT_THREAD]
+
+# Objects reset in child processes after a fork, with their _fs_after_fork() method
+_fs_fork_handlers = weakref.WeakSet()
+_fs_fork_handlers_lock = threading.Lock()
+
+
+# Fork safety
+# gRPC channels, and the Firestore clients using them, must not be used by a process forked after they were created
+# (gunicorn or multiprocessing workers forked after init_app): calls of the child process hang or fail
+# Objects registered with fs_register_at_fork drop their inherited clients, locks and background thread state in the
+# child process, and create new ones on first use, the parent process keeps its own
+# Inherited clients are abandoned, not closed: their channels are still used by the parent process
+# Forks not notified to Python (os.register_at_fork) are detected by the objects comparing the process id with
+# fs_fork_check
+def fs_register_at_fork(obj):
+    with _fs_fork_handlers_lock:
+        _fs_fork_handlers.add(obj)
+
+
+# Calls the fork handler of obj if the current process is not the process pid, returns the current process id
+def fs_fork_check(obj, pid) -> int:
+    current_pid = os.getpid()
+    if pid != current_pid:
+        obj._fs_after_fork()
+    return current_pid
+
+
+def _fs_after_fork_in_child():
+    global _fs_fork_handlers_lock
+    # Lock possibly held by a thread of the parent process when it forked
+    _fs_fork_handlers_lock = threading.Lock()
+    for obj in list(_fs_fork_handlers):
+        obj._fs_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_fs_after_fork_in_child)
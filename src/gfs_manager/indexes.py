@@ -0,0 +1,168 @@
+import threading
+from urllib.parse import quote
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+
+from gfs_manager.models import Model, fs_model_schema
+
+# Collection of the lookup documents of an index, next to the indexed collection
+FSM_INDEX_COLLECTION_FORMAT = '{collection}_by_{field}'
+# Subcollection of the entries of a value of a non unique index, one document per indexed document
+FSM_INDEX_ENTRIES_COLLECTION = 'ids'
+
+# Document writes of indexed collections
+FSM_INDEX_SET = 'set'
+FSM_INDEX_MERGE = 'merge'
+FSM_INDEX_UPDATE = 'update'
+FSM_INDEX_DELETE = 'delete'
+
+# Registered indexes: {collection name: {field: SecondaryIndex}}
+_fs_indexes = {}
+_fs_indexes_lock = threading.Lock()
+
+
+# Secondary index of a property of the documents of every collection named collection
+# Lookup documents are stored in the collection '<collection>_by_<field>' next to the indexed collection, one per
+# indexed value: a unique index lookup is a single document read
+#   unique: <collection>_by_<field>/<value key> holds the entry of the document with that value, a write indexing a
+#     value already indexed for another document fails
+#   non unique: <collection>_by_<field>/<value key>/ids/<fs_id> holds the entry of every document with that value
+# Entries: {'fs_id', 'fs_path'} and a copy of the include properties of the document (denormalized lookup table)
+# Only string, integer and boolean values are indexed, documents without the property or with other values are not
+class SecondaryIndex:
+    def __init__(self, collection, field, unique=False, include=None):
+        self.collection = collection
+        self.field = field
+        self.unique = unique
+        self.include = tuple(include or ())
+        self.name = FSM_INDEX_COLLECTION_FORMAT.format(collection=collection, field=field)
+
+    # Lookup document id of a value: value type and value, '/' and '%' escaped, None if the value is not indexed
+    @staticmethod
+    def key(value):
+        if isinstance(value, bool):
+            tag = 'b'
+        elif isinstance(value, int):
+            tag = 'i'
+        elif isinstance(value, str):
+            tag = 's'
+        else:
+            return None
+        return quote('{}:{}'.format(tag, value), safe='')
+
+    def _fs_properties_key(self, properties):
+        return self.key(properties.get(self.field)) if properties is not None else None
+
+    # Path of the index collection of the collection col_path
+    def index_path(self, col_path) -> str:
+        parent = col_path.rpartition('/')[0]
+        return (parent + '/' if parent else '') + self.name
+
+    # Path of the lookup document of a value key of a unique index, of the entries collection of a value key of a non
+    # unique index
+    def value_path(self, col_path, key) -> str:
+        value_path = self.index_path(col_path) + '/' + key
+        return value_path if self.unique else value_path + '/' + FSM_INDEX_ENTRIES_COLLECTION
+
+    # Path of the lookup document of a value key, for the document fs_id of the collection col_path
+    def lookup_path(self, col_path, key, fs_id) -> str:
+        return self.value_path(col_path, key) + ('' if self.unique else '/' + fs_id)
+
+    def entry(self, fs_doc_path, properties) -> dict:
+        entry = {'fs_id': fs_doc_path.rpartition('/')[2], 'fs_path': fs_doc_path}
+        for name in self.include:
+            if name in properties:
+                entry[name] = properties[name]
+        return entry
+
+    # Adds the lookup document writes of a document write to a batch or transaction
+    # previous: document properties before the write, None for a new document
+    # properties: document properties after the write, None for a deletion
+    def writes(self, writer, client, fs_doc_path, previous, properties):
+        col_path, _, fs_id = fs_doc_path.rpartition('/')
+        previous_key = self._fs_properties_key(previous)
+        key = self._fs_properties_key(properties)
+        if previous_key is not None and previous_key != key:
+            writer.delete(client.document(self.lookup_path(col_path, previous_key, fs_id)))
+        if key is not None:
+            entry = self.entry(fs_doc_path, properties)
+            lookup_ref = client.document(self.lookup_path(col_path, key, fs_id))
+            if key != previous_key:
+                if self.unique:
+                    # Fails the whole write if the value is indexed for another document
+                    writer.create(lookup_ref, entry)
+                else:
+                    writer.set(lookup_ref, entry)
+            elif entry != self.entry(fs_doc_path, previous):
+                # Included properties changed
+                writer.set(lookup_ref, entry)
+
+
+# Registers a secondary index of the property field of the documents of the collections named collection
+# collection: collection name, or model class (collection of the model) or app object class (class name)
+# Returns the index
+def fs_index(collection, field, unique=False, include=None) -> SecondaryIndex:
+    if isinstance(collection, type):
+        collection = fs_model_schema(collection).collection if issubclass(collection, Model) else collection.__name__
+    index = SecondaryIndex(collection, field, unique, include)
+    with _fs_indexes_lock:
+        indexes = dict(_fs_indexes.get(collection, {}))
+        indexes[field] = index
+        _fs_indexes[collection] = indexes
+    return index
+
+
+# Unregisters the index of field of the collections named collection, existing lookup documents are kept
+def fs_drop_index(collection, field):
+    if isinstance(collection, type):
+        collection = fs_model_schema(collection).collection if issubclass(collection, Model) else collection.__name__
+    with _fs_indexes_lock:
+        indexes = dict(_fs_indexes.get(collection, {}))
+        indexes.pop(field, None)
+        _fs_indexes[collection] = indexes
+
+
+# Indexes of the collection col_path, by field
+def fs_collection_indexes(col_path) -> dict:
+    return _fs_indexes.get(col_path.rpartition('/')[2], {}) if col_path else {}
+
+
+# Checks the document read by an indexed write: the document must exist if exists is set, and have been last updated
+# at fs_last_update_time if provided, as the write options of unindexed writes
+def fs_index_check(fs_doc, exists=False, fs_last_update_time=None):
+    if (exists or fs_last_update_time is not None) and not fs_doc.exists:
+        raise NotFound('No document to update: {}'.format(fs_doc.reference.path))
+    if fs_last_update_time is not None and fs_doc.update_time != fs_last_update_time:
+        raise FailedPrecondition('The document {} was last updated at a different time'
+                                 .format(fs_doc.reference.path))
+
+
+# Properties written by an indexed write of operation (FSM_INDEX_SET, FSM_INDEX_MERGE, FSM_INDEX_UPDATE,
+# FSM_INDEX_DELETE), and document properties after the write, None for a deletion
+# Merges and updates: properties replace the previous properties, increments are added to them
+# Returns (data, properties after the write)
+def fs_index_properties(operation, previous, properties=None, increments=None):
+    if operation == FSM_INDEX_DELETE:
+        return None, None
+    data = dict(properties or {})
+    if operation == FSM_INDEX_SET:
+        return data, data
+    for name, amount in (increments or {}).items():
+        value = (previous or {}).get(name)
+        # As Increment transforms: non numeric values are replaced by the amount
+        data[name] = value + amount if isinstance(value, (int, float)) and not isinstance(value, bool) else amount
+    return data, {**(previous or {}), **data}
+
+
+# Adds the document write and the lookup document writes of an indexed write to a transaction
+# previous: document properties read by the transaction, None if the document does not exist
+def fs_index_write(transaction, client, fs_doc_ref, indexes, operation, previous, properties=None, increments=None):
+    data, properties = fs_index_properties(operation, previous, properties, increments)
+    if operation == FSM_INDEX_DELETE:
+        transaction.delete(fs_doc_ref)
+    elif operation == FSM_INDEX_UPDATE:
+        transaction.update(fs_doc_ref, data)
+    else:
+        transaction.set(fs_doc_ref, data, merge=operation == FSM_INDEX_MERGE)
+    for index in indexes.values():
+        index.writes(transaction, client, fs_doc_ref.path, previous, properties)
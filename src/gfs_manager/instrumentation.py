@@ -0,0 +1,422 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+
+import proto
+
+from gfs_manager.models import fs_model_schema
+
+# Instrumentation of GFSManager operations
+# Every public manager method call is an operation: its duration, RPCs, bytes written and read, documents read and
+# errors are recorded and reported to the manager instrumentation object
+# RPCs are intercepted at the Firestore client API, and attributed to the operation running in the current context
+# (thread or asyncio task, and worker threads of bulk operations)
+
+# Latency histogram bucket upper bounds, in milliseconds
+FSM_LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Firestore RPCs returning a stream of responses
+_FS_STREAMING_RPCS = ['batch_get_documents', 'run_query', 'run_aggregation_query', 'list_collection_ids',
+                      'list_documents', 'partition_query']
+
+# Operation running in the current context
+_fs_current_operation = contextvars.ContextVar('gfs_manager_operation', default=None)
+
+
+# A manager method call being instrumented
+class FSOperation:
+    def __init__(self, method, collection_path=None, instrumentation=None):
+        self.method = method
+        self.collection_path = collection_path
+        # App path prefix (FSM_APP_ROOT/FSM_APP_OBJECTS_PATH) of the collection
+        self.tenant = '/'.join(collection_path.split('/')[:2]) if collection_path else None
+        self.instrumentation = instrumentation
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.rpcs = {}
+        self.rpc_time = 0.0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.documents = 0
+        self.errors = []
+        # Tracing span, set by instrumentations supporting tracing
+        self.span = None
+        self.__lock = threading.Lock()
+
+    def add_rpc(self, rpc, elapsed, bytes_written=0):
+        with self.__lock:
+            self.rpcs[rpc] = self.rpcs.get(rpc, 0) + 1
+            self.rpc_time += elapsed
+            self.bytes_written += bytes_written
+
+    def add_read(self, documents, bytes_read):
+        with self.__lock:
+            self.documents += documents
+            self.bytes_read += bytes_read
+
+    def add_error(self, e):
+        with self.__lock:
+            # An exception raised by an RPC and logged by the manager is recorded once
+            if not any(error is e for error in self.errors):
+                self.errors.append(e)
+
+    @property
+    def rpc_count(self) -> int:
+        return sum(self.rpcs.values())
+
+
+# Instrumentation interface, hooks called by GFSManager, no-op implementation
+# Any object implementing these methods can be plugged into GFSManager with set_instrumentation
+class Instrumentation:
+    def on_operation_start(self, operation: FSOperation):
+        pass
+
+    def on_rpc(self, operation: FSOperation, rpc, elapsed, error=None):
+        pass
+
+    def on_operation_end(self, operation: FSOperation):
+        pass
+
+
+# Aggregated metrics per manager method, per collection path and per tenant (app path prefix):
+# calls, latency histogram, RPCs, bytes written and read, documents read and errors by exception type
+# tracer: optional OpenTelemetry compatible tracer (start_span), one span per operation with the collection path
+class MetricsInstrumentation(Instrumentation):
+    def __init__(self, tracer=None, buckets_ms=None):
+        self.tracer = tracer
+        self.buckets_ms = list(buckets_ms or FSM_LATENCY_BUCKETS_MS)
+        self.__lock = threading.Lock()
+        self.__methods = {}
+        self.__collections = {}
+        self.__tenants = {}
+
+    def _new_stats(self) -> dict:
+        return {'calls': 0, 'errors': {}, 'rpcs': {}, 'bytes_written': 0, 'bytes_read': 0, 'documents': 0,
+                'latency_ms': {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.buckets_ms) + 1)}}
+
+    def _add(self, stats, operation, elapsed_ms):
+        stats['calls'] += 1
+        for e in operation.errors:
+            stats['errors'][e.__class__.__name__] = stats['errors'].get(e.__class__.__name__, 0) + 1
+        for rpc, count in operation.rpcs.items():
+            stats['rpcs'][rpc] = stats['rpcs'].get(rpc, 0) + count
+        stats['bytes_written'] += operation.bytes_written
+        stats['bytes_read'] += operation.bytes_read
+        stats['documents'] += operation.documents
+        latency = stats['latency_ms']
+        latency['count'] += 1
+        latency['sum'] += elapsed_ms
+        latency['max'] = max(latency['max'], elapsed_ms)
+        bucket = next((i for i, bound in enumerate(self.buckets_ms) if elapsed_ms <= bound), len(self.buckets_ms))
+        latency['buckets'][bucket] += 1
+
+    def on_operation_start(self, operation):
+        if self.tracer is not None:
+            attributes = {'gfs.method': operation.method}
+            if operation.collection_path is not None:
+                attributes['gfs.collection_path'] = operation.collection_path
+                attributes['gfs.tenant'] = operation.tenant
+            operation.span = self.tracer.start_span('gfs_manager.' + operation.method, attributes=attributes)
+
+    def on_operation_end(self, operation):
+        elapsed_ms = operation.elapsed * 1000
+        with self.__lock:
+            self._add(self.__methods.setdefault(operation.method, self._new_stats()), operation, elapsed_ms)
+            if operation.collection_path is not None:
+                self._add(self.__collections.setdefault(operation.collection_path, self._new_stats()), operation,
+                          elapsed_ms)
+                self._add(self.__tenants.setdefault(operation.tenant, self._new_stats()), operation, elapsed_ms)
+        span = operation.span
+        if span is not None:
+            span.set_attribute('gfs.rpc_count', operation.rpc_count)
+            span.set_attribute('gfs.documents', operation.documents)
+            span.set_attribute('gfs.bytes_written', operation.bytes_written)
+            span.set_attribute('gfs.bytes_read', operation.bytes_read)
+            for e in operation.errors:
+                if hasattr(span, 'record_exception'):
+                    span.record_exception(e)
+            if operation.errors:
+                span.set_attribute('error.type', operation.errors[-1].__class__.__name__)
+            span.end()
+
+    # Latency at percentile (0-100) estimated from a latency histogram: upper bound of the bucket
+    def latency_percentile(self, latency, percentile):
+        if not latency['count']:
+            return None
+        rank = latency['count'] * percentile / 100
+        total = 0
+        for i, count in enumerate(latency['buckets']):
+            total += count
+            if total >= rank:
+                return self.buckets_ms[i] if i < len(self.buckets_ms) else latency['max']
+        return latency['max']
+
+    # Snapshot of the metrics: {'methods': {method: stats}, 'collections': {path: stats}, 'tenants': {prefix: stats}}
+    @property
+    def metrics(self) -> dict:
+        def export(stats):
+            stats = dict(stats, errors=dict(stats['errors']), rpcs=dict(stats['rpcs']),
+                         latency_ms=dict(stats['latency_ms'], buckets=list(stats['latency_ms']['buckets'])))
+            for percentile in (50, 95, 99):
+                stats['latency_ms']['p{}'.format(percentile)] = \
+                    self.latency_percentile(stats['latency_ms'], percentile)
+            return stats
+
+        with self.__lock:
+            return {'methods': {k: export(v) for k, v in self.__methods.items()},
+                    'collections': {k: export(v) for k, v in self.__collections.items()},
+                    'tenants': {k: export(v) for k, v in self.__tenants.items()},
+                    'buckets_ms': list(self.buckets_ms)}
+
+    def reset(self):
+        with self.__lock:
+            self.__methods.clear()
+            self.__collections.clear()
+            self.__tenants.clear()
+
+
+def _fs_message_size(message) -> int:
+    raw = type(message).pb(message) if isinstance(message, proto.Message) else message
+    return raw.ByteSize() if hasattr(raw, 'ByteSize') else 0
+
+
+# Document returned by a batch get or query response, None if the response has no document
+def _fs_response_document(response):
+    raw = type(response).pb(response) if isinstance(response, proto.Message) else response
+    for field in ('found', 'document'):
+        if field in raw.DESCRIPTOR.fields_by_name and raw.HasField(field):
+            return getattr(raw, field)
+    return None
+
+
+def _fs_request_size(rpc, request) -> int:
+    # Bytes written: documents and transforms sent by commits
+    if rpc == 'commit' and request:
+        return sum(_fs_message_size(write) for write in request.get('writes', ()))
+    return 0
+
+
+def _fs_count_response(operation, response):
+    document = _fs_response_document(response)
+    if document is not None:
+        operation.add_read(1, document.ByteSize())
+
+
+def _fs_count_responses(operation, responses):
+    for response in responses:
+        _fs_count_response(operation, response)
+        yield response
+
+
+async def _fs_async_count_responses(operation, responses):
+    async for response in responses:
+        _fs_count_response(operation, response)
+        yield response
+
+
+def _fs_rpc_done(operation, rpc, start, request, error=None):
+    elapsed = time.perf_counter() - start
+    operation.add_rpc(rpc, elapsed, _fs_request_size(rpc, request))
+    if error is not None:
+        operation.add_error(error)
+    operation.instrumentation.on_rpc(operation, rpc, elapsed, error)
+
+
+# Firestore client API proxy, records the RPCs of the current operation
+class _InstrumentedFirestoreAPI:
+    def __init__(self, api):
+        self._fs_api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._fs_api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            operation = _fs_current_operation.get()
+            if operation is None:
+                return attr(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                _fs_rpc_done(operation, name, start, kwargs.get('request'), e)
+                raise
+            _fs_rpc_done(operation, name, start, kwargs.get('request'))
+            return _fs_count_responses(operation, result) if name in _FS_STREAMING_RPCS else result
+        return call
+
+
+# Firestore async client API proxy
+class _AsyncInstrumentedFirestoreAPI(_InstrumentedFirestoreAPI):
+    def __getattr__(self, name):
+        attr = getattr(self._fs_api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            operation = _fs_current_operation.get()
+            if operation is None:
+                return await attr(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = await attr(*args, **kwargs)
+            except Exception as e:
+                _fs_rpc_done(operation, name, start, kwargs.get('request'), e)
+                raise
+            _fs_rpc_done(operation, name, start, kwargs.get('request'))
+            return _fs_async_count_responses(operation, result) if name in _FS_STREAMING_RPCS else result
+        return call
+
+
+# Installs the RPC recording proxy on a Firestore client (sync or async), once per client
+# RPCs made outside instrumented operations, e.g. by other managers sharing the client, are not recorded
+def fs_instrument_client(fs_client, async_client=False):
+    api = fs_client._firestore_api
+    if not isinstance(api, _InstrumentedFirestoreAPI):
+        proxy_class = _AsyncInstrumentedFirestoreAPI if async_client else _InstrumentedFirestoreAPI
+        fs_client._firestore_api_internal = proxy_class(api)
+    return fs_client
+
+
+# Records an exception in the current operation, if any
+def fs_record_error(e):
+    operation = _fs_current_operation.get()
+    if operation is not None:
+        operation.add_error(e)
+
+
+# Wraps fn to run in the current context (instrumented operation, call retry policy), for functions run by worker
+# threads
+def fs_bind_operation(fn):
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        # A context is entered by one thread at a time: every call runs in its own copy
+        return context.copy().run(fn, *args, **kwargs)
+    return bound
+
+
+# Collection path of a manager method call, from its arguments
+def _fs_operation_path(manager, arguments):
+    if arguments.get('fs_collection_path'):
+        return arguments['fs_collection_path']
+    for doc_path in ('fs_path', 'fs_doc_path'):
+        if arguments.get(doc_path):
+            return arguments[doc_path].rpartition('/')[0]
+    try:
+        lookup_collection = arguments.get('lookup_collection')
+        # Typed models: collection of the model class
+        model_class = arguments['model'].__class__ if 'model' in arguments else arguments.get('model_class')
+        if model_class is not None:
+            lookup_collection = fs_model_schema(model_class).collection
+        return manager._fs_collection_path(arguments.get('app_object'), arguments.get('parent_doc_path'),
+                                           lookup_collection)
+    except Exception:
+        # Manager not connected, or not a model class
+        return None
+
+
+# Decorator of manager methods (functions, generators, coroutines and async generators) recorded as operations
+# Only when the manager has an instrumentation, calls nested in an operation are part of the outer operation
+def fs_instrumented(method):
+    signature = inspect.signature(method)
+
+    def start(manager, args, kwargs):
+        instrumentation = manager.instrumentation
+        if instrumentation is None or _fs_current_operation.get() is not None:
+            return None
+        arguments = signature.bind_partial(manager, *args, **kwargs).arguments
+        operation = FSOperation(method.__name__, _fs_operation_path(manager, arguments), instrumentation)
+        instrumentation.on_operation_start(operation)
+        return operation
+
+    def end(operation):
+        operation.elapsed = time.perf_counter() - operation.start
+        operation.instrumentation.on_operation_end(operation)
+
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def wrapper(manager, *args, **kwargs):
+            operation = start(manager, args, kwargs)
+            if operation is None:
+                async for item in method(manager, *args, **kwargs):
+                    yield item
+                return
+            # The operation is only current while the generator runs, not while the caller handles its items
+            items = method(manager, *args, **kwargs)
+            try:
+                while True:
+                    token = _fs_current_operation.set(operation)
+                    try:
+                        item = await items.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    except Exception as e:
+                        operation.add_error(e)
+                        raise
+                    finally:
+                        _fs_current_operation.reset(token)
+                    yield item
+            finally:
+                await items.aclose()
+                end(operation)
+    elif inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(manager, *args, **kwargs):
+            operation = start(manager, args, kwargs)
+            if operation is None:
+                return await method(manager, *args, **kwargs)
+            token = _fs_current_operation.set(operation)
+            try:
+                return await method(manager, *args, **kwargs)
+            except Exception as e:
+                operation.add_error(e)
+                raise
+            finally:
+                _fs_current_operation.reset(token)
+                end(operation)
+    elif inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def wrapper(manager, *args, **kwargs):
+            operation = start(manager, args, kwargs)
+            if operation is None:
+                yield from method(manager, *args, **kwargs)
+                return
+            # The operation is only current while the generator runs, not while the caller handles its items
+            items = method(manager, *args, **kwargs)
+            try:
+                while True:
+                    token = _fs_current_operation.set(operation)
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        operation.add_error(e)
+                        raise
+                    finally:
+                        _fs_current_operation.reset(token)
+                    yield item
+            finally:
+                items.close()
+                end(operation)
+    else:
+        @functools.wraps(method)
+        def wrapper(manager, *args, **kwargs):
+            operation = start(manager, args, kwargs)
+            if operation is None:
+                return method(manager, *args, **kwargs)
+            token = _fs_current_operation.set(operation)
+            try:
+                return method(manager, *args, **kwargs)
+            except Exception as e:
+                operation.add_error(e)
+                raise
+            finally:
+                _fs_current_operation.reset(token)
+                end(operation)
+    return wrapper
@@ -0,0 +1,902 @@
+import functools
+import math
+import queue
+import re
+import threading
+import time
+import uuid
+import weakref
+
+import proto
+from google.api_core.exceptions import Aborted, AlreadyExists, Cancelled, FailedPrecondition, InvalidArgument, \
+    NotFound
+from google.api_core.retry import AsyncRetry, Retry
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from google.cloud.firestore_v1 import types
+from google.cloud.firestore_v1.field_path import parse_field_path
+from google.protobuf import timestamp_pb2
+
+# In-memory Firestore backend
+# Replaces the Firestore RPC API (commit, batch get, queries, aggregations, transactions) of a Firestore client with an
+# in-process database, so the client library (references, queries, batches, transactions) runs unchanged on top of it
+# Used to run the GFSManager tests offline and for local benchmarking, with FSM_BACKEND = 'memory'
+# Listeners (on_snapshot) receive the changes of the target documents after every commit
+# Not supported: bulk writer, read time (point in time) reads, listeners of async clients (not implemented by the client
+# library)
+# Transactions are optimistic: a transaction commit is aborted, and retried by the client library, when a document
+# read by the transaction was modified after being read
+
+# Default project of in-memory clients
+FSM_MEMORY_PROJECT = 'gfs-memory'
+
+_Document = types.Document.pb()
+_Value = types.Value.pb()
+_Cursor = types.Cursor.pb()
+_WriteResult = types.WriteResult.pb()
+_CommitResponse = types.CommitResponse.pb()
+_BatchGetDocumentsResponse = types.BatchGetDocumentsResponse.pb()
+_RunQueryResponse = types.RunQueryResponse.pb()
+_RunAggregationQueryResponse = types.RunAggregationQueryResponse.pb()
+_ListenResponse = types.ListenResponse.pb()
+_TargetChange = types.TargetChange.pb()
+
+_FieldOperator = types.StructuredQuery.FieldFilter.Operator
+_UnaryOperator = types.StructuredQuery.UnaryFilter.Operator
+_CompositeOperator = types.StructuredQuery.CompositeFilter.Operator
+_DESCENDING = types.StructuredQuery.Direction.DESCENDING
+_RANGE_OPERATORS = [_FieldOperator.LESS_THAN, _FieldOperator.LESS_THAN_OR_EQUAL, _FieldOperator.GREATER_THAN,
+                    _FieldOperator.GREATER_THAN_OR_EQUAL]
+_INEQUALITY_OPERATORS = _RANGE_OPERATORS + [_FieldOperator.NOT_EQUAL, _FieldOperator.NOT_IN]
+
+# Numeric document ids (__id<n>__) sort before string ids
+_NUMERIC_ID = re.compile(r'^__id(-?\d+)__$')
+
+
+def _raw(message):
+    # Protobuf message wrapped by a proto-plus message
+    return type(message).pb(message) if isinstance(message, proto.Message) else message
+
+
+def _timestamp(ns) -> timestamp_pb2.Timestamp:
+    return timestamp_pb2.Timestamp(seconds=ns // 1000000000, nanos=ns % 1000000000)
+
+
+def _segments(path) -> tuple:
+    return tuple(segment for segment in path.split('/') if segment)
+
+
+def _segment_key(segment) -> tuple:
+    numeric_id = _NUMERIC_ID.match(segment)
+    return (0, int(numeric_id.group(1))) if numeric_id else (1, segment)
+
+
+@functools.lru_cache(maxsize=1024)
+def _field_parts(field_path) -> tuple:
+    return tuple(parse_field_path(field_path))
+
+
+# Sort key of a Firestore value, following Firestore ordering of value types
+# https://firebase.google.com/docs/firestore/manage-data/data-types#value_type_ordering
+def _value_key(value) -> tuple:
+    kind = value.WhichOneof('value_type')
+    if kind == 'null_value' or kind is None:
+        return 0,
+    if kind == 'boolean_value':
+        return 1, value.boolean_value
+    if kind == 'integer_value':
+        return 2, 1, value.integer_value
+    if kind == 'double_value':
+        # NaN sorts before any other number
+        return (2, 0) if math.isnan(value.double_value) else (2, 1, value.double_value)
+    if kind == 'timestamp_value':
+        return 3, value.timestamp_value.seconds, value.timestamp_value.nanos
+    if kind == 'string_value':
+        return 4, value.string_value
+    if kind == 'bytes_value':
+        return 5, value.bytes_value
+    if kind == 'reference_value':
+        return 6, _reference_key(value.reference_value)
+    if kind == 'geo_point_value':
+        return 7, value.geo_point_value.latitude, value.geo_point_value.longitude
+    if kind == 'array_value':
+        return 8, tuple(_value_key(v) for v in value.array_value.values)
+    return 9, tuple(sorted((k, _value_key(v)) for k, v in value.map_value.fields.items()))
+
+
+def _reference_key(name) -> tuple:
+    # Document names: projects/{project}/databases/{database}/documents/{path}
+    path = name.split('/documents', 1)[1] if '/documents' in name else name
+    return tuple(_segment_key(segment) for segment in _segments(path))
+
+
+def _number(value):
+    kind = value.WhichOneof('value_type') if value is not None else None
+    if kind == 'integer_value':
+        return value.integer_value
+    if kind == 'double_value':
+        return value.double_value
+    return None
+
+
+def _number_value(number) -> _Value:
+    if isinstance(number, int):
+        return _Value(integer_value=number)
+    return _Value(double_value=number)
+
+
+def _array_value(values) -> _Value:
+    array = _Value()
+    array.array_value.SetInParent()
+    array.array_value.values.extend(values)
+    return array
+
+
+# Value at a field path (tuple of field names) of a document fields map, None if not present
+def _get_value(fields, parts):
+    value = None
+    for part in parts:
+        if fields is None or part not in fields:
+            return None
+        value = fields[part]
+        fields = value.map_value.fields if value.WhichOneof('value_type') == 'map_value' else None
+    return value
+
+
+def _set_value(fields, parts, value):
+    for part in parts[:-1]:
+        child = fields[part]
+        if child.WhichOneof('value_type') != 'map_value':
+            child.Clear()
+            child.map_value.SetInParent()
+        fields = child.map_value.fields
+    fields[parts[-1]].CopyFrom(value)
+
+
+def _delete_value(fields, parts):
+    for part in parts[:-1]:
+        if part not in fields or fields[part].WhichOneof('value_type') != 'map_value':
+            return
+        fields = fields[part].map_value.fields
+    if parts[-1] in fields:
+        del fields[parts[-1]]
+
+
+def _compare_keys(keys, other_keys, descending) -> int:
+    for key, other_key, desc in zip(keys, other_keys, descending):
+        if key != other_key:
+            result = -1 if key < other_key else 1
+            return -result if desc else result
+    return 0
+
+
+def _field_filter_matches(value, op, operand) -> bool:
+    if value is None:
+        # Documents without the field never match a field filter
+        return False
+    key = _value_key(value)
+    if op == _FieldOperator.EQUAL:
+        return key == _value_key(operand)
+    if op == _FieldOperator.NOT_EQUAL:
+        return key != _value_key(operand)
+    if op in _RANGE_OPERATORS:
+        operand_key = _value_key(operand)
+        # Range filters only match values of the same type
+        if key[0] != operand_key[0] or key == (2, 0) or operand_key == (2, 0):
+            return False
+        if op == _FieldOperator.LESS_THAN:
+            return key < operand_key
+        if op == _FieldOperator.LESS_THAN_OR_EQUAL:
+            return key <= operand_key
+        if op == _FieldOperator.GREATER_THAN:
+            return key > operand_key
+        return key >= operand_key
+    if op == _FieldOperator.IN:
+        return key in set(_value_key(v) for v in operand.array_value.values)
+    if op == _FieldOperator.NOT_IN:
+        return key != (0,) and key not in set(_value_key(v) for v in operand.array_value.values)
+    if value.WhichOneof('value_type') != 'array_value':
+        return False
+    elements = set(_value_key(v) for v in value.array_value.values)
+    if op == _FieldOperator.ARRAY_CONTAINS:
+        return _value_key(operand) in elements
+    if op == _FieldOperator.ARRAY_CONTAINS_ANY:
+        return any(_value_key(v) in elements for v in operand.array_value.values)
+    raise InvalidArgument('Unsupported field filter operator {}'.format(op))
+
+
+# In-memory Firestore database
+# Documents are stored as Firestore protobuf documents, by collection path and document id
+# Stored documents are never modified, commits replace them
+class MemoryDatabase:
+    def __init__(self, name):
+        # projects/{project}/databases/{database}
+        self.name = name
+        self.__documents_prefix = name + '/documents'
+        self.__lock = threading.RLock()
+        # {collection path: {document id: document}}
+        self.__collections = {}
+        # Documents read by open transactions: {transaction id: {document path: update time}}
+        self.__transactions = {}
+        self.__clock_ns = 0
+        # Listen streams notified of every commit
+        self.__listeners = []
+
+    # Path relative to the database documents root of a document or parent resource name
+    def _path(self, name) -> str:
+        if name.startswith(self.__documents_prefix):
+            name = name[len(self.__documents_prefix):]
+        return '/'.join(_segments(name))
+
+    # Commit timestamp, strictly increasing, microsecond precision
+    def _tick(self) -> int:
+        self.__clock_ns = max(time.time_ns() // 1000 * 1000, self.__clock_ns + 1000)
+        return self.__clock_ns
+
+    def _read_time(self) -> timestamp_pb2.Timestamp:
+        return _timestamp(max(time.time_ns() // 1000 * 1000, self.__clock_ns))
+
+    def _get(self, path):
+        col_path, _, doc_id = path.rpartition('/')
+        return self.__collections.get(col_path, {}).get(doc_id)
+
+    def _put(self, path, doc):
+        col_path, _, doc_id = path.rpartition('/')
+        if doc is not None:
+            self.__collections.setdefault(col_path, {})[doc_id] = doc
+        else:
+            docs = self.__collections.get(col_path)
+            if docs is not None:
+                docs.pop(doc_id, None)
+                if not docs:
+                    del self.__collections[col_path]
+
+    # Number of stored documents
+    def __len__(self):
+        with self.__lock:
+            return sum(len(docs) for docs in self.__collections.values())
+
+    # Removes every document
+    def clear(self):
+        with self.__lock:
+            self.__collections.clear()
+            self.__transactions.clear()
+            self._notify()
+
+    def add_listener(self, listener):
+        with self.__lock:
+            self.__listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.__lock:
+            if listener in self.__listeners:
+                self.__listeners.remove(listener)
+
+    # Listeners are notified in commit order, holding the database lock
+    def _notify(self):
+        for listener in list(self.__listeners):
+            listener.on_commit()
+
+    # Documents of a listen target (query or documents), returns ({document name: document}, read time)
+    def target_documents(self, target) -> tuple:
+        with self.__lock:
+            if target.HasField('query'):
+                docs = self._run_query(target.query.parent, target.query.structured_query)
+            else:
+                docs = [(self._path(name), self._get(self._path(name))) for name in target.documents.documents]
+            return {doc.name: doc for path, doc in docs if doc is not None}, self._read_time()
+
+    def _record_reads(self, transaction, docs_by_path):
+        if transaction:
+            reads = self.__transactions.get(transaction)
+            if reads is None:
+                raise InvalidArgument('Transaction {} is not active'.format(transaction))
+            for path, doc in docs_by_path:
+                reads.setdefault(path, (doc.update_time.seconds, doc.update_time.nanos) if doc is not None else None)
+
+    def begin_transaction(self) -> bytes:
+        with self.__lock:
+            transaction = uuid.uuid4().bytes
+            self.__transactions[transaction] = {}
+            return transaction
+
+    def rollback(self, transaction):
+        with self.__lock:
+            self.__transactions.pop(transaction, None)
+
+    # Applies writes atomically, returns the commit response
+    def commit(self, writes, transaction=None):
+        with self.__lock:
+            if transaction:
+                reads = self.__transactions.pop(transaction, None)
+                if reads is None:
+                    raise InvalidArgument('Transaction {} is not active'.format(transaction))
+                for path, update_time in reads.items():
+                    doc = self._get(path)
+                    if update_time != ((doc.update_time.seconds, doc.update_time.nanos) if doc is not None else None):
+                        raise Aborted('Transaction aborted, document {} was modified'.format(path))
+            commit_time = _timestamp(self._tick())
+            # Documents written by the commit, applied once every write is validated
+            staged = {}
+            write_results = [self._apply_write(_raw(write), staged, commit_time) for write in writes]
+            for path, doc in staged.items():
+                self._put(path, doc)
+            self._notify()
+            return _CommitResponse(write_results=write_results, commit_time=commit_time)
+
+    def _apply_write(self, write, staged, commit_time):
+        operation = write.WhichOneof('operation')
+        if operation == 'update':
+            name = write.update.name
+        elif operation == 'delete':
+            name = write.delete
+        else:
+            name = write.transform.document
+        path = self._path(name)
+        current = staged[path] if path in staged else self._get(path)
+
+        if write.HasField('current_document'):
+            precondition = write.current_document
+            if precondition.WhichOneof('condition_type') == 'exists':
+                if precondition.exists and current is None:
+                    raise NotFound('No document to update: {}'.format(name))
+                if not precondition.exists and current is not None:
+                    raise AlreadyExists('Document already exists: {}'.format(name))
+            elif current is None or current.update_time != precondition.update_time:
+                raise FailedPrecondition('The document {} was last updated at a different time'.format(name))
+
+        if operation == 'delete':
+            staged[path] = None
+            return _WriteResult()
+
+        doc = _Document(name=name)
+        if operation == 'update' and not write.HasField('update_mask'):
+            doc.fields.MergeFrom(write.update.fields)
+        else:
+            if current is not None:
+                doc.fields.MergeFrom(current.fields)
+            if operation == 'update':
+                for field_path in write.update_mask.field_paths:
+                    parts = _field_parts(field_path)
+                    value = _get_value(write.update.fields, parts)
+                    if value is None:
+                        _delete_value(doc.fields, parts)
+                    else:
+                        _set_value(doc.fields, parts, value)
+        field_transforms = write.update_transforms if operation == 'update' else write.transform.field_transforms
+        transform_results = [self._apply_transform(doc.fields, field_transform, commit_time)
+                             for field_transform in field_transforms]
+
+        if current is not None:
+            doc.create_time.CopyFrom(current.create_time)
+            # Writes not changing the document keep its update time
+            unchanged = dict(doc.fields) == dict(current.fields)
+            doc.update_time.CopyFrom(current.update_time if unchanged else commit_time)
+        else:
+            doc.create_time.CopyFrom(commit_time)
+            doc.update_time.CopyFrom(commit_time)
+        staged[path] = doc
+        return _WriteResult(update_time=doc.update_time, transform_results=transform_results)
+
+    @staticmethod
+    def _apply_transform(fields, field_transform, commit_time):
+        parts = _field_parts(field_transform.field_path)
+        current = _get_value(fields, parts)
+        kind = field_transform.WhichOneof('transform_type')
+        if kind == 'set_to_server_value':
+            result = _Value(timestamp_value=commit_time)
+        elif kind in ('increment', 'maximum', 'minimum'):
+            operand = getattr(field_transform, kind)
+            number, operand_number = _number(current), _number(operand)
+            if number is None:
+                result = operand
+            elif kind == 'increment':
+                result = _number_value(number + operand_number)
+            elif kind == 'maximum':
+                result = operand if operand_number > number else current
+            else:
+                result = operand if operand_number < number else current
+        else:
+            elements = list(current.array_value.values) \
+                if current is not None and current.WhichOneof('value_type') == 'array_value' else []
+            if kind == 'append_missing_elements':
+                keys = [_value_key(v) for v in elements]
+                for value in field_transform.append_missing_elements.values:
+                    if _value_key(value) not in keys:
+                        elements.append(value)
+                        keys.append(_value_key(value))
+            else:
+                removed = set(_value_key(v) for v in field_transform.remove_all_from_array.values)
+                elements = [v for v in elements if _value_key(v) not in removed]
+            result = _array_value(elements)
+        # Copy, result may be the current value
+        copied = _Value()
+        copied.CopyFrom(result)
+        _set_value(fields, parts, copied)
+        return copied
+
+    @staticmethod
+    def _project(doc, field_paths):
+        projected = _Document(name=doc.name, create_time=doc.create_time, update_time=doc.update_time)
+        for field_path in field_paths:
+            if field_path != '__name__':
+                parts = _field_parts(field_path)
+                value = _get_value(doc.fields, parts)
+                if value is not None:
+                    _set_value(projected.fields, parts, value)
+        return projected
+
+    def batch_get_documents(self, names, mask=None, transaction=None) -> list:
+        with self.__lock:
+            read_time = self._read_time()
+            docs = [(self._path(name), name) for name in names]
+            docs = [(path, name, self._get(path)) for path, name in docs]
+            self._record_reads(transaction, [(path, doc) for path, name, doc in docs])
+            responses = []
+            for path, name, doc in docs:
+                if doc is None:
+                    responses.append(_BatchGetDocumentsResponse(missing=name, read_time=read_time))
+                else:
+                    if mask is not None:
+                        doc = self._project(doc, mask.field_paths)
+                    responses.append(_BatchGetDocumentsResponse(found=doc, read_time=read_time))
+            return responses
+
+    # Documents in the query collections, before filters
+    def _documents(self, parent_path, collection_id, all_descendants):
+        if not all_descendants:
+            col_path = parent_path + '/' + collection_id if parent_path else collection_id
+            return list(self.__collections.get(col_path, {}).values())
+        prefix = parent_path + '/' if parent_path else ''
+        docs = []
+        for col_path, col_docs in self.__collections.items():
+            if col_path.startswith(prefix) and (not collection_id or col_path.rpartition('/')[2] == collection_id):
+                docs.extend(col_docs.values())
+        return docs
+
+    def _field_value(self, doc, field_path):
+        if field_path == '__name__':
+            return _Value(reference_value=doc.name)
+        return _get_value(doc.fields, _field_parts(field_path))
+
+    def _matches(self, doc, query_filter) -> bool:
+        kind = query_filter.WhichOneof('filter_type')
+        if kind == 'composite_filter':
+            matches = (self._matches(doc, f) for f in query_filter.composite_filter.filters)
+            return any(matches) if query_filter.composite_filter.op == _CompositeOperator.OR else all(matches)
+        if kind == 'field_filter':
+            field_filter = query_filter.field_filter
+            value = self._field_value(doc, field_filter.field.field_path)
+            return _field_filter_matches(value, field_filter.op, field_filter.value)
+        unary_filter = query_filter.unary_filter
+        value = self._field_value(doc, unary_filter.field.field_path)
+        if value is None:
+            return False
+        key = _value_key(value)
+        if unary_filter.op == _UnaryOperator.IS_NAN:
+            return key == (2, 0)
+        if unary_filter.op == _UnaryOperator.IS_NULL:
+            return key == (0,)
+        if unary_filter.op == _UnaryOperator.IS_NOT_NAN:
+            return key != (2, 0)
+        return key != (0,)
+
+    @staticmethod
+    def _inequality_fields(query_filter, fields):
+        kind = query_filter.WhichOneof('filter_type')
+        if kind == 'composite_filter':
+            for f in query_filter.composite_filter.filters:
+                MemoryDatabase._inequality_fields(f, fields)
+        elif kind == 'field_filter' and query_filter.field_filter.op in _INEQUALITY_OPERATORS:
+            if query_filter.field_filter.field.field_path not in fields:
+                fields.append(query_filter.field_filter.field.field_path)
+        return fields
+
+    # Documents matching a structured query, in query order, as (document path, document)
+    def _run_query(self, parent, query) -> list:
+        selector = query.from_[0]
+        docs = self._documents(self._path(parent), selector.collection_id, selector.all_descendants)
+        if query.HasField('where'):
+            docs = [doc for doc in docs if self._matches(doc, query.where)]
+
+        # Explicit orders, then inequality fields and document name as Firestore implicit orders
+        orders = [(order.field.field_path, order.direction == _DESCENDING) for order in query.order_by]
+        order_fields = [field_path for field_path, descending in orders]
+        if query.HasField('where'):
+            for field_path in self._inequality_fields(query.where, []):
+                if field_path not in order_fields:
+                    orders.append((field_path, False))
+        if '__name__' not in order_fields:
+            orders.append(('__name__', orders[-1][1] if orders else False))
+        descending = [desc for field_path, desc in orders]
+
+        # Documents without a value for an order field are not returned
+        keyed = []
+        for doc in docs:
+            values = [self._field_value(doc, field_path) for field_path, desc in orders]
+            if all(value is not None for value in values):
+                keyed.append(([_value_key(value) for value in values], doc))
+        keyed.sort(key=functools.cmp_to_key(lambda a, b: _compare_keys(a[0], b[0], descending)))
+
+        if query.HasField('start_at'):
+            cursor = [_value_key(v) for v in query.start_at.values]
+            before = query.start_at.before
+            keyed = [(keys, doc) for keys, doc in keyed
+                     if _compare_keys(keys, cursor, descending) > (-1 if before else 0)]
+        if query.HasField('end_at'):
+            cursor = [_value_key(v) for v in query.end_at.values]
+            before = query.end_at.before
+            keyed = [(keys, doc) for keys, doc in keyed
+                     if _compare_keys(keys, cursor, descending) < (0 if before else 1)]
+
+        docs = [doc for keys, doc in keyed][query.offset:]
+        if query.HasField('limit'):
+            docs = docs[:query.limit.value]
+        if query.HasField('select'):
+            docs = [self._project(doc, [f.field_path for f in query.select.fields]) for doc in docs]
+        return [(self._path(doc.name), doc) for doc in docs]
+
+    def run_query(self, parent, structured_query, transaction=None) -> list:
+        with self.__lock:
+            read_time = self._read_time()
+            docs = self._run_query(parent, _raw(structured_query))
+            self._record_reads(transaction, docs)
+            if not docs:
+                # Firestore reports the read time of empty results
+                return [_RunQueryResponse(read_time=read_time)]
+            return [_RunQueryResponse(document=doc, read_time=read_time) for path, doc in docs]
+
+    def run_aggregation_query(self, parent, structured_aggregation_query, transaction=None) -> list:
+        structured_aggregation_query = _raw(structured_aggregation_query)
+        with self.__lock:
+            read_time = self._read_time()
+            docs = self._run_query(parent, structured_aggregation_query.structured_query)
+            self._record_reads(transaction, docs)
+            response = _RunAggregationQueryResponse(read_time=read_time)
+            for aggregation in structured_aggregation_query.aggregations:
+                count = len(docs)
+                if aggregation.count.HasField('up_to'):
+                    count = min(count, aggregation.count.up_to.value)
+                response.result.aggregate_fields[aggregation.alias].integer_value = count
+            return [response]
+
+    # Ids of the collections directly under parent (database root or document) holding documents
+    def list_collection_ids(self, parent) -> list:
+        parent_path = self._path(parent)
+        depth = len(_segments(parent_path)) + 1
+        with self.__lock:
+            col_paths = [_segments(col_path) for col_path in self.__collections]
+        prefix = _segments(parent_path)
+        return sorted(set(col[depth - 1] for col in col_paths if len(col) >= depth and col[:depth - 1] == prefix))
+
+    # Documents of a collection, including missing documents with subcollections
+    def list_documents(self, parent, collection_id) -> list:
+        parent_path = self._path(parent)
+        col_path = parent_path + '/' + collection_id if parent_path else collection_id
+        depth = len(_segments(col_path))
+        with self.__lock:
+            names = set(doc.name for doc in self.__collections.get(col_path, {}).values())
+            for path in self.__collections:
+                segments = _segments(path)
+                if len(segments) > depth + 1 and '/'.join(segments[:depth]) == col_path:
+                    names.add(self.__documents_prefix + '/' + '/'.join(segments[:depth + 1]))
+        return [_Document(name=name) for name in sorted(names, key=_reference_key)]
+
+    # Split points of a collection group query, evenly distributed amongst the matching documents
+    # Up to partition_count split points, as Firestore returns, splitting the documents in partition_count + 1 parts
+    def partition_query(self, parent, structured_query, partition_count) -> list:
+        with self.__lock:
+            docs = self._run_query(parent, _raw(structured_query))
+        if partition_count < 1 or len(docs) < 2:
+            return []
+        positions = sorted(set(len(docs) * i // (partition_count + 1) for i in range(1, partition_count + 1)) - {0})
+        points = [docs[i][1].name for i in positions]
+        return [_Cursor(values=[_Value(reference_value=name)]) for name in points]
+
+
+# Listen stream of a target: target documents when opened, then the target changes after every commit
+# Implements the parts of a gRPC streaming call used by the client library listeners (google.api_core.bidi)
+class _MemoryListenCall:
+    def __init__(self, database, target):
+        self.__database = database
+        self.__target = target
+        self.__responses = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__active = True
+        self.__callbacks = []
+        # Documents sent to the client: {document name: update time}
+        self.__sent = {}
+        self.__put_target_change(_TargetChange.TargetChangeType.ADD, [target.target_id])
+        # Documents held by the client from a previous stream are discarded
+        self.__put_target_change(_TargetChange.TargetChangeType.RESET, [target.target_id])
+        database.add_listener(self)
+        with self.__lock:
+            self.__send_changes(initial=True)
+
+    def __put_target_change(self, change_type, target_ids, read_time=None):
+        self.__responses.put(_ListenResponse(target_change=_TargetChange(
+            target_change_type=change_type, target_ids=target_ids, read_time=read_time)))
+
+    # Changed and removed documents since the last changes sent, then a consistent snapshot marker
+    def __send_changes(self, initial=False):
+        docs, read_time = self.__database.target_documents(self.__target)
+        target_ids = [self.__target.target_id]
+        changed = False
+        for name, doc in docs.items():
+            update_time = (doc.update_time.seconds, doc.update_time.nanos)
+            if self.__sent.get(name) != update_time:
+                self.__responses.put(_ListenResponse(document_change=types.DocumentChange.pb()(
+                    document=doc, target_ids=target_ids)))
+                self.__sent[name] = update_time
+                changed = True
+        for name in [name for name in self.__sent if name not in docs]:
+            self.__responses.put(_ListenResponse(document_remove=types.DocumentRemove.pb()(
+                document=name, removed_target_ids=target_ids)))
+            del self.__sent[name]
+            changed = True
+        if initial:
+            self.__put_target_change(_TargetChange.TargetChangeType.CURRENT, target_ids)
+        if initial or changed:
+            self.__put_target_change(_TargetChange.TargetChangeType.NO_CHANGE, [], read_time)
+
+    def on_commit(self):
+        with self.__lock:
+            if self.__active:
+                self.__send_changes()
+
+    def add_done_callback(self, callback):
+        self.__callbacks.append(callback)
+
+    def is_active(self) -> bool:
+        return self.__active
+
+    def cancel(self):
+        self.fail(Cancelled('Listen stream cancelled'))
+
+    # Terminates the stream with error
+    def fail(self, error):
+        with self.__lock:
+            if not self.__active:
+                return
+            self.__active = False
+        self.__database.remove_listener(self)
+        self.__responses.put(error)
+        for callback in self.__callbacks:
+            callback(error)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        response = self.__responses.get()
+        if isinstance(response, Cancelled):
+            # Cancelled by the client: a response ignored by listeners lets the consumer thread exit on its own
+            self.__responses.put(response)
+            return types.ListenResponse.wrap(_ListenResponse(target_change=_TargetChange(
+                target_change_type=_TargetChange.TargetChangeType.NO_CHANGE, target_ids=[self.__target.target_id])))
+        if isinstance(response, Exception):
+            self.__responses.put(response)
+            raise response
+        return types.ListenResponse.wrap(response)
+
+
+# RPC of the in-memory API: counted, failing with the injected errors if any, and retried with the retry argument
+# of the call as the Firestore API does
+def _memory_rpc(method):
+    @functools.wraps(method)
+    def rpc(self, request, metadata=None, retry=None, timeout=None, **kwargs):
+        def attempt():
+            self._count(method.__name__)
+            self._raise_injected_error(method.__name__)
+            return method(self, request, metadata)
+        if isinstance(retry, Retry):
+            return retry(attempt)()
+        return attempt()
+    return rpc
+
+
+# Firestore RPC API backed by a MemoryDatabase, counts calls per RPC
+class _MemoryFirestoreAPI:
+    def __init__(self, database):
+        self.database = database
+        self.__lock = threading.Lock()
+        self.__rpc_counts = {}
+        self.__injected_errors = {}
+        self.__listen_calls = weakref.WeakSet()
+
+    @property
+    def rpc_counts(self) -> dict:
+        with self.__lock:
+            return dict(self.__rpc_counts)
+
+    def _count(self, rpc):
+        with self.__lock:
+            self.__rpc_counts[rpc] = self.__rpc_counts.get(rpc, 0) + 1
+
+    # The next calls of rpc fail with errors, one error per call
+    # Listen errors terminate the active listen streams first
+    def inject_errors(self, rpc, errors):
+        errors = list(errors)
+        if rpc == 'listen':
+            for call in list(self.__listen_calls):
+                if errors and call.is_active():
+                    call.fail(errors.pop(0))
+        with self.__lock:
+            self.__injected_errors.setdefault(rpc, []).extend(errors)
+
+    def _raise_injected_error(self, rpc):
+        with self.__lock:
+            errors = self.__injected_errors.get(rpc)
+            error = errors.pop(0) if errors else None
+        if error is not None:
+            raise error
+
+    @_memory_rpc
+    def commit(self, request, metadata=None):
+        response = self.database.commit(request['writes'], request.get('transaction'))
+        return types.CommitResponse.wrap(response)
+
+    @_memory_rpc
+    def batch_get_documents(self, request, metadata=None):
+        responses = self.database.batch_get_documents(request['documents'], _raw(request.get('mask')),
+                                                      request.get('transaction'))
+        return iter([types.BatchGetDocumentsResponse.wrap(response) for response in responses])
+
+    @_memory_rpc
+    def run_query(self, request, metadata=None):
+        responses = self.database.run_query(request['parent'], request['structured_query'],
+                                            request.get('transaction'))
+        return iter([types.RunQueryResponse.wrap(response) for response in responses])
+
+    @_memory_rpc
+    def run_aggregation_query(self, request, metadata=None):
+        responses = self.database.run_aggregation_query(request['parent'], request['structured_aggregation_query'],
+                                                        request.get('transaction'))
+        return iter([types.RunAggregationQueryResponse.wrap(response) for response in responses])
+
+    @_memory_rpc
+    def begin_transaction(self, request, metadata=None):
+        return types.BeginTransactionResponse(transaction=self.database.begin_transaction())
+
+    @_memory_rpc
+    def rollback(self, request, metadata=None):
+        self.database.rollback(request['transaction'])
+
+    @_memory_rpc
+    def list_collection_ids(self, request, metadata=None):
+        return iter(self.database.list_collection_ids(request['parent']))
+
+    @_memory_rpc
+    def list_documents(self, request, metadata=None):
+        docs = self.database.list_documents(request['parent'], request['collection_id'])
+        return iter([types.Document.wrap(doc) for doc in docs])
+
+    @_memory_rpc
+    def partition_query(self, request, metadata=None):
+        cursors = self.database.partition_query(request['parent'], request['structured_query'],
+                                                request['partition_count'])
+        return iter([types.Cursor.wrap(cursor) for cursor in cursors])
+
+    # Transport used by the client library listeners (Watch) to open listen streams
+    @property
+    def _transport(self):
+        return self
+
+    # Bidirectional listen stream, only the first request (target to add) is read
+    def listen(self, requests, metadata=None, **kwargs):
+        self._count('listen')
+        call = _MemoryListenCall(self.database, _raw(next(iter(requests)).add_target))
+        self.__listen_calls.add(call)
+        with self.__lock:
+            errors = self.__injected_errors.get('listen')
+            error = errors.pop(0) if errors else None
+        if error is not None:
+            call.fail(error)
+        return call
+
+
+async def _async_iter(items):
+    for item in items:
+        yield item
+
+
+# Asynchronous Firestore RPC API for async clients, streaming RPCs return async iterators
+class _AsyncMemoryFirestoreAPI:
+    _STREAMING = ['batch_get_documents', 'run_query', 'run_aggregation_query', 'list_collection_ids',
+                  'list_documents', 'partition_query']
+
+    def __init__(self, api):
+        self.__api = api
+
+    @property
+    def rpc_counts(self) -> dict:
+        return self.__api.rpc_counts
+
+    def inject_errors(self, rpc, errors):
+        self.__api.inject_errors(rpc, errors)
+
+    def __getattr__(self, rpc):
+        method = getattr(self.__api, rpc)
+
+        async def call(*args, retry=None, **kwargs):
+            async def attempt():
+                result = method(*args, **kwargs)
+                return _async_iter(result) if rpc in self._STREAMING else result
+            if isinstance(retry, AsyncRetry):
+                return await retry(attempt)()
+            return await attempt()
+        return call
+
+
+# Process wide in-memory databases, by database name: clients of the same project share their data
+_memory_databases = {}
+_memory_databases_lock = threading.Lock()
+
+
+def memory_database(name) -> MemoryDatabase:
+    with _memory_databases_lock:
+        database = _memory_databases.get(name)
+        if database is None:
+            database = _memory_databases[name] = MemoryDatabase(name)
+        return database
+
+
+# Firestore client using an in-memory database, no credentials nor network access needed
+class MemoryClient(firestore.Client):
+    def __init__(self, project=FSM_MEMORY_PROJECT, credentials=None, **kwargs):
+        super().__init__(project=project or FSM_MEMORY_PROJECT, credentials=credentials or AnonymousCredentials(),
+                         **kwargs)
+        self.__api = _MemoryFirestoreAPI(memory_database(self._database_string))
+        # API returned by the client _firestore_api property
+        self._firestore_api_internal = self.__api
+
+    # Credentials are not used by the in-memory backend
+    @classmethod
+    def from_service_account_json(cls, json_credentials_path, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+    @classmethod
+    def from_service_account_info(cls, info, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+    @property
+    def database(self) -> MemoryDatabase:
+        return self.__api.database
+
+    # Number of calls per RPC made by this client
+    @property
+    def rpc_counts(self) -> dict:
+        return self.__api.rpc_counts
+
+    # Fault injection: the next calls of rpc ('commit', 'run_query'...) fail with errors, one error per call
+    # Example: client.inject_errors('commit', ServiceUnavailable('unavailable'))
+    def inject_errors(self, rpc, *errors):
+        self.__api.inject_errors(rpc, errors)
+
+
+# Asynchronous Firestore client using an in-memory database
+class AsyncMemoryClient(firestore.AsyncClient):
+    def __init__(self, project=FSM_MEMORY_PROJECT, credentials=None, **kwargs):
+        super().__init__(project=project or FSM_MEMORY_PROJECT, credentials=credentials or AnonymousCredentials(),
+                         **kwargs)
+        self.__api = _AsyncMemoryFirestoreAPI(_MemoryFirestoreAPI(memory_database(self._database_string)))
+        self._firestore_api_internal = self.__api
+
+    @classmethod
+    def from_service_account_json(cls, json_credentials_path, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+    @classmethod
+    def from_service_account_info(cls, info, *args, **kwargs):
+        return cls(*args, **kwargs)
+
+    @property
+    def database(self) -> MemoryDatabase:
+        return memory_database(self._database_string)
+
+    @property
+    def rpc_counts(self) -> dict:
+        return self.__api.rpc_counts
+
+    def inject_errors(self, rpc, *errors):
+        self.__api.inject_errors(rpc, errors)
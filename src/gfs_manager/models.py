@@ -0,0 +1,162 @@
+import copy
+import dataclasses
+import threading
+
+# Registered model schemas: {model class: ModelSchema}
+_fs_model_schemas = {}
+_fs_models_lock = threading.Lock()
+_fs_missing = object()
+
+
+# Copy of a properties dictionary not sharing mutable values (lists, dictionaries) with it, immutable values are
+# shared: properties recorded as loaded or written are not changed by in place changes of the model properties
+def _fs_copy_properties(properties) -> dict:
+    return {name: copy.deepcopy(value) if isinstance(value, (list, dict)) else value
+            for name, value in properties.items()}
+
+
+# Base class of typed models mapped to Firestore documents, one attribute per document property
+# Models are declared as dataclasses, or as classes with __slots__ (slots starting with '_' are not stored):
+#   @dataclasses.dataclass(slots=True)
+#   class User(Model):
+#       name: str = ''
+#       tags: list = dataclasses.field(default_factory=list)
+#
+#   class City(Model):
+#       __slots__ = ('name', 'population')
+# Models are stored in a collection named as the model class, as app objects are, unless registered with fs_model()
+# Document metadata: fs_id, fs_path and fs_update_time, None until the model is stored or read
+class Model:
+    __slots__ = ('_fs_id', '_fs_path', '_fs_update_time', '_fs_loaded')
+
+    @property
+    def fs_id(self):
+        return getattr(self, '_fs_id', None)
+
+    @property
+    def fs_path(self):
+        return getattr(self, '_fs_path', None)
+
+    @property
+    def fs_update_time(self):
+        return getattr(self, '_fs_update_time', None)
+
+
+# Stored properties of a model class, with their default values for properties missing from documents
+# Dataclasses: every field, defaults of the field or of its default factory, None if no default
+# Slots classes: every public slot of the class hierarchy, None by default
+# Returns a list of (name, default, default_factory)
+def _fs_model_fields(model_class) -> list:
+    if dataclasses.is_dataclass(model_class):
+        return [(f.name,
+                 None if f.default is dataclasses.MISSING else f.default,
+                 None if f.default_factory is dataclasses.MISSING else f.default_factory)
+                for f in dataclasses.fields(model_class)]
+    names = []
+    for cls in reversed(model_class.__mro__):
+        if cls in (Model, object):
+            continue
+        slots = cls.__dict__.get('__slots__', ())
+        for name in [slots] if isinstance(slots, str) else slots:
+            if not name.startswith('_') and name not in names:
+                names.append(name)
+    if not names:
+        raise TypeError("Model {} must be a dataclass or declare __slots__".format(model_class.__name__))
+    return [(name, None, None) for name in names]
+
+
+# Encoder and decoder of a model class, generated once per class as dataclasses does for __init__: property names
+# are inlined, no loop over the fields nor getattr() per property when converting documents
+def _fs_compile(model_class, fields):
+    namespace = {'new': model_class.__new__, 'cls': model_class, 'missing': _fs_missing,
+                 'copy_properties': _fs_copy_properties}
+    properties = ', '.join("'{0}': model.{0}".format(name) for name, default, default_factory in fields)
+    lines = ['def encode(model):',
+             '    return {{{}}}'.format(properties),
+             'def decode(data, fs_id=None, fs_path=None, fs_update_time=None, loaded=None):',
+             '    model = new(cls)',
+             '    get = data.get']
+    for name, default, default_factory in fields:
+        if default_factory is not None:
+            namespace['_f_' + name] = default_factory
+            lines.append("    value = get('{0}', missing)".format(name))
+            lines.append("    model.{0} = _f_{0}() if value is missing else value".format(name))
+        else:
+            namespace['_d_' + name] = default
+            lines.append("    model.{0} = get('{0}', _d_{0})".format(name))
+    lines += ['    model._fs_id = fs_id',
+              '    model._fs_path = fs_path',
+              '    model._fs_update_time = fs_update_time',
+              '    model._fs_loaded = copy_properties(data) if loaded is None else loaded',
+              '    return model']
+    exec(compile('\n'.join(lines), '<gfs_manager model {}>'.format(model_class.__name__), 'exec'), namespace)
+    return namespace['encode'], namespace['decode']
+
+
+# Schema of a model class: collection, stored properties, encoder (model to properties dictionary) and decoder
+# (properties dictionary to model)
+# Decoded and written models record their properties, with copies of the list and dictionary properties, to find the
+# changed properties: in place changes of list and dictionary properties are detected
+# loaded: properties recorded by decode, a copy of data if None, must not be changed afterwards
+class ModelSchema:
+    def __init__(self, model_class, collection=None):
+        if not issubclass(model_class, Model):
+            raise TypeError("Model {} must be a subclass of Model".format(model_class.__name__))
+        self.model_class = model_class
+        self.collection = collection or model_class.__name__
+        fields = _fs_model_fields(model_class)
+        self.fields = tuple(name for name, default, default_factory in fields)
+        self.encode, self.decode = _fs_compile(model_class, fields)
+
+    # Model from a document snapshot, None if the document does not exist
+    # The model is decoded from a copy of the snapshot properties, only list and dictionary properties are copied,
+    # not every value as DocumentSnapshot.to_dict() does: snapshots may be shared with other readers (caches)
+    # The snapshot properties, never changed, are recorded as loaded
+    def from_snapshot(self, fs_doc):
+        if fs_doc is None or not fs_doc.exists:
+            return None
+        return self.decode(_fs_copy_properties(fs_doc._data), fs_doc.id, fs_doc.reference.path, fs_doc.update_time,
+                           fs_doc._data)
+
+    # Properties changed since the model was read or last written, all properties for new models
+    def changes(self, model) -> dict:
+        properties = self.encode(model)
+        loaded = getattr(model, '_fs_loaded', None)
+        if loaded is None:
+            return properties
+        return {name: value for name, value in properties.items() if loaded.get(name, _fs_missing) != value}
+
+    # Records the document of a model after a write: properties as written (copied), id, path and update time
+    @staticmethod
+    def written(model, properties, fs_id, fs_path, fs_update_time):
+        model._fs_id = fs_id
+        model._fs_path = fs_path
+        model._fs_update_time = fs_update_time
+        model._fs_loaded = _fs_copy_properties(properties)
+
+
+# Registers model_class with its schema
+# collection: name of the collection of the model documents, model class name by default
+# Usable as a class decorator, above the dataclass decorator:
+#   @fs_model(collection='Users')
+#   @dataclasses.dataclass
+#   class User(Model): ...
+def fs_model(model_class=None, collection=None):
+    def register(cls):
+        schema = ModelSchema(cls, collection)
+        with _fs_models_lock:
+            _fs_model_schemas[cls] = schema
+        return cls
+
+    return register(model_class) if model_class is not None else register
+
+
+# Schema of model_class, registered with its default collection on first use
+def fs_model_schema(model_class) -> ModelSchema:
+    schema = _fs_model_schemas.get(model_class)
+    if schema is None:
+        with _fs_models_lock:
+            schema = _fs_model_schemas.get(model_class)
+            if schema is None:
+                schema = _fs_model_schemas[model_class] = ModelSchema(model_class)
+    return schema
@@ -0,0 +1,127 @@
+import contextlib
+import contextvars
+import threading
+
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+from google.api_core.retry import AsyncRetry, Retry
+
+# Default retry policy settings
+# Exponential backoff: first delay, maximum delay (seconds) and multiplier
+# Every delay is drawn at random between 0 and the backoff (full jitter) by google-api-core
+FSM_RETRY_INITIAL = 0.1
+FSM_RETRY_MAXIMUM = 5.0
+FSM_RETRY_MULTIPLIER = 2.0
+# Total time of a call including retries, seconds
+FSM_RETRY_DEADLINE = 30.0
+# Retry budget: retries allowed per call, on top of a reserve of retries for low traffic
+FSM_RETRY_BUDGET = 0.1
+FSM_RETRY_BUDGET_RESERVE = 10
+# Transient Firestore errors
+FSM_RETRYABLE_ERRORS = (DeadlineExceeded, ServiceUnavailable, ResourceExhausted)
+
+
+def _fs_never_retry(e) -> bool:
+    return False
+
+
+# Retries disabled: a None retry argument is not supported by every client call (query streams)
+_FS_NO_RETRY = Retry(predicate=_fs_never_retry)
+_FS_NO_ASYNC_RETRY = AsyncRetry(predicate=_fs_never_retry)
+# Retry policy of the calls made in a fs_retrying() block, overriding the manager retry policy
+_fs_unset = object()
+_fs_call_retry_policy = contextvars.ContextVar('gfs_manager_retry_policy', default=_fs_unset)
+
+
+# Token bucket limiting retries to a ratio of the calls, so that an outage does not turn into a retry storm
+# Every call deposits ratio tokens, every retry withdraws one token, the bucket holds at most reserve tokens
+class RetryBudget:
+    def __init__(self, ratio=FSM_RETRY_BUDGET, reserve=FSM_RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.__tokens = float(reserve)
+        self.__lock = threading.Lock()
+        self.retries = 0
+        # Retries not made because the budget was exhausted
+        self.denied = 0
+
+    @property
+    def tokens(self) -> float:
+        return self.__tokens
+
+    def deposit(self):
+        with self.__lock:
+            self.__tokens = min(self.__tokens + self.ratio, self.reserve)
+
+    # True if a retry is allowed
+    def withdraw(self) -> bool:
+        with self.__lock:
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                self.retries += 1
+                return True
+            self.denied += 1
+            return False
+
+
+# Retry policy of the Firestore calls of a manager, built on google-api-core Retry and AsyncRetry
+# deadline: total time of a call including retries, timeout: time of each RPC attempt (client default if None)
+# Only idempotent calls are retried: reads, writes replacing documents, deletes without preconditions
+# Writes that could report a false failure when repeated (create, delete of an existing document, writes asserting a
+# last update time) are not retried, unless retry_non_idempotent is set
+class RetryPolicy:
+    def __init__(self, initial=FSM_RETRY_INITIAL, maximum=FSM_RETRY_MAXIMUM, multiplier=FSM_RETRY_MULTIPLIER,
+                 deadline=FSM_RETRY_DEADLINE, timeout=None, budget=None, retryable_errors=FSM_RETRYABLE_ERRORS,
+                 retry_non_idempotent=False):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self.timeout = timeout
+        self.budget = budget if budget is not None else RetryBudget()
+        self.retryable_errors = tuple(retryable_errors)
+        self.retry_non_idempotent = retry_non_idempotent
+
+    # Transient error, retried if the budget allows it
+    def _fs_should_retry(self, e) -> bool:
+        return isinstance(e, self.retryable_errors) and self.budget.withdraw()
+
+    # google-api-core retry object of a call
+    def retry(self, idempotent=True, async_call=False):
+        self.budget.deposit()
+        if not idempotent and not self.retry_non_idempotent:
+            return _FS_NO_ASYNC_RETRY if async_call else _FS_NO_RETRY
+        retry_class = AsyncRetry if async_call else Retry
+        return retry_class(predicate=self._fs_should_retry, initial=self.initial, maximum=self.maximum,
+                           multiplier=self.multiplier, timeout=self.deadline)
+
+    # Retry and timeout arguments of a Firestore client call
+    def kwargs(self, idempotent=True, async_call=False) -> dict:
+        kwargs = {'retry': self.retry(idempotent, async_call)}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return kwargs
+
+
+# Retry policy of the manager calls made in the with block, in the current thread or task
+# Use None to disable retries
+# Example:
+#   with fs_retrying(RetryPolicy(deadline=2.0)):
+#       fs.fs_doc_update(fs_id, doc_properties, fs_collection_path)
+@contextlib.contextmanager
+def fs_retrying(retry_policy):
+    token = _fs_call_retry_policy.set(retry_policy)
+    try:
+        yield retry_policy
+    finally:
+        _fs_call_retry_policy.reset(token)
+
+
+# Retry and timeout arguments of a Firestore client call, using the fs_retrying() policy if set, else retry_policy
+# Without a retry policy calls are not retried
+def fs_retry_kwargs(retry_policy, idempotent=True, async_call=False) -> dict:
+    call_retry_policy = _fs_call_retry_policy.get()
+    if call_retry_policy is not _fs_unset:
+        retry_policy = call_retry_policy
+    if retry_policy is None:
+        return {'retry': _FS_NO_ASYNC_RETRY if async_call else _FS_NO_RETRY}
+    return retry_policy.kwargs(idempotent, async_call)
@@ -0,0 +1,121 @@
+import threading
+
+from google.api_core.exceptions import Aborted
+from google.cloud.firestore_v1.async_transaction import _AsyncTransactional
+from google.cloud.firestore_v1.transaction import _Transactional
+
+# Default transaction settings
+# Attempts of a transaction aborted by concurrent writes to the documents it read
+FSM_TRANSACTION_MAX_ATTEMPTS = 5
+# Documents tracked by the contention statistics, transactions of other documents are only counted in the totals
+FSM_CONTENTION_MAX_KEYS = 10000
+
+
+# Contention statistics of the manager transactions, by document path (fs_doc_transform) or transaction name
+# (fs_transaction)
+# transactions: transactions run, retries: attempts aborted by concurrent writes and run again, aborts: transactions
+# failed after their last attempt
+class ContentionStats:
+    def __init__(self, max_keys=FSM_CONTENTION_MAX_KEYS):
+        self.max_keys = max_keys
+        self.__totals = {'transactions': 0, 'retries': 0, 'aborts': 0}
+        self.__keys = {}
+        self.__lock = threading.Lock()
+
+    # attempts: attempts of a transaction, aborted: True if its last attempt was aborted
+    def record(self, key, attempts, aborted=False):
+        with self.__lock:
+            entries = [self.__totals]
+            if key in self.__keys or len(self.__keys) < self.max_keys:
+                entries.append(self.__keys.setdefault(key, {'transactions': 0, 'retries': 0, 'aborts': 0}))
+            for entry in entries:
+                entry['transactions'] += 1
+                entry['retries'] += max(0, attempts - 1)
+                entry['aborts'] += 1 if aborted else 0
+
+    # Snapshot of the statistics: {'transactions', 'retries', 'aborts', 'keys': {key: statistics}}
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(self.__totals, keys={key: dict(entry) for key, entry in self.__keys.items()})
+
+    # Keys with most retries and aborts: [(key, statistics)], at most n keys with contention
+    def hot_keys(self, n=10) -> list:
+        with self.__lock:
+            keys = [(key, dict(entry)) for key, entry in self.__keys.items() if entry['retries'] or entry['aborts']]
+        keys.sort(key=lambda item: (item[1]['aborts'], item[1]['retries']), reverse=True)
+        return keys[:n]
+
+    def reset(self):
+        with self.__lock:
+            self.__totals = {'transactions': 0, 'retries': 0, 'aborts': 0}
+            self.__keys = {}
+
+
+# Paths of the documents written by a transaction, from its write protobufs
+# Document names: projects/{project}/databases/{database}/documents/{path}
+def fs_write_paths(transaction) -> list:
+    paths = []
+    for write_pb in transaction._write_pbs:
+        name = write_pb.update.name or write_pb.delete or write_pb.transform.document
+        if name:
+            paths.append(name.split('/documents/', 1)[1])
+    return paths
+
+
+# Transactional callable of the client library (firestore.transactional) counting attempts and aborted commits, and
+# keeping the write results and the paths of the documents written by the commit, which the client library discards
+class FSTransactional(_Transactional):
+    def __init__(self, to_wrap):
+        super().__init__(to_wrap)
+        self.attempts = 0
+        self.aborted_commits = 0
+        self.write_results = []
+        self.write_paths = []
+
+    # True if the last attempt was aborted by concurrent writes
+    @property
+    def aborted(self) -> bool:
+        return self.attempts > 0 and self.aborted_commits == self.attempts
+
+    def _pre_commit(self, transaction, *args, **kwargs):
+        self.attempts += 1
+        return super()._pre_commit(transaction, *args, **kwargs)
+
+    # Same as _Transactional._maybe_commit, aborted read-write transactions are run again
+    def _maybe_commit(self, transaction):
+        try:
+            self.write_paths = fs_write_paths(transaction)
+            self.write_results = transaction._commit()
+            return True
+        except Aborted:
+            if transaction._read_only:
+                raise
+            self.aborted_commits += 1
+            return False
+
+
+class AsyncFSTransactional(_AsyncTransactional):
+    def __init__(self, to_wrap):
+        super().__init__(to_wrap)
+        self.attempts = 0
+        self.aborted_commits = 0
+        self.write_results = []
+        self.write_paths = []
+
+    aborted = FSTransactional.aborted
+
+    async def _pre_commit(self, transaction, *args, **kwargs):
+        self.attempts += 1
+        return await super()._pre_commit(transaction, *args, **kwargs)
+
+    async def _maybe_commit(self, transaction):
+        try:
+            self.write_paths = fs_write_paths(transaction)
+            self.write_results = await transaction._commit()
+            return True
+        except Aborted:
+            if transaction._read_only:
+                raise
+            self.aborted_commits += 1
+            return False
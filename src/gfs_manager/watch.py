@@ -0,0 +1,176 @@
+import logging
+import random
+import threading
+
+from google.cloud.firestore_v1.watch import ChangeType
+
+# Default collection watch settings
+# Seconds between checks of the listener state
+FSM_WATCH_CHECK_INTERVAL = 1.0
+# Reconnection backoff after a listener termination: first delay and maximum delay (seconds), doubled on every failure
+FSM_WATCH_RECONNECT_INITIAL = 1.0
+FSM_WATCH_RECONNECT_MAXIMUM = 60.0
+
+# Change types delivered to watch callbacks
+FSM_CHANGE_ADDED = 'added'
+FSM_CHANGE_MODIFIED = 'modified'
+FSM_CHANGE_REMOVED = 'removed'
+
+
+# Local mirror of the documents of a collection or query, kept up to date by a Firestore listener (on_snapshot)
+# The mirror is a dictionary of {fs_id: properties}, read with no RPCs
+# callback: optional function called with the list of changes of every snapshot, from the listener thread
+#   [(change_type, fs_id, properties)], change_type in FSM_CHANGE_ADDED, FSM_CHANGE_MODIFIED, FSM_CHANGE_REMOVED
+#   properties of removed documents are their last mirrored properties
+# The first snapshot delivers every document as added
+# Listeners stopped by a non recoverable error are reopened with exponential backoff, the mirror is then resynchronized
+# with the documents of the new listener and only the differences are delivered
+class CollectionWatch:
+    def __init__(self, query, callback=None, check_interval=FSM_WATCH_CHECK_INTERVAL,
+                 reconnect_initial=FSM_WATCH_RECONNECT_INITIAL, reconnect_maximum=FSM_WATCH_RECONNECT_MAXIMUM):
+        self.query = query
+        self.callback = callback
+        self.check_interval = check_interval
+        self.reconnect_initial = reconnect_initial
+        self.reconnect_maximum = reconnect_maximum
+        self.__lock = threading.Lock()
+        self.__mirror = {}
+        self.__update_times = {}
+        self.__resync = False
+        self.__ready = threading.Event()
+        self.__stopped = threading.Event()
+        self.__watch = None
+        self.__supervisor = None
+        self.read_time = None
+        self.snapshots = 0
+        self.reconnects = 0
+
+    # Opens the listener and starts the thread reopening it on failures
+    def start(self):
+        self.__watch = self._fs_listen()
+        self.__supervisor = threading.Thread(target=self._fs_supervise, name='gfs-manager-watch', daemon=True)
+        self.__supervisor.start()
+        return self
+
+    # Opens a listener of the query
+    # A listener terminated by an error is closed by a thread of the client library raising the error, an unhandled
+    # exception of that thread: the listener is closed without raising, the error is logged and the supervisor thread
+    # reopens the listener
+    def _fs_listen(self):
+        watch = self.query.on_snapshot(self._fs_on_snapshot)
+        close = watch.close
+
+        def close_listener(reason=None):
+            if reason:
+                logging.log(level=logging.WARNING, msg="Listener terminated: {}".format(reason))
+            close()
+
+        watch.close = close_listener
+        return watch
+
+    # Closes the listener, the mirror keeps the last documents received
+    def stop(self):
+        self.__stopped.set()
+        watch = self.__watch
+        self.__watch = None
+        if watch is not None:
+            watch.unsubscribe()
+
+    @property
+    def is_active(self) -> bool:
+        watch = self.__watch
+        return watch is not None and watch.is_active
+
+    # Waits for the first snapshot, returns True if received before timeout
+    def wait_ready(self, timeout=None) -> bool:
+        return self.__ready.wait(timeout)
+
+    # Mirrored properties of a document, None if the document is not in the mirror
+    # Mirrored dictionaries are replaced, not modified, by later snapshots, and must not be modified
+    def get(self, fs_id) -> dict:
+        return self.__mirror.get(fs_id)
+
+    def __contains__(self, fs_id):
+        return fs_id in self.__mirror
+
+    def __len__(self):
+        return len(self.__mirror)
+
+    # Copy of the mirror: {fs_id: properties}
+    @property
+    def mirror(self) -> dict:
+        with self.__lock:
+            return dict(self.__mirror)
+
+    def _fs_on_snapshot(self, docs, changes, read_time):
+        with self.__lock:
+            if self.__resync:
+                # First snapshot of a reopened listener: differences with the mirror
+                current = {doc.id: doc for doc in docs}
+                deltas = [(FSM_CHANGE_REMOVED, fs_id, self.__mirror[fs_id]) for fs_id in self.__mirror
+                          if fs_id not in current]
+                for fs_id, doc in current.items():
+                    if fs_id not in self.__mirror:
+                        deltas.append((FSM_CHANGE_ADDED, fs_id, doc.to_dict()))
+                    elif self.__update_times[fs_id] != doc.update_time:
+                        deltas.append((FSM_CHANGE_MODIFIED, fs_id, doc.to_dict()))
+                self.__resync = False
+            else:
+                deltas = []
+                for change in changes:
+                    doc = change.document
+                    if change.type == ChangeType.REMOVED:
+                        deltas.append((FSM_CHANGE_REMOVED, doc.id, self.__mirror.get(doc.id)))
+                    else:
+                        deltas.append((FSM_CHANGE_ADDED if change.type == ChangeType.ADDED else FSM_CHANGE_MODIFIED,
+                                       doc.id, doc.to_dict()))
+                current = {doc.id: doc for doc in docs}
+            # Mirror replaced, readers never see a partially applied snapshot
+            mirror = dict(self.__mirror)
+            for change_type, fs_id, properties in deltas:
+                if change_type == FSM_CHANGE_REMOVED:
+                    mirror.pop(fs_id, None)
+                    self.__update_times.pop(fs_id, None)
+                else:
+                    mirror[fs_id] = properties
+                    self.__update_times[fs_id] = current[fs_id].update_time
+            self.__mirror = mirror
+            self.read_time = read_time
+            self.snapshots += 1
+        self.__ready.set()
+        if self.callback is not None and deltas:
+            try:
+                self.callback(deltas)
+            except Exception as e:
+                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}"
+                            .format(e.__class__, e, getattr(self.callback, '__name__', self.callback)))
+
+    # Reopens the listener when it stops, with exponential backoff and jitter
+    # The backoff is reset once a reopened listener delivers a snapshot
+    def _fs_supervise(self):
+        failures = 0
+        snapshots = 0
+        while not self.__stopped.wait(self.check_interval):
+            watch = self.__watch
+            if watch is None or watch.is_active:
+                if self.snapshots > snapshots:
+                    failures = 0
+                continue
+            delay = min(self.reconnect_initial * 2 ** failures, self.reconnect_maximum)
+            failures += 1
+            if self.__stopped.wait(random.uniform(delay / 2, delay)):
+                break
+            try:
+                watch.unsubscribe()
+                with self.__lock:
+                    self.__resync = True
+                snapshots = self.snapshots
+                self.reconnects += 1
+                self.__watch = self._fs_listen()
+                logging.log(level=logging.WARNING, msg="Listener reopened after {} failures".format(failures))
+            except Exception as e:
+                logging.log(level=logging.ERROR, msg="Exception {}:{} Method: {}"
+                            .format(e.__class__, e, self._fs_supervise.__name__))
+        # A listener reopened while stopping
+        if self.__watch is not None:
+            self.stop()
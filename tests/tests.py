@@ -1,14 +1,57 @@
+import asyncio
+import dataclasses
+import datetime
+import gc
+import json
+import math
+import os
+import pickle
 import random
+import tempfile
+import threading
+import time
 import unittest
 import warnings
+from operator import itemgetter
 
 # App specific imports
-from gfs_manager import GFSManager
+from gfs_manager import AsyncGFSManager, GFSManager, FSM_WRITE_PRECONDITION, FSM_WRITE_STRICT
+from gfs_manager import FSM_BACKEND_MEMORY
+from gfs_manager.benchmark import Benchmark, BenchmarkApp, compare_results, run_stress, FSM_BENCHMARK_OPERATIONS
+from gfs_manager.buffered_writer import BufferedWriter
+from gfs_manager.cache import DocumentCache, QueryCache
+from gfs_manager.client_pool import ClientPool
+from gfs_manager.counters import WriteCoalescer
+from gfs_manager.indexes import fs_drop_index, fs_index
+from gfs_manager.instrumentation import MetricsInstrumentation
+from gfs_manager.memory_backend import MemoryClient
+from gfs_manager.models import Model, fs_model, fs_model_schema
+from gfs_manager.retry import RetryBudget, RetryPolicy, fs_retrying
+from gfs_manager.watch import CollectionWatch
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound, PermissionDenied, \
+    ServiceUnavailable
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 # FSMConfig imports
 from config import TestConfig
 
 
+@fs_model(collection='ModelUsers')
+@dataclasses.dataclass
+class ModelUser(Model):
+    name: str = ''
+    age: int = 0
+    tags: list = dataclasses.field(default_factory=list)
+
+
+class ModelCity(Model):
+    __slots__ = ('name', 'population', '_cached')
+
+    def __init__(self, name=None, population=None):
+        self.name = name
+        self.population = population
+
+
 class MockFSOApp:
     def __init__(self, config_class=TestConfig):
         self.config = config_class().to_dict()
@@ -250,5 +293,1805 @@ class FireStoreManagerModelCase(unittest.TestCase):
         self.assertNotIn(after_fs_docs_ids, before_fs_docs_ids)
 
 
+    def test_9_bulk_store_update_delete(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        docs_properties = [{'x': i, 'title': "Nunc es bibendum"} for i in range(0, 12)]
+        stored = self.fs.fs_docs_store_many(app_object=app_object, docs_properties=docs_properties,
+                                            batch_size=5, max_workers=3)
+        self.assertEqual(len(docs_properties), len(stored))
+        for fs_stored_time, fs_id, fs_path, result in stored:
+            self.assertIsNotNone(fs_stored_time)
+            self.assertIsNotNone(fs_id)
+            self.assertIsNotNone(fs_path)
+            self.assertTrue(result)
+
+        # Results are returned in the same order as the input
+        fs_collection_path = self.fs.path_prefix + '/' + app_object.__class__.__name__
+        for doc_properties, (fs_stored_time, fs_id, fs_path, result) in zip(docs_properties, stored):
+            self.assertEqual(doc_properties, self.fs.fs_doc_properties(fs_id=fs_id,
+                                                                        fs_collection_path=fs_collection_path))
+
+        # Updates existing objects, non existent ids are reported as not updated
+        new_properties = {fs_id: {'y': 300} for fs_stored_time, fs_id, fs_path, result in stored}
+        new_properties['non_existent_id'] = {'y': 300}
+        updated = self.fs.fs_docs_update_many(docs_properties=new_properties, fs_collection_path=fs_collection_path,
+                                              batch_size=5, max_workers=3)
+        self.assertEqual(len(new_properties), len(updated))
+        self.assertTrue(all(result for fs_stored_time, fs_id, fs_path, result in updated[:-1]))
+        self.assertEqual((None, 'non_existent_id', None, False), updated[-1])
+        for fs_stored_time, fs_id, fs_path, result in updated[:-1]:
+            self.assertEqual({'y': 300}, self.fs.fs_doc_properties(fs_id=fs_id, fs_collection_path=fs_collection_path))
+
+        # Deletes all the stored objects
+        deleted = self.fs.fs_docs_delete_many(fs_docs=[(fs_id, fs_path) for t, fs_id, fs_path, r in stored],
+                                              batch_size=5, max_workers=3)
+        self.assertEqual(len(stored), len(deleted))
+        for (t, fs_id, fs_path, r), (fs_deleted_time, fs_deleted_id, fs_deleted_path, result) in zip(stored, deleted):
+            self.assertTrue(result)
+            self.assertIsNotNone(fs_deleted_time)
+            self.assertEqual(fs_id, fs_deleted_id)
+            self.assertEqual(fs_path, fs_deleted_path)
+            self.assertFalse(self.fs.fs_doc_exist(fs_path))
+
+
+    def test_10_write_modes(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        fs_collection_path = self.fs.path_prefix + '/' + app_object.__class__.__name__
+        for write_mode in [FSM_WRITE_PRECONDITION, FSM_WRITE_STRICT]:
+            fs_stored_time, fs_id, fs_path, result = self.fs.fs_doc_store(app_object=app_object,
+                                                                          doc_properties={'x': 100})
+            self.assertTrue(result)
+
+            # Updates existing object
+            fs_updated_time, fs_id, fs_updated_path, result = \
+                self.fs.fs_doc_update(fs_id=fs_id, doc_properties={'y': 300}, fs_collection_path=fs_collection_path,
+                                      write_mode=write_mode)
+            self.assertTrue(result)
+            self.assertEqual(fs_path, fs_updated_path)
+            self.assertEqual({'y': 300}, self.fs.fs_doc_properties(fs_id=fs_id, fs_collection_path=fs_collection_path))
+
+            # Update with an outdated last update time is rejected
+            update = self.fs.fs_doc_update(fs_id=fs_id, doc_properties={'y': 400}, fs_collection_path=fs_collection_path,
+                                           fs_last_update_time=fs_stored_time, write_mode=write_mode)
+            self.assertFalse(update[3])
+            # Update with the current last update time succeeds
+            update = self.fs.fs_doc_update(fs_id=fs_id, doc_properties={'y': 500}, fs_collection_path=fs_collection_path,
+                                           fs_last_update_time=fs_updated_time, write_mode=write_mode)
+            self.assertTrue(update[3])
+
+            # Non existent objects are not updated nor created
+            update = self.fs.fs_doc_update(fs_id='non_existent_id', doc_properties={'y': 300},
+                                           fs_collection_path=fs_collection_path, write_mode=write_mode)
+            self.assertFalse(update[3])
+            self.assertFalse(self.fs.fs_doc_exist(fs_collection_path + '/non_existent_id'))
+
+            # Deletes existing object, a second delete fails
+            delete = self.fs.fs_doc_delete(fs_id=fs_id, fs_path=fs_path, write_mode=write_mode)
+            self.assertTrue(delete[3])
+            self.assertIsNotNone(delete[0])
+            self.assertFalse(self.fs.fs_doc_exist(fs_path))
+            delete = self.fs.fs_doc_delete(fs_id=fs_id, fs_path=fs_path, write_mode=write_mode)
+            self.assertFalse(delete[3])
+
+
+    def test_11_iter_query(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        lookup_collection = app_object.__class__.__name__
+        self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+        self.fs.fs_docs_store_many(app_object=app_object,
+                                   docs_properties=[{'x': i % 2, 'y': i} for i in range(0, 11)])
+
+        # Same documents as the list variant, read in pages
+        fs_docs = self.fs.fs_query_by_collection(lookup_collection=lookup_collection)
+        iter_docs = list(self.fs.fs_iter_query_by_collection(lookup_collection=lookup_collection, page_size=3))
+        self.assertEqual(set([doc.id for doc in fs_docs]), set([doc.id for doc in iter_docs]))
+        self.assertEqual(len(fs_docs), len(iter_docs))
+
+        # Resume an interrupted scan from the last document processed
+        first_docs = []
+        for doc in self.fs.fs_iter_query_by_collection(lookup_collection=lookup_collection, page_size=3):
+            first_docs.append(doc)
+            if len(first_docs) == 5:
+                break
+        resumed_docs = list(self.fs.fs_iter_query_by_collection(lookup_collection=lookup_collection, page_size=3,
+                                                                start_after_id=first_docs[-1].id))
+        self.assertEqual([doc.id for doc in iter_docs], [doc.id for doc in first_docs + resumed_docs])
+
+        iter_docs = list(self.fs.fs_iter_query_by_properties(lookup_properties={'x': 1},
+                                                             lookup_collection=lookup_collection, page_size=2))
+        self.assertEqual(5, len(iter_docs))
+        self.assertTrue(all(doc.to_dict().get('x') == 1 for doc in iter_docs))
+        self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+
+
+    def test_12_compound_query(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        lookup_collection = app_object.__class__.__name__
+        self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+        self.fs.fs_docs_store_many(app_object=app_object,
+                                   docs_properties=[{'x': i % 2, 'y': i, 'tags': ['t' + str(i % 3)]}
+                                                    for i in range(0, 12)])
+
+        # All the property filters are applied
+        fs_docs = self.fs.fs_query_by_properties(lookup_properties={'x': 1, 'y': 3}, app_object=app_object)
+        self.assertEqual([{'x': 1, 'y': 3, 'tags': ['t0']}], [doc.to_dict() for doc in fs_docs])
+
+        fs_docs = self.fs.fs_query(lookup_collection=lookup_collection, lookup_properties={'x': 0},
+                                   filters=[('y', '>=', 4)], order_by=[('y', 'DESCENDING')], limit=3, offset=1,
+                                   select=['y'])
+        self.assertEqual([{'y': 8}, {'y': 6}, {'y': 4}], [doc.to_dict() for doc in fs_docs])
+
+        fs_docs = self.fs.fs_query(lookup_collection=lookup_collection, filters=[('y', 'in', [1, 2, 20])],
+                                   order_by=['y'])
+        self.assertEqual([1, 2], [doc.get('y') for doc in fs_docs])
+
+        fs_docs = self.fs.fs_query(lookup_collection=lookup_collection, filters=[('tags', 'array_contains', 't1')])
+        self.assertEqual(set([1, 4, 7, 10]), set([doc.get('y') for doc in fs_docs]))
+
+        # Invalid operators are reported as a failed query
+        self.assertIsNone(self.fs.fs_query(lookup_collection=lookup_collection, filters=[('y', 'like', 1)]))
+        self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+
+
+    def test_13_aggregations(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        lookup_collection = app_object.__class__.__name__
+        self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+        self.assertEqual(0, self.fs.fs_count(app_object=app_object))
+        self.fs.fs_docs_store_many(app_object=app_object,
+                                   docs_properties=[{'x': i % 2, 'y': i} for i in range(0, 10)])
+
+        self.assertEqual(10, self.fs.fs_count(app_object=app_object))
+        self.assertEqual(len(self.fs.fs_query_by_collection(app_object=app_object)),
+                         self.fs.fs_count(lookup_collection=lookup_collection))
+        self.assertEqual(5, self.fs.fs_count(app_object=app_object, lookup_properties={'x': 1}))
+        self.assertEqual(3, self.fs.fs_count(app_object=app_object, filters=[('y', '>', 6)]))
+        self.assertEqual(45, self.fs.fs_sum('y', app_object=app_object))
+        self.assertEqual(25, self.fs.fs_sum('y', app_object=app_object, lookup_properties={'x': 1}))
+        self.assertAlmostEqual(4.5, self.fs.fs_avg('y', app_object=app_object))
+        self.assertIsNone(self.fs.fs_avg('non_existent_property', app_object=app_object))
+        # Errors logged as errors of the aggregation method
+        self.fs.client.inject_errors('run_aggregation_query', PermissionDenied('denied'))
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertIsNone(self.fs.fs_count(app_object=app_object))
+        self.assertIn('Method: fs_count', logs.output[0])
+        self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+
+
+    def test_14_document_cache(self):
+        self.assertTrue(self.fs.initialized())
+        self.fs.set_cache(DocumentCache(max_entries=10, ttl=60))
+        app_object = MockFSOAppObject()
+        fs_collection_path = self.fs.path_prefix + '/' + app_object.__class__.__name__
+        fs_stored_time, fs_id, fs_path, result = self.fs.fs_doc_store(app_object=app_object,
+                                                                      doc_properties={'x': 100})
+        fs_doc_1 = self.fs.fs_query_by_id(lookup_id=fs_id, app_object=app_object)
+        fs_doc_2 = self.fs.fs_query_by_id(lookup_id=fs_id, app_object=app_object)
+        self.assertIs(fs_doc_1, fs_doc_2)
+        self.assertEqual({'x': 100}, self.fs.fs_doc_properties(fs_id=fs_id, fs_collection_path=fs_collection_path))
+        self.assertEqual(1, self.fs.cache.stats['misses'])
+        self.assertEqual(2, self.fs.cache.stats['hits'])
+
+        # Updates and deletes invalidate cached documents
+        self.fs.fs_doc_update(fs_id=fs_id, doc_properties={'y': 300}, fs_collection_path=fs_collection_path)
+        self.assertEqual({'y': 300}, self.fs.fs_doc_properties(fs_id=fs_id, fs_collection_path=fs_collection_path))
+        self.fs.fs_doc_delete(fs_id=fs_id, fs_path=fs_path)
+        self.assertIsNone(self.fs.fs_query_by_id(lookup_id=fs_id, app_object=app_object))
+        self.fs.set_cache(None)
+
+    def test_15_recursive_delete_collection(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        lookup_collection = app_object.__class__.__name__
+        stored = self.fs.fs_docs_store_many(app_object=app_object, docs_properties=[{'x': i} for i in range(0, 7)])
+        # Child objects stored in a subcollection of every object
+        for fs_stored_time, fs_id, fs_path, result in stored:
+            self.fs.fs_docs_store_many(app_object=app_object, docs_properties=[{'y': 1}, {'y': 2}],
+                                       fs_collection_path=fs_path + '/Child')
+        progress = []
+        collection_deleted = self.fs.fs_delete_collection(lookup_collection=lookup_collection, batch_size=4,
+                                                          max_workers=2, progress_callback=progress.append)
+        self.assertTrue(collection_deleted)
+        self.assertGreaterEqual(progress[-1]['deleted'], 21)
+        self.assertEqual(0, progress[-1]['failed'])
+        self.assertEqual([], self.fs.fs_query_by_collection(lookup_collection=lookup_collection))
+        for fs_stored_time, fs_id, fs_path, result in stored:
+            self.assertEqual([], self.fs.fs_query_by_collection(parent_doc_path=fs_path, lookup_collection='Child'))
+
+    def test_16_shared_client(self):
+        self.assertTrue(self.fs.initialized())
+        # Second app with its own objects path, same credentials
+        other_app = MockFSOApp(config_class=TestConfig)
+        other_app.config['FSM_APP_OBJECTS_PATH'] = self.app.config['FSM_APP_OBJECTS_PATH'] + '_other'
+        other_fs = GFSManager()
+        other_fs.init_app(other_app)
+        self.assertTrue(other_fs.initialized())
+        self.assertIs(self.fs.client, other_fs.client)
+        self.assertNotEqual(self.fs.path_prefix, other_fs.path_prefix)
+
+        # Client still usable by the first manager after the second one closes its connection
+        other_fs.close_connection()
+        self.assertFalse(other_fs.initialized())
+        self.assertIsNotNone(self.fs.fs_query_by_collection(lookup_collection='non_existent_collection'))
+
+    def test_17_lazy_init_app(self):
+        lazy_app = MockFSOApp(config_class=TestConfig)
+        lazy_app.config['FSM_LAZY_INIT'] = True
+        lazy_fs = GFSManager()
+        lazy_fs.init_app(lazy_app)
+        # Connected on first use
+        self.assertTrue(lazy_fs.initialized())
+        self.assertEqual(self.fs.path_prefix, lazy_fs.path_prefix)
+        self.assertIsNotNone(lazy_fs.fs_query_by_collection(lookup_collection='non_existent_collection'))
+        lazy_fs.close_connection()
+
+        # Connected in a background thread
+        lazy_app.config['FSM_WARMUP'] = True
+        lazy_fs = GFSManager()
+        lazy_fs.init_app(lazy_app)
+        lazy_fs.warm_up(background=True).join()
+        self.assertTrue(lazy_fs.initialized())
+        lazy_fs.close_connection()
+
+    def test_18_query_by_ids(self):
+        self.assertTrue(self.fs.initialized())
+        app_object = MockFSOAppObject()
+        stored = self.fs.fs_docs_store_many(app_object=app_object,
+                                            docs_properties=[{'x': i, 'y': i * 2} for i in range(0, 7)])
+        lookup_ids = [fs_id for t, fs_id, fs_path, r in stored] + ['non_existent_id']
+        fs_docs = self.fs.fs_query_by_ids(lookup_ids=lookup_ids, app_object=app_object, batch_size=3)
+        self.assertEqual(set(lookup_ids), set(fs_docs.keys()))
+        self.assertIsNone(fs_docs['non_existent_id'])
+        for i, (t, fs_id, fs_path, r) in enumerate(stored):
+            self.assertEqual({'x': i, 'y': i * 2}, fs_docs[fs_id].to_dict())
+            self.assertEqual(fs_path, fs_docs[fs_id].reference.path)
+
+        # Field mask
+        fs_docs = self.fs.fs_query_by_ids(lookup_ids=lookup_ids[:2], app_object=app_object, field_paths=['y'])
+        self.assertEqual({'y': 0}, fs_docs[lookup_ids[0]].to_dict())
+
+        fs_paths = [fs_path for t, fs_id, fs_path, r in stored]
+        non_existent_path = self.fs.path_prefix + '/' + app_object.__class__.__name__ + '/non_existent_id'
+        exist = self.fs.fs_docs_exist(fs_paths + [non_existent_path], batch_size=3)
+        self.assertTrue(all(exist[fs_path] for fs_path in fs_paths))
+        self.assertFalse(exist[non_existent_path])
+        self.fs.fs_docs_delete_many(fs_docs=[(fs_id, fs_path) for t, fs_id, fs_path, r in stored])
+
+
+class AsyncFireStoreManagerModelCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        test_app = MockFSOApp(config_class=TestConfig)
+        fs = AsyncGFSManager()
+        await fs.init_app(test_app)
+        self.app = test_app
+        self.fs = fs
+        warnings.filterwarnings(action="ignore", category=ResourceWarning)
+
+    async def asyncTearDown(self):
+        self.fs.close_connection()
+
+    async def test_0_init_app(self):
+        self.assertTrue(self.fs.initialized())
+        self.assertEqual(self.app.config['FSM_APP_ROOT'] + '/' + self.app.config['FSM_APP_OBJECTS_PATH'],
+                         self.fs.path_prefix)
+        # Initialized again: client of the configured project, the previous client is closed
+        closed = []
+        previous_client = self.fs.client
+        previous_client.close = lambda: closed.append(previous_client)
+        self.app.config['FSM_PROJECT'] = 'gfs-async-project'
+        await self.fs.init_app(self.app)
+        self.assertEqual([previous_client], closed)
+        self.assertEqual('gfs-async-project', self.fs.client.project)
+        self.assertTrue(self.fs.initialized())
+
+    async def test_1_store_update_delete(self):
+        app_object = MockFSOAppObject()
+        fs_collection_path = self.fs.path_prefix + '/' + app_object.__class__.__name__
+        fs_stored_time, fs_id, fs_path, result = await self.fs.fs_doc_store(app_object=app_object,
+                                                                            doc_properties={'x': 100})
+        self.assertTrue(result)
+        recovered_fs_doc = await self.fs.fs_query_by_id(lookup_id=fs_id, app_object=app_object)
+        self.assertEqual({'x': 100}, recovered_fs_doc.to_dict())
+        update = await self.fs.fs_doc_update(fs_id=fs_id, doc_properties={'y': 300},
+                                             fs_collection_path=fs_collection_path)
+        self.assertTrue(update[3])
+        self.assertEqual({'y': 300}, await self.fs.fs_doc_properties(fs_id=fs_id,
+                                                                      fs_collection_path=fs_collection_path))
+        delete = await self.fs.fs_doc_delete(fs_id=fs_id, fs_path=fs_path)
+        self.assertTrue(delete[3])
+        self.assertFalse(await self.fs.fs_doc_exist(fs_path))
+
+    async def test_2_bulk_and_queries(self):
+        app_object = MockFSOAppObject()
+        lookup_collection = app_object.__class__.__name__
+        await self.fs.fs_delete_collection(lookup_collection=lookup_collection)
+        stored = await self.fs.fs_docs_store_many(app_object=app_object,
+                                                  docs_properties=[{'x': i % 2, 'y': i} for i in range(0, 9)],
+                                                  batch_size=2)
+        self.assertTrue(all(result for t, fs_id, fs_path, result in stored))
+
+        # Independent calls in flight at the same time
+        fs_docs, fs_docs_x, count = await asyncio.gather(
+            self.fs.fs_query_by_collection(lookup_collection=lookup_collection),
+            self.fs.fs_query_by_properties(lookup_properties={'x': 1}, lookup_collection=lookup_collection),
+            self.fs.fs_count(lookup_collection=lookup_collection))
+        self.assertEqual(9, len(fs_docs))
+        self.assertEqual(4, len(fs_docs_x))
+        self.assertEqual(9, count)
+
+        iter_docs = [doc async for doc in self.fs.fs_iter_query_by_collection(lookup_collection=lookup_collection,
+                                                                                page_size=4)]
+        self.assertEqual(set([doc.id for doc in fs_docs]), set([doc.id for doc in iter_docs]))
+
+        deleted = await self.fs.fs_docs_delete_many(fs_docs=[(fs_id, fs_path) for t, fs_id, fs_path, r in stored[:3]])
+        self.assertTrue(all(result for t, fs_id, fs_path, result in deleted))
+        self.assertTrue(await self.fs.fs_delete_collection(lookup_collection=lookup_collection, batch_size=2))
+        self.assertEqual(0, await self.fs.fs_count(lookup_collection=lookup_collection))
+
+
+class DocumentCacheCase(unittest.TestCase):
+    class MockSnapshot:
+        def __init__(self, path, data):
+            self.reference = type('MockReference', (), {'path': path})()
+            self.data = data
+
+        def to_dict(self):
+            return dict(self.data)
+
+    def setUp(self):
+        self.now = 0
+        self.cache = DocumentCache(max_entries=3, max_bytes=1000, ttl=10, timer=lambda: self.now)
+
+    def put(self, path, data):
+        self.cache.put(path, self.MockSnapshot(path, data))
+
+    def test_0_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('a/1'))
+        self.put('a/1', {'x': 1})
+        self.assertEqual({'x': 1}, self.cache.get('a/1').to_dict())
+        self.assertEqual(1, self.cache.stats['hits'])
+        self.assertEqual(1, self.cache.stats['misses'])
+        self.assertEqual(1, self.cache.stats['entries'])
+
+    def test_1_ttl(self):
+        self.put('a/1', {'x': 1})
+        self.now = 9
+        self.assertIsNotNone(self.cache.get('a/1'))
+        self.now = 10
+        self.assertIsNone(self.cache.get('a/1'))
+
+    def test_2_lru_eviction_by_entries(self):
+        for i in range(0, 3):
+            self.put('a/' + str(i), {'x': i})
+        # a/0 becomes the most recently used entry
+        self.cache.get('a/0')
+        self.put('a/3', {'x': 3})
+        self.assertIsNotNone(self.cache.get('a/0'))
+        self.assertIsNone(self.cache.get('a/1'))
+        self.assertEqual(3, self.cache.stats['entries'])
+        self.assertEqual(1, self.cache.stats['evictions'])
+
+    def test_3_eviction_by_bytes(self):
+        self.put('a/1', {'text': 'x' * 600})
+        self.put('a/2', {'text': 'y' * 600})
+        self.assertIsNone(self.cache.get('a/1'))
+        self.assertIsNotNone(self.cache.get('a/2'))
+        self.assertLessEqual(self.cache.stats['bytes'], 1000)
+        # Documents larger than the cache are not cached
+        self.put('a/3', {'text': 'z' * 2000})
+        self.assertIsNone(self.cache.get('a/3'))
+
+    def test_4_invalidation(self):
+        self.put('a/1', {'x': 1})
+        self.put('a/2', {'x': 2})
+        self.put('b/1', {'x': 3})
+        self.cache.invalidate('a/1')
+        self.assertIsNone(self.cache.get('a/1'))
+        self.cache.invalidate_prefix('a/')
+        self.assertIsNone(self.cache.get('a/2'))
+        self.assertIsNotNone(self.cache.get('b/1'))
+
+
+
+class ClientPoolCase(unittest.TestCase):
+    class MockClient:
+        def __init__(self, project=None):
+            self.project = project
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        self.pool = ClientPool()
+
+    def test_0_shared_by_credentials_and_project(self):
+        client_1 = self.pool.acquire('', 'p1', client_class=self.MockClient)
+        client_2 = self.pool.acquire('', 'p1', client_class=self.MockClient)
+        client_3 = self.pool.acquire('', 'p2', client_class=self.MockClient)
+        self.assertIs(client_1, client_2)
+        self.assertIsNot(client_1, client_3)
+        self.assertEqual(2, len(self.pool))
+        self.assertEqual(2, self.pool.references(client_1))
+
+    def test_1_closed_by_last_user(self):
+        client_1 = self.pool.acquire('', 'p1', client_class=self.MockClient)
+        client_2 = self.pool.acquire('', 'p1', client_class=self.MockClient)
+        self.assertFalse(self.pool.release(client_1))
+        self.assertFalse(client_1.closed)
+        self.assertTrue(self.pool.release(client_2))
+        self.assertTrue(client_2.closed)
+        self.assertEqual(0, len(self.pool))
+        # New client created after the previous one was closed
+        client_3 = self.pool.acquire('', 'p1', client_class=self.MockClient)
+        self.assertIsNot(client_1, client_3)
+        # Clients not in the pool are ignored
+        self.assertFalse(self.pool.release(self.MockClient()))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
+
+
+class MemoryBackendCase(unittest.TestCase):
+    def setUp(self):
+        # Project per test: every test starts with an empty database
+        self.client = MemoryClient(project='gfs-memory-test-{}'.format(random.randint(0, 10 ** 9)))
+        self.col = self.client.collection('memory_tests')
+
+    def test_0_preconditions(self):
+        doc_ref = self.col.document('a')
+        with self.assertRaises(NotFound):
+            doc_ref.update({'x': 1})
+        fs_write_result = doc_ref.create({'x': 1})
+        with self.assertRaises(AlreadyExists):
+            doc_ref.create({'x': 2})
+        doc_ref.set({'x': 2})
+        with self.assertRaises(FailedPrecondition):
+            doc_ref.delete(option=self.client.write_option(last_update_time=fs_write_result.update_time))
+        doc_ref.delete()
+        self.assertFalse(doc_ref.get().exists)
+
+    def test_1_update_and_transforms(self):
+        doc_ref = self.col.document('a')
+        doc_ref.set({'n': 1, 'tags': ['a'], 'nested': {'x': 1, 'y': 2}})
+        doc_ref.update({'n': firestore.Increment(2), 'tags': firestore.ArrayUnion(['a', 'b']),
+                        'nested.x': firestore.DELETE_FIELD, 'at': firestore.SERVER_TIMESTAMP})
+        fs_doc = doc_ref.get()
+        self.assertEqual(3, fs_doc.get('n'))
+        self.assertEqual(['a', 'b'], fs_doc.get('tags'))
+        self.assertEqual({'y': 2}, fs_doc.get('nested'))
+        self.assertEqual(fs_doc.update_time, fs_doc.get('at'))
+
+    def test_2_queries(self):
+        for i in range(10):
+            self.col.document('d{}'.format(i)).set({'i': i, 'even': i % 2 == 0, 'tags': ['t{}'.format(i % 3)]})
+        self.col.document('other').set({'i': 'text'})
+        query = self.col.where(filter=FieldFilter('i', '>=', 4)).order_by('i', direction=firestore.Query.DESCENDING)
+        self.assertEqual([9, 8, 7, 6, 5, 4], [fs_doc.get('i') for fs_doc in query.stream()])
+        self.assertEqual([7, 6], [fs_doc.get('i') for fs_doc in query.offset(2).limit(2).stream()])
+        self.assertEqual([5, 4], [fs_doc.get('i') for fs_doc in query.start_after({'i': 6}).stream()])
+        query = self.col.where(filter=FieldFilter('tags', 'array_contains', 't0')) \
+            .where(filter=FieldFilter('even', '==', True))
+        self.assertEqual(['d0', 'd6'], [fs_doc.id for fs_doc in query.stream()])
+        self.assertEqual(2, query.count().get()[0][0].value)
+        self.assertEqual([{}], [fs_doc.to_dict() for fs_doc in self.col.select([]).limit(1).stream()])
+
+    def test_3_transaction_retried_on_contention(self):
+        doc_ref = self.col.document('counter')
+        doc_ref.set({'n': 0})
+        attempts = []
+
+        @firestore.transactional
+        def increment(transaction):
+            n = doc_ref.get(transaction=transaction).get('n')
+            if not attempts:
+                # Concurrent write between the transaction read and commit
+                doc_ref.set({'n': 10})
+            attempts.append(n)
+            transaction.update(doc_ref, {'n': n + 1})
+
+        increment(self.client.transaction())
+        self.assertEqual([0, 10], attempts)
+        self.assertEqual(11, doc_ref.get().get('n'))
+        self.assertEqual(2, self.client.rpc_counts['begin_transaction'])
+
+
+class BenchmarkCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(BenchmarkApp(backend=FSM_BACKEND_MEMORY))
+
+    def tearDown(self):
+        self.fs.close_connection()
+
+    def test_0_run(self):
+        report = Benchmark(self.fs, sizes=[5], concurrency=[1, 2], queries=3).run()
+        self.assertEqual(2 * len(FSM_BENCHMARK_OPERATIONS), len(report['results']))
+        for r in report['results']:
+            self.assertEqual(0, r['errors'])
+            self.assertGreater(r['ops_per_second'], 0)
+            self.assertLessEqual(r['latency_ms']['p50'], r['latency_ms']['p99'])
+            self.assertGreater(r['peak_memory_bytes'], 0)
+        store = report['results'][0]
+        self.assertEqual(('store', 5, 5), (store['operation'], store['collection_size'], store['ops']))
+        # One commit per stored document
+        self.assertEqual({'commit': 1.0}, store['rpcs_per_op'])
+        query_by_id = report['results'][2]
+        self.assertEqual(('query_by_id', {'batch_get_documents': 1.0}),
+                         (query_by_id['operation'], query_by_id['rpcs_per_op']))
+
+    def test_3_instrumentation(self):
+        # RPCs counted by the manager instrumentation, the instrumentation of the manager still records the operations
+        instrumentation = MetricsInstrumentation()
+        self.fs.set_instrumentation(instrumentation)
+        report = Benchmark(self.fs, sizes=[5], concurrency=[1], operations=['store']).run()
+        self.assertEqual({'commit': 1.0}, report['results'][0]['rpcs_per_op'])
+        self.assertIs(instrumentation, self.fs.instrumentation)
+        self.assertEqual({'commit': 5}, instrumentation.metrics['methods']['fs_doc_store']['rpcs'])
+
+    def test_1_compare(self):
+        baseline = {'results': [{'operation': 'store', 'collection_size': 5, 'concurrency': 1, 'ops_per_second': 100,
+                                 'latency_ms': {'p50': 1.0, 'p95': 2.0}}]}
+        current = {'results': [{'operation': 'store', 'collection_size': 5, 'concurrency': 1, 'ops_per_second': 90,
+                                'latency_ms': {'p50': 1.5, 'p95': 2.1}}]}
+        regressions = compare_results(baseline, current, threshold=0.2)
+        self.assertEqual(['p50'], [r['metric'] for r in regressions])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'fork not supported')
+    def test_2_stress(self):
+        report = run_stress(self.fs, processes=2, threads=4, operations=10)
+        self.assertEqual((160, 0, 0, 2), (report['ops'], report['errors'], report['mismatches'],
+                                          report['clients_rebuilt']))
+        self.assertGreater(report['ops_per_second'], 0)
+
+
+class InstrumentationCase(unittest.TestCase):
+    class MockSpan:
+        def __init__(self, name, attributes):
+            self.name = name
+            self.attributes = dict(attributes)
+            self.exceptions = []
+            self.ended = False
+
+        def set_attribute(self, key, value):
+            self.attributes[key] = value
+
+        def record_exception(self, e):
+            self.exceptions.append(e)
+
+        def end(self):
+            self.ended = True
+
+    class MockTracer:
+        def __init__(self):
+            self.spans = []
+
+        def start_span(self, name, attributes=None):
+            self.spans.append(InstrumentationCase.MockSpan(name, attributes or {}))
+            return self.spans[-1]
+
+    def setUp(self):
+        test_app = MockFSOApp(config_class=TestConfig)
+        test_app.config['FSM_METRICS'] = True
+        self.fs = GFSManager()
+        self.fs.init_app(test_app)
+        self.collection = 'Instrumentation_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+
+    def tearDown(self):
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def test_0_method_metrics(self):
+        self.assertIsInstance(self.fs.instrumentation, MetricsInstrumentation)
+        fs_ids = [self.fs.fs_doc_store(None, {'i': i}, fs_collection_path=self.col_path)[1] for i in range(3)]
+        self.assertEqual(3, len(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+        self.assertIsNotNone(self.fs.fs_query_by_id(fs_ids[0], lookup_collection=self.collection))
+
+        metrics = self.fs.instrumentation.metrics
+        store = metrics['methods']['fs_doc_store']
+        self.assertEqual(3, store['calls'])
+        self.assertEqual({'commit': 3}, store['rpcs'])
+        self.assertGreater(store['bytes_written'], 0)
+        self.assertEqual(3, store['latency_ms']['count'])
+        self.assertLessEqual(store['latency_ms']['p50'], store['latency_ms']['p99'])
+        query = metrics['methods']['fs_query_by_collection']
+        self.assertEqual((1, 3), (query['rpcs']['run_query'], query['documents']))
+        self.assertGreater(query['bytes_read'], 0)
+        self.assertEqual(1, metrics['methods']['fs_query_by_id']['documents'])
+        # Per collection and per tenant (application root and objects path) metrics
+        self.assertEqual(5, metrics['collections'][self.col_path]['calls'])
+        self.assertIn(self.fs.path_prefix, metrics['tenants'])
+
+    def test_1_errors(self):
+        update = self.fs.fs_doc_update(fs_id='non_existent_id', doc_properties={'y': 1},
+                                       fs_collection_path=self.col_path, write_mode=FSM_WRITE_PRECONDITION)
+        self.assertFalse(update[3])
+        update = self.fs.instrumentation.metrics['methods']['fs_doc_update']
+        self.assertEqual({'NotFound': 1}, update['errors'])
+        self.assertEqual(1, update['rpcs']['commit'])
+
+    def test_2_spans(self):
+        tracer = self.MockTracer()
+        self.fs.set_instrumentation(MetricsInstrumentation(tracer=tracer))
+        fs_id = self.fs.fs_doc_store(None, {'x': 1}, fs_collection_path=self.col_path)[1]
+        self.fs.fs_doc_update(fs_id='non_existent_id', doc_properties={'y': 1}, fs_collection_path=self.col_path,
+                              write_mode=FSM_WRITE_PRECONDITION)
+        self.assertEqual(['gfs_manager.fs_doc_store', 'gfs_manager.fs_doc_update'], [s.name for s in tracer.spans])
+        store, update = tracer.spans
+        self.assertTrue(store.ended and update.ended)
+        self.assertEqual(self.col_path, store.attributes['gfs.collection_path'])
+        self.assertEqual(1, store.attributes['gfs.rpc_count'])
+        self.assertEqual([], store.exceptions)
+        self.assertEqual('NotFound', update.attributes['error.type'])
+        self.assertIsInstance(update.exceptions[0], NotFound)
+        self.assertTrue(self.fs.fs_doc_exist(self.col_path + '/' + fs_id))
+
+    def test_3_async(self):
+        async def run():
+            test_app = MockFSOApp(config_class=TestConfig)
+            test_app.config['FSM_METRICS'] = True
+            fs = AsyncGFSManager()
+            await fs.init_app(test_app)
+            try:
+                for i in range(3):
+                    await fs.fs_doc_store(None, {'i': i}, fs_collection_path=self.col_path)
+                docs = [doc async for doc in fs.fs_iter_query_by_collection(
+                    lookup_collection=self.collection, page_size=2)]
+                self.assertEqual(3, len(docs))
+                return fs.instrumentation.metrics
+            finally:
+                fs.close_connection()
+
+        metrics = asyncio.run(run())
+        self.assertEqual({'commit': 3}, metrics['methods']['fs_doc_store']['rpcs'])
+        iterate = metrics['methods']['fs_iter_query_by_collection']
+        self.assertEqual((1, 3, 2), (iterate['calls'], iterate['documents'], iterate['rpcs']['run_query']))
+
+
+class RetryCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        # Short backoff delays
+        self.fs.set_retry_policy(RetryPolicy(initial=0.001, maximum=0.01))
+        self.collection = 'Retry_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+
+    def tearDown(self):
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def rpc_count(self, rpc):
+        return self.fs.client.rpc_counts.get(rpc, 0)
+
+    def test_0_transient_errors_retried(self):
+        commits = self.rpc_count('commit')
+        self.fs.client.inject_errors('commit', ServiceUnavailable('unavailable'), ServiceUnavailable('unavailable'))
+        fs_stored_time, fs_id, fs_path, result = self.fs.fs_doc_store(None, {'x': 1}, fs_collection_path=self.col_path)
+        self.assertTrue(result)
+        self.assertEqual(commits + 3, self.rpc_count('commit'))
+        self.fs.client.inject_errors('run_query', ServiceUnavailable('unavailable'))
+        self.assertEqual(1, len(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+
+    def test_1_non_idempotent_not_retried(self):
+        fs_id, fs_path = self.fs.fs_doc_store(None, {'x': 1}, fs_collection_path=self.col_path)[1:3]
+        commits = self.rpc_count('commit')
+        # A delete asserting the document exists is not retried
+        self.fs.client.inject_errors('commit', ServiceUnavailable('unavailable'))
+        with self.assertRaises(ServiceUnavailable):
+            self.fs.fs_doc_delete(fs_id, fs_path)
+        self.assertEqual(commits + 1, self.rpc_count('commit'))
+        self.assertTrue(self.fs.fs_doc_exist(fs_path))
+        # Nor an update asserting the last update time
+        fs_updated_time = self.fs.fs_doc_update(fs_id, {'x': 2}, fs_collection_path=self.col_path)[0]
+        self.fs.client.inject_errors('commit', ServiceUnavailable('unavailable'))
+        self.assertFalse(self.fs.fs_doc_update(fs_id, {'x': 3}, fs_collection_path=self.col_path,
+                                               fs_last_update_time=fs_updated_time)[3])
+        self.assertEqual({'x': 2}, self.fs.fs_doc_properties(fs_id, fs_collection_path=self.col_path))
+
+    def test_2_retry_budget(self):
+        budget = RetryBudget(ratio=0, reserve=1)
+        self.fs.set_retry_policy(RetryPolicy(initial=0.001, maximum=0.01, budget=budget))
+        self.fs.client.inject_errors('batch_get_documents', *[ServiceUnavailable('unavailable')] * 3)
+        self.assertIsNone(self.fs.fs_query_by_id('a', lookup_collection=self.collection, use_cache=False))
+        self.assertEqual((1, 1), (budget.retries, budget.denied))
+        self.fs.client.inject_errors('batch_get_documents')
+
+    def test_3_call_retry_policy(self):
+        fs_id = self.fs.fs_doc_store(None, {'x': 1}, fs_collection_path=self.col_path)[1]
+        queries = self.rpc_count('run_query')
+        with fs_retrying(None):
+            self.fs.client.inject_errors('run_query', ServiceUnavailable('unavailable'))
+            self.assertIsNone(self.fs.fs_query_by_collection(lookup_collection=self.collection))
+        self.assertEqual(queries + 1, self.rpc_count('run_query'))
+        # Retried in the worker threads of bulk operations
+        with fs_retrying(RetryPolicy(initial=0.001, maximum=0.01)):
+            self.fs.client.inject_errors('commit', ServiceUnavailable('unavailable'))
+            results = self.fs.fs_docs_update_many({fs_id: {'x': 2}}, fs_collection_path=self.col_path, max_workers=2)
+        self.assertTrue(results[0][3])
+
+    def test_4_async(self):
+        async def run():
+            fs = AsyncGFSManager()
+            await fs.init_app(MockFSOApp(config_class=TestConfig))
+            fs.set_retry_policy(RetryPolicy(initial=0.001, maximum=0.01))
+            try:
+                fs.client.inject_errors('commit', ServiceUnavailable('unavailable'))
+                fs_stored_time, fs_id, fs_path, result = await fs.fs_doc_store(None, {'x': 1},
+                                                                               fs_collection_path=self.col_path)
+                self.assertTrue(result)
+                fs.client.inject_errors('batch_get_documents', ServiceUnavailable('unavailable'))
+                self.assertTrue(await fs.fs_doc_exist(fs_path))
+            finally:
+                fs.close_connection()
+
+        asyncio.run(run())
+
+
+class WatchCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.collection = 'Watch_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        self.changes = []
+
+    def tearDown(self):
+        self.fs.close_connection()
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def store(self, doc_properties):
+        return self.fs.fs_doc_store(None, doc_properties, fs_collection_path=self.col_path)[1]
+
+    def update(self, fs_id, doc_properties):
+        self.assertTrue(self.fs.fs_doc_update(fs_id, doc_properties, fs_collection_path=self.col_path)[3])
+
+    def delete(self, fs_id):
+        self.assertTrue(self.fs.fs_doc_delete(fs_id, self.col_path + '/' + fs_id)[3])
+
+    # Waits for the listener thread to deliver count changes
+    def wait_changes(self, count, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while len(self.changes) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return [change[:2] for change in self.changes]
+
+    def test_0_collection_mirror(self):
+        a = self.store({'x': 1})
+        b = self.store({'x': 2})
+        watch = self.fs.fs_watch_collection(lookup_collection=self.collection, callback=self.changes.extend)
+        self.assertTrue(watch.wait_ready(timeout=5))
+        self.assertEqual({a: {'x': 1}, b: {'x': 2}}, watch.mirror)
+        self.assertEqual({('added', a), ('added', b)}, set(self.wait_changes(2)))
+        self.update(a, {'x': 3})
+        self.delete(b)
+        c = self.store({'x': 4})
+        self.assertEqual([('modified', a), ('removed', b), ('added', c)], self.wait_changes(5)[2:])
+        # Last mirrored properties of removed documents
+        self.assertEqual({'x': 2}, self.changes[3][2])
+        self.assertEqual({a: {'x': 3}, c: {'x': 4}}, watch.mirror)
+        self.assertEqual((2, {'x': 4}), (len(watch), watch.get(c)))
+        self.assertNotIn(b, watch)
+        # Stopped by close_connection
+        self.fs.close_connection()
+        self.assertFalse(watch.is_active)
+
+    def test_1_query(self):
+        a = self.store({'x': 1})
+        b = self.store({'x': 2})
+        watch = self.fs.fs_watch_query(lookup_collection=self.collection, filters=[('x', '>=', 2)],
+                                       callback=self.changes.extend)
+        self.assertTrue(watch.wait_ready(timeout=5))
+        self.assertEqual([b], list(watch.mirror))
+        # Documents entering and leaving the query
+        self.update(a, {'x': 3})
+        self.update(b, {'x': 0})
+        self.assertEqual([('added', b), ('added', a), ('removed', b)], self.wait_changes(3))
+        self.assertEqual({a: {'x': 3}}, watch.mirror)
+
+    def test_2_reconnect(self):
+        a = self.store({'x': 1})
+        b = self.store({'x': 2})
+        # Listener errors are not raised by the threads of the client library
+        thread_exceptions = []
+        excepthook = threading.excepthook
+        threading.excepthook = thread_exceptions.append
+        watch = CollectionWatch(self.fs.client.collection(self.col_path), callback=self.changes.extend,
+                                check_interval=0.01, reconnect_initial=0.01).start()
+        try:
+            self.assertTrue(watch.wait_ready(timeout=5))
+            self.wait_changes(2)
+            # Listener closed by a non recoverable error, changes made while disconnected
+            self.fs.client.inject_errors('listen', PermissionDenied('denied'))
+            self.update(b, {'x': 3})
+            self.delete(a)
+            # Only the differences are delivered after the resynchronization
+            self.assertEqual([('removed', a), ('modified', b)], self.wait_changes(4)[2:])
+            self.assertEqual(1, watch.reconnects)
+            self.assertEqual({b: {'x': 3}}, watch.mirror)
+            # Changes delivered by the reopened listener
+            self.update(b, {'x': 4})
+            self.assertEqual(('modified', b), self.wait_changes(5)[4])
+            self.assertEqual({b: {'x': 4}}, watch.mirror)
+            self.assertEqual([], [args.exc_value for args in thread_exceptions])
+        finally:
+            watch.stop()
+            threading.excepthook = excepthook
+
+
+class ModelCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.fs.set_instrumentation(MetricsInstrumentation())
+
+    def tearDown(self):
+        self.fs.fs_delete_collection(lookup_collection='ModelUsers')
+        self.fs.fs_delete_collection(lookup_collection='ModelCity')
+        self.fs.close_connection()
+
+    def rpcs(self, method):
+        return self.fs.instrumentation.metrics['methods'][method]['rpcs']
+
+    def test_0_schema(self):
+        schema = fs_model_schema(ModelUser)
+        self.assertEqual(('ModelUsers', ('name', 'age', 'tags')), (schema.collection, schema.fields))
+        self.assertEqual({'name': 'ann', 'age': 30, 'tags': []}, schema.encode(ModelUser('ann', 30)))
+        # Defaults for properties missing from documents
+        user = schema.decode({'name': 'bob'}, 'id0')
+        self.assertEqual((ModelUser('bob', 0, []), 'id0'), (user, user.fs_id))
+        # Private slots are not stored, collection named as the class
+        city_schema = fs_model_schema(ModelCity)
+        self.assertEqual(('ModelCity', ('name', 'population')), (city_schema.collection, city_schema.fields))
+        with self.assertRaises(TypeError):
+            fs_model_schema(MockFSOAppObject)
+
+    def test_1_store_get_update(self):
+        user = ModelUser('ann', 30, ['a'])
+        self.assertIsNone(user.fs_id)
+        fs_stored_time, fs_id, fs_path, result = self.fs.fs_model_store(user)
+        self.assertTrue(result)
+        self.assertEqual((fs_id, fs_path, fs_stored_time), (user.fs_id, user.fs_path, user.fs_update_time))
+        self.assertEqual(self.fs.path_prefix + '/ModelUsers/' + fs_id, fs_path)
+        self.assertEqual(user, self.fs.fs_model_get(ModelUser, fs_id))
+        # Only the changed properties are written
+        user.age = 31
+        user.tags = ['a', 'b']
+        fs_updated_time, fs_id, fs_path, result = self.fs.fs_model_update(user)
+        self.assertTrue(result)
+        self.assertEqual(fs_updated_time, user.fs_update_time)
+        self.assertEqual({'commit': 1}, self.rpcs('fs_model_update'))
+        self.assertEqual({'name': 'ann', 'age': 31, 'tags': ['a', 'b']},
+                         self.fs.fs_doc_properties(fs_id, self.fs.path_prefix + '/ModelUsers'))
+        # Nothing changed: no RPC
+        self.assertTrue(self.fs.fs_model_update(user)[3])
+        self.assertEqual({'commit': 1}, self.rpcs('fs_model_update'))
+        # A concurrent write fails an update asserting the last update time
+        stored = self.fs.fs_model_get(ModelUser, fs_id, use_cache=False)
+        stored.name = 'bob'
+        self.assertTrue(self.fs.fs_model_update(stored)[3])
+        user.name = 'carl'
+        self.assertFalse(self.fs.fs_model_update(user, fs_last_update_time=user.fs_update_time)[3])
+        self.assertIsNone(self.fs.fs_model_get(ModelUser, 'missing'))
+        # Models not stored are not updated
+        self.assertFalse(self.fs.fs_model_update(ModelUser('dan'))[3])
+
+    def test_4_in_place_changes(self):
+        user = ModelUser('ann', 30, ['a'])
+        fs_stored_time, fs_id, fs_path, result = self.fs.fs_model_store(user)
+        # List property changed in place after a write, and after reads (cached or not)
+        user.tags.append('b')
+        self.assertEqual({'tags': ['a', 'b']}, fs_model_schema(ModelUser).changes(user))
+        self.assertTrue(self.fs.fs_model_update(user)[3])
+        for use_cache in (True, False):
+            stored = self.fs.fs_model_get(ModelUser, fs_id, use_cache=use_cache)
+            self.assertEqual(['a', 'b'], stored.tags)
+            stored.tags.append('c')
+            self.assertTrue(self.fs.fs_model_update(stored)[3])
+            properties = self.fs.fs_doc_properties(fs_id, self.fs.path_prefix + '/ModelUsers')
+            self.assertEqual(['a', 'b', 'c'], properties['tags'])
+            stored.tags.pop()
+            self.assertTrue(self.fs.fs_model_update(stored)[3])
+        # Snapshots of the document cache are not changed by models decoded from them
+        self.assertEqual(['a', 'b'], self.fs.fs_model_get(ModelUser, fs_id).tags)
+        self.assertEqual(['a', 'b'], self.fs.fs_model_get(ModelUser, fs_id, use_cache=False).tags)
+
+    def test_2_query_and_iterate(self):
+        for i in range(5):
+            self.fs.fs_model_store(ModelCity('city{}'.format(i), i * 100))
+        cities = self.fs.fs_query_models(ModelCity, filters=[('population', '>=', 200)], order_by=['population'])
+        self.assertEqual(['city2', 'city3', 'city4'], [city.name for city in cities])
+        self.assertTrue(all(isinstance(city, ModelCity) and city.fs_id for city in cities))
+        names = sorted(city.name for city in self.fs.fs_iter_models(ModelCity, page_size=2))
+        self.assertEqual(['city{}'.format(i) for i in range(5)], names)
+        cities = list(self.fs.fs_iter_models(ModelCity, lookup_properties={'population': 300}))
+        self.assertEqual(['city3'], [city.name for city in cities])
+        # Iterated models are updated as read models
+        cities[0].population = 301
+        self.assertTrue(self.fs.fs_model_update(cities[0])[3])
+        self.assertEqual(301, self.fs.fs_model_get(ModelCity, cities[0].fs_id).population)
+        # Operations recorded in the model collection
+        self.assertIn(self.fs.path_prefix + '/ModelCity', self.fs.instrumentation.metrics['collections'])
+
+    def test_3_async(self):
+        async def run():
+            fs = AsyncGFSManager()
+            await fs.init_app(MockFSOApp(config_class=TestConfig))
+            try:
+                user = ModelUser('ann', 30)
+                self.assertTrue((await fs.fs_model_store(user))[3])
+                user.age = 31
+                self.assertTrue((await fs.fs_model_update(user))[3])
+                self.assertEqual(user, await fs.fs_model_get(ModelUser, user.fs_id))
+                self.assertEqual([user], await fs.fs_query_models(ModelUser, lookup_properties={'age': 31}))
+                self.assertEqual([user], [model async for model in fs.fs_iter_models(ModelUser)])
+            finally:
+                fs.close_connection()
+
+        asyncio.run(run())
+
+
+class CounterCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.fs.set_retry_policy(RetryPolicy(initial=0.001, maximum=0.01))
+        self.collection = 'Counter_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        self.counter_path = self.fs.path_prefix + '/Counters/' + self.collection
+
+    def tearDown(self):
+        self.fs.set_write_coalescer(None)
+        self.fs.fs_counter_delete(self.collection)
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def rpc_count(self, rpc):
+        return self.fs.client.rpc_counts.get(rpc, 0)
+
+    def test_0_sharded_counter(self):
+        self.assertEqual(0, self.fs.fs_counter_value(self.collection))
+        for i in range(20):
+            self.assertTrue(self.fs.fs_counter_increment(self.collection, num_shards=4)[3])
+        self.fs.fs_counter_increment(self.collection, amount=-5, num_shards=4)
+        self.assertEqual(15, self.fs.fs_counter_value(self.collection))
+        shards = self.fs.fs_count(parent_doc_path=self.counter_path, lookup_collection='shards')
+        self.assertTrue(1 < shards <= 4)
+        # Counters of a document
+        fs_path = self.fs.fs_doc_store(None, {'x': 1}, fs_collection_path=self.col_path)[2]
+        self.fs.fs_counter_increment('views', amount=3, parent_doc_path=fs_path)
+        self.assertEqual(3, self.fs.fs_counter_value('views', parent_doc_path=fs_path))
+        self.assertTrue(self.fs.fs_counter_delete(self.collection))
+        self.assertEqual(0, self.fs.fs_counter_value(self.collection))
+
+    def test_1_counter_cached_value(self):
+        self.fs.fs_counter_increment(self.collection, amount=2)
+        self.assertEqual(2, self.fs.fs_counter_value(self.collection, max_age=60))
+        # Increments of other managers are not seen until max_age, increments of the manager are
+        other = GFSManager()
+        other.init_app(MockFSOApp(config_class=TestConfig))
+        other.fs_counter_increment(self.collection, amount=10)
+        other.close_connection()
+        self.fs.fs_counter_increment(self.collection)
+        queries = self.rpc_count('run_query') + self.rpc_count('run_aggregation_query')
+        self.assertEqual(3, self.fs.fs_counter_value(self.collection, max_age=60))
+        self.assertEqual(queries, self.rpc_count('run_query') + self.rpc_count('run_aggregation_query'))
+        self.assertEqual(13, self.fs.fs_counter_value(self.collection))
+
+    def test_2_write_coalescer(self):
+        coalescer = WriteCoalescer(self.fs, interval=60)
+        self.fs.set_write_coalescer(coalescer)
+        commits = self.rpc_count('commit')
+        for i in range(10):
+            result = self.fs.fs_doc_merge('a', {'last': i}, fs_collection_path=self.col_path, increments={'n': 1})
+            self.assertEqual((None, 'a', self.col_path + '/a', True), result)
+        for i in range(5):
+            self.fs.fs_counter_increment(self.collection, num_shards=1)
+        self.assertEqual((commits, 2, 15), (self.rpc_count('commit'), len(coalescer), coalescer.writes))
+        # One write per document
+        self.assertEqual(2, coalescer.flush())
+        self.assertEqual(commits + 1, self.rpc_count('commit'))
+        self.assertEqual({'last': 9, 'n': 10}, self.fs.fs_doc_properties('a', self.col_path))
+        self.assertEqual(5, self.fs.fs_counter_value(self.collection))
+        # Properties set after increments replace them, increments after properties are added to them
+        self.fs.fs_doc_merge('a', fs_collection_path=self.col_path, increments={'n': 5})
+        self.fs.fs_doc_merge('a', {'n': 1}, fs_collection_path=self.col_path, increments={'m': 1})
+        self.fs.fs_doc_merge('a', fs_collection_path=self.col_path, increments={'n': 2, 'm': 1})
+        coalescer.flush()
+        self.assertEqual({'last': 9, 'n': 3, 'm': 2}, self.fs.fs_doc_properties('a', self.col_path))
+
+    def test_3_write_coalescer_failures(self):
+        coalescer = WriteCoalescer(self.fs, interval=60)
+        self.fs.set_write_coalescer(coalescer)
+        self.fs.fs_doc_merge('a', {'x': 1}, fs_collection_path=self.col_path, increments={'n': 1})
+        # Increments are not retried, failed writes are buffered again
+        self.fs.client.inject_errors('commit', ServiceUnavailable('unavailable'))
+        self.assertEqual(0, coalescer.flush())
+        self.fs.fs_doc_merge('a', {'y': 2}, fs_collection_path=self.col_path, increments={'n': 1})
+        self.assertEqual(1, coalescer.flush())
+        self.assertEqual({'x': 1, 'y': 2, 'n': 2}, self.fs.fs_doc_properties('a', self.col_path))
+        # Buffered writes are flushed by close_connection, and by the background thread
+        self.fs.fs_doc_merge('b', {'x': 1}, fs_collection_path=self.col_path)
+        self.fs.close_connection()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.assertEqual({'x': 1}, self.fs.fs_doc_properties('b', self.col_path))
+        coalescer.interval = 0.01
+        self.fs.fs_doc_merge('c', {'x': 1}, fs_collection_path=self.col_path)
+        deadline = time.monotonic() + 5
+        while len(coalescer) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({'x': 1}, self.fs.fs_doc_properties('c', self.col_path, use_cache=False))
+
+    def test_4_async(self):
+        async def run():
+            fs = AsyncGFSManager()
+            await fs.init_app(MockFSOApp(config_class=TestConfig))
+            try:
+                for i in range(3):
+                    self.assertTrue((await fs.fs_counter_increment(self.collection, num_shards=2))[3])
+                self.assertEqual(3, await fs.fs_counter_value(self.collection))
+                self.assertTrue((await fs.fs_doc_merge('a', {'x': 1}, fs_collection_path=self.col_path,
+                                                       increments={'n': 2}))[3])
+                self.assertEqual({'x': 1, 'n': 2}, await fs.fs_doc_properties('a', self.col_path))
+                self.assertTrue(await fs.fs_counter_delete(self.collection))
+            finally:
+                fs.close_connection()
+
+        asyncio.run(run())
+
+
+class TransactionCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.collection = 'Transaction_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        self.fs_id = self.fs.fs_doc_store(None, {'n': 0, 'tags': ['a']}, fs_collection_path=self.col_path)[1]
+        self.fs_path = self.col_path + '/' + self.fs_id
+
+    def tearDown(self):
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def test_0_concurrent_transforms(self):
+        def increment(properties):
+            return dict(properties, n=properties['n'] + 1)
+
+        def worker():
+            for i in range(5):
+                self.assertTrue(self.fs.fs_doc_transform(self.fs_id, increment, fs_collection_path=self.col_path,
+                                                         max_attempts=100)[3])
+
+        threads = [threading.Thread(target=worker) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # No lost updates
+        self.assertEqual(30, self.fs.fs_doc_properties(self.fs_id, fs_collection_path=self.col_path)['n'])
+        stats = self.fs.contention_stats.stats
+        self.assertEqual((30, 0), (stats['transactions'], stats['aborts']))
+        self.assertEqual(30, stats['keys'][self.fs_path]['transactions'])
+
+    def test_1_transform_results(self):
+        fs_updated_time, fs_id, fs_path, result = self.fs.fs_doc_transform(
+            self.fs_id, lambda properties: dict(properties, n=10), fs_collection_path=self.col_path,
+            field_transforms={'tags': firestore.ArrayUnion(['b'])})
+        self.assertEqual((self.fs_id, self.fs_path, True), (fs_id, fs_path, result))
+        self.assertIsNotNone(fs_updated_time)
+        self.assertEqual({'n': 10, 'tags': ['a', 'b']},
+                         self.fs.fs_doc_properties(self.fs_id, fs_collection_path=self.col_path))
+        # Unchanged documents are not written
+        self.assertEqual((None, True), itemgetter(0, 3)(self.fs.fs_doc_transform(
+            self.fs_id, lambda properties: None, fs_collection_path=self.col_path)))
+        # Missing documents
+        self.assertFalse(self.fs.fs_doc_transform('missing', lambda properties: None,
+                                                  fs_collection_path=self.col_path)[3])
+        self.assertTrue(self.fs.fs_doc_transform('created', lambda properties: {'n': 1},
+                                                 fs_collection_path=self.col_path)[3])
+        # Invalid collection path
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual((None, self.fs_id, None, False), self.fs.fs_doc_transform(
+                self.fs_id, lambda properties: None, fs_collection_path=None))
+
+    def test_2_field_transforms(self):
+        calls = dict(self.fs.client.rpc_counts)
+        result = self.fs.fs_doc_transform(self.fs_id, fs_collection_path=self.col_path, field_transforms={
+            'n': firestore.Increment(5), 'tags': firestore.ArrayUnion(['a', 'c']), 'seen': firestore.SERVER_TIMESTAMP})
+        self.assertTrue(result[3])
+        # Written with no read nor transaction
+        for rpc in ('batch_get_documents', 'begin_transaction'):
+            self.assertEqual(calls.get(rpc, 0), self.fs.client.rpc_counts.get(rpc, 0))
+        properties = self.fs.fs_doc_properties(self.fs_id, fs_collection_path=self.col_path)
+        self.assertEqual((5, ['a', 'c'], result[0]), (properties['n'], properties['tags'], properties['seen']))
+        self.assertFalse(self.fs.fs_doc_transform('missing', fs_collection_path=self.col_path,
+                                                  field_transforms={'n': firestore.Increment(1)})[3])
+
+    def test_3_aborted_transaction(self):
+        fs_doc_ref = self.fs.client.document(self.fs_path)
+
+        def conflicting(transaction, amount):
+            n = fs_doc_ref.get(transaction=transaction).get('n')
+            # Concurrent write of the document read
+            self.fs.fs_doc_update(self.fs_id, {'n': n + 100}, fs_collection_path=self.col_path,
+                                  write_mode=FSM_WRITE_STRICT)
+            transaction.update(fs_doc_ref, {'n': n + amount})
+            return n + amount
+
+        self.assertEqual((None, False), self.fs.fs_transaction(conflicting, 1, max_attempts=3, name='conflicting'))
+        self.assertEqual({'transactions': 1, 'retries': 2, 'aborts': 1},
+                         self.fs.contention_stats.stats['keys']['conflicting'])
+        self.assertEqual('conflicting', self.fs.contention_stats.hot_keys()[0][0])
+        self.assertEqual(300, self.fs.fs_doc_properties(self.fs_id, fs_collection_path=self.col_path)['n'])
+
+        def move(transaction, amount):
+            n = fs_doc_ref.get(transaction=transaction).get('n')
+            transaction.update(fs_doc_ref, {'n': n - amount})
+            transaction.create(fs_doc_ref.parent.document('moved'), {'n': amount})
+            return n - amount
+
+        self.assertEqual((290, True), self.fs.fs_transaction(move, 10))
+        self.assertEqual({'n': 10}, self.fs.fs_doc_properties('moved', fs_collection_path=self.col_path))
+        self.fs.contention_stats.reset()
+        self.assertEqual(0, self.fs.contention_stats.stats['transactions'])
+
+    def test_4_async_transforms(self):
+        async def run():
+            fs = AsyncGFSManager()
+            await fs.init_app(MockFSOApp(config_class=TestConfig))
+
+            async def increment(transaction):
+                fs_doc_ref = fs.client.document(self.fs_path)
+                n = (await fs_doc_ref.get(transaction=transaction)).get('n')
+                transaction.update(fs_doc_ref, {'n': n + 1})
+                return n + 1
+
+            results = await asyncio.gather(*[
+                fs.fs_doc_transform(self.fs_id, lambda properties: dict(properties, n=properties['n'] + 1),
+                                    fs_collection_path=self.col_path, max_attempts=100) for i in range(10)])
+            self.assertTrue(all(result[3] for result in results))
+            self.assertEqual((11, True), await fs.fs_transaction(increment, max_attempts=100))
+            await fs.fs_doc_transform(self.fs_id, fs_collection_path=self.col_path,
+                                      field_transforms={'n': firestore.Increment(2)})
+            self.assertEqual(13, (await fs.fs_doc_properties(self.fs_id, fs_collection_path=self.col_path))['n'])
+            self.assertFalse((await fs.fs_doc_transform(self.fs_id, fs_collection_path=None,
+                                                        field_transforms={'n': firestore.Increment(2)}))[3])
+            self.assertEqual(11, fs.contention_stats.stats['transactions'])
+            fs.close_connection()
+
+        asyncio.run(run())
+
+
+class BufferedWriterCase(unittest.TestCase):
+    def setUp(self):
+        self.app = MockFSOApp(config_class=TestConfig)
+        self.fs = GFSManager()
+        self.fs.init_app(self.app)
+        self.collection = 'Buffered_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.spill_path = os.path.join(self.tmp_dir.name, 'writes.spill')
+
+    def tearDown(self):
+        self.fs.set_buffered_writer(None)
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+        self.tmp_dir.cleanup()
+
+    def count(self):
+        return self.fs.fs_count(lookup_collection=self.collection)
+
+    def test_0_background_flushes(self):
+        writer = BufferedWriter(self.fs, batch_size=10, interval=60)
+        self.fs.set_buffered_writer(writer)
+        paths = [self.fs.fs_doc_store_buffered(None, {'i': i}, fs_collection_path=self.col_path)[2]
+                 for i in range(25)]
+        self.assertTrue(all(paths))
+        # Flushed by size, not by interval
+        deadline = time.monotonic() + 5
+        while writer.committed < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertGreaterEqual(writer.committed, 20)
+        fs_id = paths[0].rpartition('/')[2]
+        self.assertTrue(self.fs.fs_doc_merge_buffered(fs_id, {'seen': True}, fs_collection_path=self.col_path)[3])
+        # Flushed by close_connection
+        self.fs.close_connection()
+        self.assertEqual((0, 26), (len(writer), writer.writes))
+        self.fs.init_app(self.app)
+        self.assertEqual(25, self.count())
+        self.assertEqual({'i': 0, 'seen': True}, self.fs.fs_doc_properties(fs_id, fs_collection_path=self.col_path))
+
+    def test_1_backpressure(self):
+        writer = BufferedWriter(self.fs, max_size=3, batch_size=100, interval=60, timeout=0.1)
+        self.fs.set_buffered_writer(writer)
+        self.fs.client.inject_errors('commit', PermissionDenied('denied'))
+        for i in range(3):
+            self.assertTrue(self.fs.fs_doc_store_buffered(None, {'i': i}, fs_collection_path=self.col_path)[3])
+        # Buffer full, the flush fails
+        self.assertEqual((None, None, None, False),
+                         self.fs.fs_doc_store_buffered(None, {'i': 3}, fs_collection_path=self.col_path))
+        self.assertEqual((1, 3), (writer.rejected, len(writer)))
+        self.assertEqual(3, writer.flush())
+        self.assertEqual(3, self.count())
+        # Without buffered writer
+        self.fs.set_buffered_writer(None)
+        self.assertIsNotNone(self.fs.fs_doc_store_buffered(None, {'i': 4}, fs_collection_path=self.col_path)[0])
+
+    def test_2_spill_recovery(self):
+        crashed = BufferedWriter(self.fs, batch_size=100, interval=60, spill_path=self.spill_path)
+        fs_paths = [crashed.store(self.col_path, {'i': i, 'at': firestore.SERVER_TIMESTAMP}) for i in range(5)]
+        typed = {'merged': True, 'bytes': b'\x00', 'ref': self.fs.client.document(fs_paths[1]),
+                 'nested': {'$key': [1.5, None], 'at': firestore.SERVER_TIMESTAMP}, 'i': firestore.DELETE_FIELD}
+        crashed.merge(fs_paths[0], typed)
+        with open(self.spill_path, 'ab') as spill:
+            # Record truncated by the crash
+            spill.write(b'[7,"store"')
+        writer = BufferedWriter(self.fs, interval=60, spill_path=self.spill_path)
+        self.assertEqual(6, writer.recover())
+        self.assertEqual(6, writer.flush())
+        fs_docs = {fs_doc.reference.path: fs_doc.to_dict() for fs_doc in
+                   self.fs.fs_query_by_collection(lookup_collection=self.collection)}
+        self.assertEqual(set(fs_paths), set(fs_docs))
+        merged = fs_docs[fs_paths[0]]
+        self.assertEqual((True, b'\x00', fs_paths[1], [1.5, None]),
+                         (merged['merged'], merged['bytes'], merged['ref'].path, merged['nested']['$key']))
+        self.assertNotIn('i', merged)
+        self.assertIsInstance(merged['nested']['at'], datetime.datetime)
+        self.assertTrue(all(isinstance(properties['at'], datetime.datetime) for properties in fs_docs.values()))
+        # Written writes are not recovered again
+        writer.close()
+        self.assertEqual(0, BufferedWriter(self.fs, spill_path=self.spill_path).recover())
+        # Spill files are data only: a pickle payload is not loaded, the file is kept and not recovered
+        payload = pickle.dumps(MockFSOAppObject()) + b'\n'
+        with open(self.spill_path, 'wb') as spill:
+            spill.write(payload)
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(0, BufferedWriter(self.fs, spill_path=self.spill_path).recover())
+        kept = [name for name in os.listdir(self.tmp_dir.name) if name.startswith('writes.spill.unrecovered-')]
+        self.assertEqual(1, len(kept))
+        with open(os.path.join(self.tmp_dir.name, kept[0]), 'rb') as spill:
+            self.assertEqual(payload, spill.read())
+
+    def test_4_restart_recovery(self):
+        self.app.config['FSM_BUFFER_INTERVAL'] = 60
+        self.app.config['FSM_BUFFER_SPILL_FILE'] = self.spill_path
+        for lazy in (False, True):
+            self.app.config['FSM_LAZY_INIT'] = lazy
+            self.fs.init_app(self.app)
+            fs_ref = self.fs.client.document(self.col_path + '/target')
+            fs_path = self.fs.fs_doc_store_buffered(None, {'ref': fs_ref, 'lazy': lazy},
+                                                    fs_collection_path=self.col_path)[2]
+            self.fs.fs_doc_store_buffered(None, {'plain': lazy}, fs_collection_path=self.col_path)
+            # Values not spillable are rejected
+            self.assertFalse(self.fs.fs_doc_store_buffered(None, {'n': firestore.Increment(1)},
+                                                           fs_collection_path=self.col_path)[3])
+            # Process crash: writes not committed, spill file left as is
+            self.fs.buffered_writer._BufferedWriter__spill.close()
+            self.fs.set_buffered_writer(None)
+            # Restarted: spilled writes recovered once connected, references decoded with the client
+            self.fs.init_app(self.app)
+            self.fs.fs_doc_store_buffered(None, {'after': lazy}, fs_collection_path=self.col_path)
+            self.assertEqual(3, len(self.fs.buffered_writer))
+            self.fs.buffered_writer.flush()
+            properties = self.fs.fs_doc_properties(fs_path.rpartition('/')[2], fs_collection_path=self.col_path)
+            self.assertEqual(fs_ref.path, properties['ref'].path)
+            self.fs.set_buffered_writer(None)
+        self.assertEqual(6, self.count())
+
+    def test_3_config(self):
+        self.app.config['FSM_BUFFER_INTERVAL'] = 0.05
+        self.app.config['FSM_BUFFER_SPILL_FILE'] = self.spill_path
+        self.fs.init_app(self.app)
+        self.assertIsInstance(self.fs.buffered_writer, BufferedWriter)
+        fs_id = self.fs.fs_doc_store_buffered(None, {'i': 0}, fs_collection_path=self.col_path)[1]
+        deadline = time.monotonic() + 5
+        while self.fs.buffered_writer.committed < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({'i': 0}, self.fs.fs_doc_properties(fs_id, fs_collection_path=self.col_path))
+        # Initialized again: the write buffers of the previous config are flushed and their threads stopped
+        self.app.config['FSM_BUFFER_INTERVAL'] = 60
+        self.app.config['FSM_COALESCE_INTERVAL'] = 60
+        self.fs.init_app(self.app)
+        writer, coalescer = self.fs.buffered_writer, self.fs.write_coalescer
+        fs_id = self.fs.fs_doc_store_buffered(None, {'i': 1}, fs_collection_path=self.col_path)[1]
+        self.assertTrue(self.fs.fs_doc_merge(fs_id, {'j': 1}, fs_collection_path=self.col_path)[3])
+        self.assertEqual((1, 1), (len(writer), len(coalescer)))
+        self.app.config['FSM_BUFFER_INTERVAL'] = None
+        self.app.config['FSM_COALESCE_INTERVAL'] = None
+        self.fs.init_app(self.app)
+        self.assertEqual((None, None), (self.fs.buffered_writer, self.fs.write_coalescer))
+        self.assertEqual((0, 0), (len(writer), len(coalescer)))
+        self.assertIsNone(writer._BufferedWriter__thread)
+        self.assertIsNone(coalescer._WriteCoalescer__thread)
+        self.assertEqual({'i': 1, 'j': 1}, self.fs.fs_doc_properties(fs_id, fs_collection_path=self.col_path))
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        tenant = 'Export_{}'.format(random.randint(0, 10 ** 9))
+        self.source = self.fs.path_prefix + '/Tenants/' + tenant
+        self.target = self.fs.path_prefix + '/Tenants/' + tenant + '_copy'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        client = self.fs.client
+        users = [{'i': i, 'name': 'user{}'.format(i)} for i in range(120)]
+        self.fs.fs_docs_store_many(None, users, fs_collection_path=self.source + '/Users')
+        city_path = self.source + '/Cities/paris'
+        client.document(city_path).set({
+            'at': datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+            'raw': b'\x00\xff', 'geo': firestore.GeoPoint(48.85, 2.35), 'nan': float('nan'), 'inf': float('-inf'),
+            'map': {'$tag': [1, {'nested': None}], 'ok': True}, 'capital_of': client.document(self.source),
+            'external': client.document('Elsewhere/doc')})
+        # Subcollections at any depth, and under a document that does not exist
+        client.document(city_path + '/Districts/d1').set({'n': 1})
+        client.document(city_path + '/Districts/d1/Streets/s1').set({'n': 2})
+        client.document(self.source + '/Cities/ghost/Districts/d2').set({'n': 3})
+
+    def tearDown(self):
+        for root in (self.source, self.target):
+            for collection in ('Users', 'Cities'):
+                self.fs.fs_delete_collection(parent_doc_path=root, lookup_collection=collection)
+        self.fs.close_connection()
+        self.tmp_dir.cleanup()
+
+    def documents(self, root):
+        return {fs_doc.reference.path[len(root) + 1:]: fs_doc.to_dict()
+                for collection in ('Users', 'Cities')
+                for fs_doc in self.fs.client.collection(root + '/' + collection).recursive().stream()}
+
+    def test_0_export_import(self):
+        stats = self.fs.fs_export(self.tmp_dir.name, parent_doc_path=self.source, partitions=4, page_size=30)
+        self.assertEqual((124, []), (stats['documents'], stats['failed']))
+        manifest = json.load(open(os.path.join(self.tmp_dir.name, 'manifest.json')))
+        self.assertEqual(['Cities', 'Users'], sorted(manifest['collections']))
+        self.assertTrue(len(manifest['collections']['Users']) > 1)
+        stats = self.fs.fs_import(self.tmp_dir.name, parent_doc_path=self.target, batch_size=50)
+        self.assertEqual((124, []), (stats['documents'], stats['failed']))
+        source, target = self.documents(self.source), self.documents(self.target)
+        self.assertEqual(set(source), set(target))
+        self.assertEqual(124, len(target))
+        city = target['Cities/paris']
+        self.assertTrue(math.isnan(city.pop('nan')))
+        self.assertEqual(self.target, city.pop('capital_of').path)
+        self.assertEqual('Elsewhere/doc', city.pop('external').path)
+        expected = source['Cities/paris']
+        for name in ('nan', 'capital_of', 'external'):
+            expected.pop(name)
+        self.assertEqual(expected, city)
+        self.assertEqual(source['Cities/paris/Districts/d1/Streets/s1'], target['Cities/paris/Districts/d1/Streets/s1'])
+
+    def test_1_resume(self):
+        self.fs.client.inject_errors('run_query', PermissionDenied('denied'))
+        stats = self.fs.fs_export(self.tmp_dir.name, parent_doc_path=self.source, lookup_collection='Users',
+                                  partitions=4, max_workers=1)
+        self.assertEqual(1, len(stats['failed']))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, 'manifest.json')))
+        self.assertIsNone(self.fs.fs_import(self.tmp_dir.name, parent_doc_path=self.target))
+        # Only the failed partition exported again
+        stats = self.fs.fs_export(self.tmp_dir.name, parent_doc_path=self.source, lookup_collection='Users',
+                                  partitions=4, max_workers=1)
+        self.assertEqual((1, []), (stats['files'], stats['failed']))
+        self.fs.client.inject_errors('commit', PermissionDenied('denied'))
+        stats = self.fs.fs_import(self.tmp_dir.name, parent_doc_path=self.target, max_workers=1)
+        self.assertEqual(1, len(stats['failed']))
+        stats = self.fs.fs_import(self.tmp_dir.name, parent_doc_path=self.target, max_workers=1)
+        self.assertEqual((1, []), (stats['files'], stats['failed']))
+        self.assertEqual(120, self.fs.fs_count(parent_doc_path=self.target, lookup_collection='Users'))
+        # Imported again without checkpoint
+        stats = self.fs.fs_import(self.tmp_dir.name, parent_doc_path=self.target, resume=False)
+        self.assertEqual(120, stats['documents'])
+
+
+class IndexCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.collection = 'Indexed_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        fs_index(self.collection, 'email', unique=True)
+        fs_index(self.collection, 'city', include=['name'])
+
+    def tearDown(self):
+        fs_drop_index(self.collection, 'email')
+        fs_drop_index(self.collection, 'city')
+        for collection in (self.collection, self.collection + '_by_email', self.collection + '_by_city'):
+            self.fs.fs_delete_collection(lookup_collection=collection)
+        self.fs.close_connection()
+
+    def rpc_count(self, rpc):
+        return self.fs.client.rpc_counts.get(rpc, 0)
+
+    def store(self, email, city, name='user'):
+        return self.fs.fs_doc_store(None, {'email': email, 'city': city, 'name': name},
+                                    fs_collection_path=self.col_path)
+
+    def emails(self, email):
+        return self.fs.fs_index_lookup('email', email, lookup_collection=self.collection)
+
+    def test_0_unique_index(self):
+        fs_stored_time, fs_id, fs_path, result = self.store('a@x.com', 'paris')
+        self.assertTrue(result)
+        reads = self.rpc_count('batch_get_documents')
+        self.assertEqual([{'fs_id': fs_id, 'fs_path': fs_path}], self.emails('a@x.com'))
+        # Single document read
+        self.assertEqual(reads + 1, self.rpc_count('batch_get_documents'))
+        self.assertEqual([], self.emails('b@x.com'))
+        # Value indexed for another document: nothing written
+        self.assertFalse(self.store('a@x.com', 'rome')[3])
+        self.assertEqual(1, self.fs.fs_count(lookup_collection=self.collection))
+        other_id = self.store('b@x.com', 'rome')[1]
+        self.assertFalse(self.fs.fs_doc_update(other_id, {'email': 'a@x.com'}, fs_collection_path=self.col_path)[3])
+        self.assertEqual('b@x.com', self.fs.fs_doc_properties(other_id, fs_collection_path=self.col_path)['email'])
+        # Value changed
+        self.assertTrue(self.fs.fs_doc_update(fs_id, {'email': 'c@x.com', 'city': 'paris'},
+                                              fs_collection_path=self.col_path)[3])
+        self.assertEqual(([], fs_id), (self.emails('a@x.com'), self.emails('c@x.com')[0]['fs_id']))
+        self.assertEqual(fs_id, self.fs.fs_query_by_index('email', 'c@x.com', lookup_collection=self.collection)[0].id)
+        # Deleted with the document
+        self.assertTrue(self.fs.fs_doc_delete(fs_id, fs_path)[3])
+        self.assertEqual([], self.emails('c@x.com'))
+        self.assertFalse(self.fs.fs_doc_delete(fs_id, fs_path)[3])
+        self.assertTrue(self.store('a@x.com', 'rome')[3])
+        # Values not indexed
+        self.assertIsNone(self.fs.fs_index_lookup('name', 'user', lookup_collection=self.collection))
+        self.assertTrue(self.fs.fs_doc_store(None, {'email': ['a/b', 1]}, fs_collection_path=self.col_path)[3])
+
+    def test_1_lookup_table(self):
+        ids = [self.store('{}@x.com'.format(i), 'paris' if i < 3 else 'rome', name='user{}'.format(i))[1]
+               for i in range(5)]
+        entries = self.fs.fs_index_lookup('city', 'paris', lookup_collection=self.collection)
+        self.assertEqual({(fs_id, 'user{}'.format(i)) for i, fs_id in enumerate(ids[:3])},
+                         {(entry['fs_id'], entry['name']) for entry in entries})
+        # Merges and increments
+        self.fs.fs_doc_merge(ids[0], {'city': 'rome', 'name': 'renamed'}, fs_collection_path=self.col_path,
+                             increments={'visits': 2})
+        self.fs.fs_doc_merge(ids[0], None, fs_collection_path=self.col_path, increments={'visits': 3})
+        self.assertEqual(5, self.fs.fs_doc_properties(ids[0], fs_collection_path=self.col_path)['visits'])
+        self.assertEqual(2, len(self.fs.fs_index_lookup('city', 'paris', lookup_collection=self.collection)))
+        rome = {entry['fs_id']: entry['name']
+                for entry in self.fs.fs_index_lookup('city', 'rome', lookup_collection=self.collection)}
+        self.assertEqual('renamed', rome[ids[0]])
+        self.assertEqual({ids[0], ids[3], ids[4]},
+                         {fs_doc.id for fs_doc in self.fs.fs_query_by_index('city', 'rome',
+                                                                            lookup_collection=self.collection)})
+        # Transactions recorded in the contention statistics
+        self.assertEqual(2, self.fs.contention_stats.stats['keys'][self.col_path + '/' + ids[0]]['transactions'])
+
+    def test_2_models(self):
+        fs_index(ModelUser, 'name', unique=True)
+        try:
+            parent_doc_path = self.col_path + '/tenant'
+            user = ModelUser(name='ann', age=30)
+            self.assertTrue(self.fs.fs_model_store(user, parent_doc_path=parent_doc_path)[3])
+            user.name = 'bea'
+            self.assertTrue(self.fs.fs_model_update(user)[3])
+            self.assertEqual([], self.fs.fs_index_lookup('name', 'ann', parent_doc_path=parent_doc_path,
+                                                         lookup_collection='ModelUsers'))
+            self.assertEqual(user.fs_id, self.fs.fs_index_lookup('name', 'bea', parent_doc_path=parent_doc_path,
+                                                                 lookup_collection='ModelUsers')[0]['fs_id'])
+            self.assertFalse(self.fs.fs_model_store(ModelUser(name='bea'), parent_doc_path=parent_doc_path)[3])
+        finally:
+            fs_drop_index(ModelUser, 'name')
+
+    def test_3_rebuild(self):
+        fs_drop_index(self.collection, 'email')
+        self.fs.fs_docs_store_many(None, [{'email': '{}@x.com'.format(i % 4)} for i in range(6)],
+                                   fs_collection_path=self.col_path)
+        fs_index(self.collection, 'email', unique=True)
+        self.assertEqual([], self.emails('1@x.com'))
+        stats = self.fs.fs_index_rebuild('email', lookup_collection=self.collection, page_size=4)
+        self.assertEqual({'documents': 6, 'entries': 4, 'conflicts': 2}, stats)
+        self.assertEqual(1, len(self.emails('1@x.com')))
+        self.assertIsNone(self.fs.fs_index_rebuild('name', lookup_collection=self.collection))
+
+    def test_5_bulk_writes(self):
+        stored = self.fs.fs_docs_store_many(None, [{'email': '{}@x.com'.format(i), 'city': 'oslo', 'name': str(i)}
+                                                   for i in range(5)], fs_collection_path=self.col_path, batch_size=500)
+        self.assertTrue(all(result for fs_stored_time, fs_id, fs_path, result in stored))
+        self.assertEqual([{'fs_id': stored[2][1], 'fs_path': stored[2][2]}], self.emails('2@x.com'))
+        self.assertEqual(5, len(self.fs.fs_index_lookup('city', 'oslo', lookup_collection=self.collection)))
+        # Value indexed for another document: the chunk is not written
+        self.assertFalse(self.fs.fs_docs_store_many(None, [{'email': '0@x.com'}],
+                                                    fs_collection_path=self.col_path)[0][3])
+        fs_docs = [(fs_id, fs_path) for fs_stored_time, fs_id, fs_path, result in stored[:2]]
+        deleted = self.fs.fs_docs_delete_many(fs_docs + [('missing', self.col_path + '/missing')])
+        self.assertEqual([True, True, False], [result for fs_deleted_time, fs_id, fs_path, result in deleted])
+        self.assertEqual(([], 3), (self.emails('0@x.com'),
+                                   len(self.fs.fs_index_lookup('city', 'oslo', lookup_collection=self.collection))))
+
+    def test_6_collection_delete(self):
+        self.store('a@x.com', 'paris')
+        self.assertTrue(self.fs.fs_delete_collection(lookup_collection=self.collection, recursive=False))
+        self.assertEqual([], self.emails('a@x.com'))
+        self.assertEqual([], self.fs.fs_index_lookup('city', 'paris', lookup_collection=self.collection))
+        # Entries subcollections of the non unique index
+        self.assertEqual([], list(self.fs.client.collection(self.col_path + '_by_city').recursive().stream()))
+        # Unique value indexed again
+        fs_stored_time, fs_id, fs_path, result = self.store('a@x.com', 'paris')
+        self.assertTrue(result)
+        self.assertEqual(fs_id, self.emails('a@x.com')[0]['fs_id'])
+
+    def test_4_async_indexes(self):
+        async def run():
+            fs = AsyncGFSManager()
+            await fs.init_app(MockFSOApp(config_class=TestConfig))
+            fs_id, fs_path = (await fs.fs_doc_store(None, {'email': 'a@x.com', 'city': 'paris', 'name': 'ann'},
+                                                    fs_collection_path=self.col_path))[1:3]
+            self.assertFalse((await fs.fs_doc_store(None, {'email': 'a@x.com'}, fs_collection_path=self.col_path))[3])
+            self.assertEqual(fs_id, (await fs.fs_index_lookup('email', 'a@x.com',
+                                                              lookup_collection=self.collection))[0]['fs_id'])
+            await fs.fs_doc_update(fs_id, {'email': 'b@x.com', 'city': 'rome'}, fs_collection_path=self.col_path)
+            await fs.fs_doc_merge(fs_id, {'name': 'bea'}, fs_collection_path=self.col_path)
+            self.assertEqual([fs_id], [fs_doc.id for fs_doc in await fs.fs_query_by_index(
+                'email', 'b@x.com', lookup_collection=self.collection)])
+            self.assertEqual([], await fs.fs_index_lookup('city', 'paris', lookup_collection=self.collection))
+            self.assertTrue((await fs.fs_doc_delete(fs_id, fs_path))[3])
+            self.assertEqual([], await fs.fs_index_lookup('email', 'b@x.com', lookup_collection=self.collection))
+            # Bulk writes and collection deletion
+            stored = await fs.fs_docs_store_many(None, [{'email': 'c@x.com'}], fs_collection_path=self.col_path)
+            self.assertEqual(stored[0][1], (await fs.fs_index_lookup('email', 'c@x.com',
+                                                                     lookup_collection=self.collection))[0]['fs_id'])
+            self.assertTrue((await fs.fs_docs_delete_many([stored[0][1:3]]))[0][3])
+            self.assertEqual([], await fs.fs_index_lookup('email', 'c@x.com', lookup_collection=self.collection))
+            await fs.fs_doc_store(None, {'email': 'd@x.com'}, fs_collection_path=self.col_path)
+            self.assertTrue(await fs.fs_delete_collection(lookup_collection=self.collection))
+            self.assertEqual([], await fs.fs_index_lookup('email', 'd@x.com', lookup_collection=self.collection))
+            fs.close_connection()
+
+        asyncio.run(run())
+
+
+class QueryCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = MockFSOApp(config_class=TestConfig)
+        self.app.config['FSM_QUERY_CACHE_TTL'] = 60
+        self.fs = GFSManager()
+        self.fs.init_app(self.app)
+        self.collection = 'QueryCache_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+
+    def tearDown(self):
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def store(self, doc_properties):
+        return self.fs.fs_doc_store(None, doc_properties, fs_collection_path=self.col_path)[1]
+
+    def names(self, fs_docs):
+        return sorted(fs_doc.get('name') for fs_doc in fs_docs)
+
+    def test_0_normalized_keys(self):
+        key = QueryCache.key('c', lookup_properties={'a': 1, 'b': [1, {'x': 2}]}, order_by=['n'])
+        self.assertEqual(key, QueryCache.key('c', filters=[('b', '==', [1, {'x': 2}]), ('a', '==', 1)],
+                                             order_by=[('n', 'ASCENDING')]))
+        self.assertNotEqual(key, QueryCache.key('c', lookup_properties={'a': True, 'b': [1, {'x': 2}]},
+                                                order_by=['n']))
+        self.assertNotEqual(key, QueryCache.key('c', lookup_properties={'a': 1, 'b': [1, {'x': 2}]}, limit=1,
+                                                order_by=['n']))
+        # Bounded number of queries
+        cache = QueryCache(max_entries=2)
+        for i in range(3):
+            cache.put(QueryCache.key('c', limit=i), [], cache.begin(QueryCache.key('c', limit=i)))
+        self.assertEqual((2, 1), (cache.stats['entries'], cache.stats['evictions']))
+        self.assertIsNone(cache.get(QueryCache.key('c', limit=0)))
+
+    def test_1_invalidated_by_writes(self):
+        a = self.store({'name': 'a', 'group': 1})
+        self.store({'name': 'b', 'group': 2})
+        self.assertEqual(['a', 'b'], self.names(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+        self.assertEqual(['a'], self.names(self.fs.fs_query_by_properties({'group': 1},
+                                                                          lookup_collection=self.collection)))
+        self.assertEqual(['a'], self.names(self.fs.fs_query(lookup_collection=self.collection,
+                                                            filters=[('group', '==', 1)])))
+        self.assertEqual(['a', 'b'], self.names(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+        self.assertEqual({'hits': 2, 'misses': 2}, {k: self.fs.query_cache.stats[k] for k in ('hits', 'misses')})
+        # New document, update, transaction and deletion
+        self.store({'name': 'c', 'group': 1})
+        self.assertEqual(['a', 'c'], self.names(self.fs.fs_query_by_properties({'group': 1},
+                                                                               lookup_collection=self.collection)))
+        self.assertTrue(self.fs.fs_doc_update(a, {'name': 'a', 'group': 2}, fs_collection_path=self.col_path)[3])
+        self.assertEqual(['c'], self.names(self.fs.fs_query_by_properties({'group': 1},
+                                                                          lookup_collection=self.collection)))
+        a_ref = self.fs.client.document(self.col_path + '/' + a)
+        self.assertTrue(self.fs.fs_transaction(lambda transaction: transaction.update(a_ref, {'group': 1}))[1])
+        self.assertEqual(['a', 'c'], self.names(self.fs.fs_query_by_properties({'group': 1},
+                                                                               lookup_collection=self.collection)))
+        self.assertTrue(self.fs.fs_doc_delete(a, self.col_path + '/' + a)[3])
+        self.assertEqual(['b', 'c'], self.names(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+        # Cached results are copies
+        self.fs.fs_query_by_collection(lookup_collection=self.collection).clear()
+        self.assertEqual(2, len(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+
+    def test_2_concurrent_invalidation(self):
+        cache = self.fs.query_cache
+        key = QueryCache.key(self.col_path)
+        token = cache.begin(key)
+        # Write while the query is running: its results may miss the write
+        cache.invalidate(self.col_path)
+        cache.put(key, [], token)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, [], cache.begin(key))
+        self.assertEqual([], cache.get(key))
+
+    def test_3_invalidated_by_listener(self):
+        self.store({'name': 'a'})
+        watch = self.fs.fs_watch_cache(lookup_collection=self.collection)
+        self.assertTrue(watch.wait_ready(timeout=5))
+        self.assertEqual(['a'], self.names(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+        # Write of another process, not seen by the manager
+        self.fs.client.collection(self.col_path).document().set({'name': 'b'})
+        deadline = time.monotonic() + 5
+        while len(self.fs.fs_query_by_collection(lookup_collection=self.collection)) < 2 and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['a', 'b'], self.names(self.fs.fs_query_by_collection(lookup_collection=self.collection)))
+        watch.stop()
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'fork not supported')
+class ForkCase(unittest.TestCase):
+    def setUp(self):
+        self.app = MockFSOApp(config_class=TestConfig)
+        self.fs = GFSManager()
+        self.fs.init_app(self.app)
+        self.collection = 'Fork_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.fs.set_buffered_writer(None)
+        self.fs.close_connection()
+        self.tmp_dir.cleanup()
+
+    # Runs child() in a forked process, returns its exit code: 0 if child() returned True
+    @staticmethod
+    def fork(child):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                exit_code = 0 if child() else 1
+            finally:
+                os._exit(exit_code)
+        return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+    def test_0_client_rebuilt_in_child(self):
+        parent_client = self.fs.client
+        rpc_counts = dict(parent_client.rpc_counts)
+
+        def child():
+            fs_stored_time, fs_id, fs_path, result = self.fs.fs_doc_store(None, {'n': 1},
+                                                                           fs_collection_path=self.col_path)
+            # App document not bootstrapped again
+            return self.fs.client is not parent_client and result and \
+                self.fs.fs_doc_properties(fs_id, fs_collection_path=self.col_path) == {'n': 1} and \
+                self.fs.client.rpc_counts == {'commit': 1, 'batch_get_documents': 1}
+
+        self.assertEqual(0, self.fork(child))
+        # Parent client unchanged and not used by the child
+        self.assertIs(parent_client, self.fs.client)
+        self.assertEqual(rpc_counts, parent_client.rpc_counts)
+
+    def test_1_fork_detected_by_pid(self):
+        # Client not from the pool, which is not forked here
+        self.fs.close_connection()
+        self.app.config['FSM_CLIENT_POLICY'] = 'manager'
+        self.fs.init_app(self.app)
+        parent_client = self.fs.client
+        # Fork not notified to Python
+        self.fs._GFSManager__pid = -1
+        self.assertIsNot(parent_client, self.fs.client)
+        self.assertTrue(self.fs.fs_doc_store(None, {'n': 1}, fs_collection_path=self.col_path)[3])
+        self.assertEqual(os.getpid(), self.fs._GFSManager__pid)
+
+    def test_2_buffered_writes_after_fork(self):
+        spill_path = os.path.join(self.tmp_dir.name, 'writes.spill')
+        writer = BufferedWriter(self.fs, interval=60, spill_path=spill_path)
+        self.fs.set_buffered_writer(writer)
+        writer.store(self.col_path, {'process': 'parent'})
+
+        def child():
+            # Writes of the parent process not inherited, child writes spilled to its own file
+            ok = len(writer) == 0 and writer.spill_path == '{}.{}'.format(spill_path, os.getpid())
+            writer.store(self.col_path, {'process': 'child'})
+            writer.store(self.col_path, {'process': 'child'})
+            # Crash before the writes are flushed
+            return ok
+
+        self.assertEqual(0, self.fork(child))
+        self.assertEqual((1, spill_path), (len(writer), writer.spill_path))
+        writer.close()
+        # Writes of the child process recovered by the next writer of the spill file
+        recovered = BufferedWriter(self.fs, interval=60, spill_path=spill_path)
+        self.assertEqual(2, recovered.recover())
+        self.assertEqual(['writes.spill'], os.listdir(self.tmp_dir.name))
+        recovered.close()
+        self.assertEqual(3, self.fs.fs_count(lookup_collection=self.collection))
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+
+    def test_3_client_per_thread(self):
+        self.fs.close_connection()
+        self.app.config['FSM_CLIENT_POLICY'] = 'thread'
+        self.fs.init_app(self.app)
+        self.assertEqual('thread', self.fs.client_policy)
+        clients = []
+        closed = []
+        lock = threading.Lock()
+
+        def run():
+            with lock:
+                fs_client = self.fs.client
+                fs_client.close = lambda: closed.append(fs_client)
+                clients.append(fs_client)
+            self.assertIs(fs_client, self.fs.client)
+            self.assertTrue(self.fs.fs_doc_store(None, {'n': 1}, fs_collection_path=self.col_path)[3])
+
+        workers = [threading.Thread(target=run) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(4, len(set(map(id, clients))))
+        # Clients of the ended threads closed
+        gc.collect()
+        self.assertEqual(set(map(id, clients)), set(map(id, closed)))
+        self.assertEqual(4, self.fs.fs_count(lookup_collection=self.collection))
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+
+
+class PartitionCase(unittest.TestCase):
+    def setUp(self):
+        self.fs = GFSManager()
+        self.fs.init_app(MockFSOApp(config_class=TestConfig))
+        self.collection = 'Scan_{}'.format(random.randint(0, 10 ** 9))
+        self.col_path = self.fs.path_prefix + '/' + self.collection
+        results = self.fs.fs_docs_store_many(None, [{'i': i} for i in range(300)], fs_collection_path=self.col_path)
+        self.ids = set(fs_id for fs_stored_time, fs_id, fs_path, result in results)
+        # Subcollection of the same name, not part of the collection, of a document sorted after the auto ids
+        self.fs.fs_docs_store_many(None, [{'i': i} for i in range(20)],
+                                   fs_collection_path=self.col_path + '/~doc/' + self.collection)
+
+    def tearDown(self):
+        self.fs.fs_delete_collection(lookup_collection=self.collection)
+        self.fs.close_connection()
+
+    def test_0_partitions(self):
+        ranges = self.fs.fs_collection_partitions(6, lookup_collection=self.collection)
+        self.assertEqual(6, len(ranges))
+        self.assertEqual((None, None), (ranges[0][0], ranges[-1][1]))
+        # Partitions cover the collection documents once
+        ids = [doc.id for start_id, end_id in ranges
+               for doc in self.fs.fs_iter_partition(start_id, end_id, lookup_collection=self.collection, page_size=40)]
+        self.assertEqual((300, self.ids), (len(ids), set(ids)))
+        self.assertEqual([(None, None)], self.fs.fs_collection_partitions(1, lookup_collection=self.collection))
+        # One split point per document: split points of the subcollection ignored
+        self.assertEqual(300, len(self.fs.fs_collection_partitions(320, lookup_collection=self.collection)))
+
+    def test_1_scan(self):
+        pages = []
+        stats = self.fs.fs_scan_partitioned(pages.append, lookup_collection=self.collection, max_workers=3,
+                                            page_size=25, select=['i'])
+        self.assertEqual((300, []), (stats['documents'], stats['failed']))
+        self.assertTrue(all(len(page) <= 25 for page in pages))
+        self.assertEqual(self.ids, set(doc.id for page in pages for doc in page))
+        self.assertEqual(set(range(300)), set(doc.get('i') for page in pages for doc in page))
+
+    def test_2_failed_partitions(self):
+        ids = []
+        self.fs.client.inject_errors('run_query', PermissionDenied('denied'))
+        stats = self.fs.fs_scan_partitioned(lambda page: ids.extend(doc.id for doc in page),
+                                            lookup_collection=self.collection, partitions=4, max_workers=2)
+        self.assertEqual(1, len(stats['failed']))
+        # Failed partitions scanned again
+        start_id, end_id = stats['failed'][0]
+        ids.extend(doc.id for doc in self.fs.fs_iter_partition(start_id, end_id, lookup_collection=self.collection))
+        self.assertEqual((300, self.ids), (len(ids), set(ids)))